@@ -0,0 +1,306 @@
+"""Throughput benchmark of the computation hooks on synthetic models and data.
+
+Example:
+    python benchmark/computation_benchmark.py --models mlp cnn \
+        --batch-sizes 16 64 --worker-nums 1 2 --output bench.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from collections.abc import Callable
+from types import SimpleNamespace
+from typing import Any
+
+import torch
+import torch.nn
+from cyy_torch_algorithm.computation import (
+    BatchHVPHook,
+    SampleGradientHook,
+    SampleGradientJVPHook,
+    SampleGradientVJPHook,
+)
+from cyy_torch_algorithm.computation.computation_hook import ComputationHook
+from cyy_torch_toolbox import ModelEvaluator
+
+CLASS_NUM = 10
+
+
+class SmallTransformer(torch.nn.Module):
+    def __init__(self, seq_len: int = 16, d_model: int = 32) -> None:
+        super().__init__()
+        self.encoder = torch.nn.TransformerEncoderLayer(
+            d_model=d_model, nhead=4, dim_feedforward=64, batch_first=True
+        )
+        self.classifier = torch.nn.Linear(d_model, CLASS_NUM)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.classifier(self.encoder(x).mean(dim=1))
+
+
+def create_model(model_name: str) -> tuple[torch.nn.Module, tuple[int, ...]]:
+    # Returns the model together with the shape of a single input.
+    match model_name:
+        case "mlp":
+            return torch.nn.Sequential(
+                torch.nn.Flatten(),
+                torch.nn.Linear(64, 128),
+                torch.nn.ReLU(),
+                torch.nn.Linear(128, CLASS_NUM),
+            ), (64,)
+        case "cnn":
+            return torch.nn.Sequential(
+                torch.nn.Conv2d(1, 8, 3, padding=1),
+                torch.nn.ReLU(),
+                torch.nn.MaxPool2d(2),
+                torch.nn.Conv2d(8, 16, 3, padding=1),
+                torch.nn.ReLU(),
+                torch.nn.AdaptiveAvgPool2d(1),
+                torch.nn.Flatten(),
+                torch.nn.Linear(16, CLASS_NUM),
+            ), (1, 28, 28)
+        case "transformer":
+            return SmallTransformer(), (16, 32)
+    raise NotImplementedError(model_name)
+
+
+def create_hook(
+    hook_name: str, model: torch.nn.Module, input_shape: tuple[int, ...]
+) -> ComputationHook:
+    match hook_name:
+        case "sample_gradient":
+            return SampleGradientHook()
+        case "batch_hvp":
+            hook = BatchHVPHook()
+            hook.set_vectors(
+                [
+                    {k: torch.randn_like(v) for k, v in model.named_parameters()}
+                    for _ in range(4)
+                ]
+            )
+            return hook
+        case "sample_gjvp":
+            hook = SampleGradientJVPHook()
+            hook.set_vector(torch.randn(input_shape).view(-1))
+            return hook
+        case "sample_gvjp":
+            hook = SampleGradientVJPHook()
+            hook.set_vector(torch.randn(sum(p.numel() for p in model.parameters())))
+            return hook
+    raise NotImplementedError(hook_name)
+
+
+def get_rss_kb(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def get_descendant_pids(pid: int) -> list[int]:
+    children: dict[int, list[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", encoding="utf8") as f:
+                # The command name may contain spaces, so fields are split
+                # after its closing parenthesis.
+                parent_pid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent_pid, []).append(int(entry))
+    pids: list[int] = []
+    stack = [pid]
+    while stack:
+        for child_pid in children.get(stack.pop(), []):
+            pids.append(child_pid)
+            stack.append(child_pid)
+    return pids
+
+
+class RSSSampler:
+    # Samples the summed resident set size of this process and its live
+    # worker processes, which getrusage can not report while they run.
+    def __init__(self, interval: float = 0.05) -> None:
+        self.__interval = interval
+        self.__stop_event = threading.Event()
+        self.__thread: threading.Thread | None = None
+        self.peak_rss_kb: int = 0
+
+    def __sample(self) -> None:
+        while True:
+            pid = os.getpid()
+            self.peak_rss_kb = max(
+                self.peak_rss_kb,
+                sum(get_rss_kb(p) for p in [pid, *get_descendant_pids(pid)]),
+            )
+            if self.__stop_event.wait(self.__interval):
+                return
+
+    def __enter__(self) -> "RSSSampler":
+        self.__thread = threading.Thread(target=self.__sample, daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.__stop_event.set()
+        assert self.__thread is not None
+        self.__thread.join()
+
+
+def get_percentiles(samples: list[float]) -> dict[str, float]:
+    samples = sorted(samples)
+    return {
+        f"p{p}": samples[min(int(p / 100 * len(samples)), len(samples) - 1)]
+        for p in (50, 90, 99)
+    }
+
+
+def run_benchmark(
+    hook_name: str,
+    model_name: str,
+    batch_size: int,
+    worker_num: int,
+    batch_number: int,
+    warmup_batch_number: int = 1,
+    backend: str = "process",
+    in_flight_batch_number: int = 4,
+    configure_hook: Callable | None = None,
+) -> dict[str, Any]:
+    torch.manual_seed(0)
+    model, input_shape = create_model(model_name)
+    model_evaluator = ModelEvaluator(model=model, loss_fun=torch.nn.CrossEntropyLoss())
+    hook = create_hook(hook_name, model, input_shape)
+    hook.set_executor_backend(backend)
+    hook.set_worker_num(worker_num)
+    if configure_hook is not None:
+        configure_hook(hook)
+    hook.enable_timing()
+    # Results are dropped once fetched, so that they do not pile up.
+    hook.set_result_collection_fun(lambda results: None)
+    # Sample hooks submit one task per batch and keep several batches in
+    # flight, while BatchHVPHook needs the results of a batch before the next.
+    if not isinstance(hook, BatchHVPHook):
+        hook.set_max_pending_task_num(in_flight_batch_number)
+
+    blocking_times: list[float] = []
+    start = time.perf_counter()
+    with RSSSampler() as rss_sampler:
+        for batch_index in range(warmup_batch_number + batch_number):
+            if batch_index == warmup_batch_number:
+                # Worker startup and one-time compilation are not measured.
+                _ = hook.result_dict
+                hook.reset_timing_metrics()
+                start = time.perf_counter()
+            inputs = torch.randn((batch_size, *input_shape))
+            targets = torch.randint(0, CLASS_NUM, (batch_size,))
+            batch_start = time.perf_counter()
+            if isinstance(hook, BatchHVPHook):
+                hook._before_batch(
+                    executor=SimpleNamespace(model_evaluator=model_evaluator),
+                    inputs=inputs,
+                    targets=targets,
+                    batch_index=batch_index,
+                )
+                _ = hook.result_dict
+            else:
+                hook._before_batch(
+                    executor=None,
+                    model_evaluator=model_evaluator,
+                    inputs=inputs,
+                    targets=targets,
+                    sample_indices=torch.arange(
+                        batch_index * batch_size, (batch_index + 1) * batch_size
+                    ),
+                )
+            if batch_index >= warmup_batch_number:
+                blocking_times.append((time.perf_counter() - batch_start) * 1000)
+        _ = hook.result_dict
+        elapsed_seconds = time.perf_counter() - start
+    stage_metrics = hook.timing_metrics
+    hook.release()
+
+    # HVP tasks are per vector and not per sample, so throughput counts the
+    # samples of the batches for all hooks. Blocking times are how long each
+    # batch holds up the caller.
+    return {
+        "hook": hook_name,
+        "model": model_name,
+        "batch_size": batch_size,
+        "worker_num": worker_num,
+        "backend": backend,
+        "batch_number": batch_number,
+        "in_flight_batch_number": in_flight_batch_number,
+        "samples_per_second": batch_size * batch_number / elapsed_seconds,
+        "batch_blocking_ms": get_percentiles(blocking_times),
+        "peak_rss_mb": rss_sampler.peak_rss_kb / 1024,
+        "stage_metrics": stage_metrics,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--hooks",
+        nargs="+",
+        default=["sample_gradient", "batch_hvp", "sample_gjvp", "sample_gvjp"],
+    )
+    parser.add_argument("--models", nargs="+", default=["mlp", "cnn", "transformer"])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[32])
+    parser.add_argument("--worker-nums", nargs="+", type=int, default=[1])
+    parser.add_argument("--batch-number", type=int, default=10)
+    parser.add_argument("--in-flight-batch-number", type=int, default=4)
+    parser.add_argument(
+        "--backend", default="process", choices=["process", "thread", "inline"]
+    )
+    parser.add_argument("--output", help="JSON file, defaults to stdout")
+    args = parser.parse_args()
+
+    results = []
+    for hook_name in args.hooks:
+        for model_name in args.models:
+            for batch_size in args.batch_sizes:
+                for worker_num in args.worker_nums:
+                    result = run_benchmark(
+                        hook_name=hook_name,
+                        model_name=model_name,
+                        batch_size=batch_size,
+                        worker_num=worker_num,
+                        batch_number=args.batch_number,
+                        backend=args.backend,
+                        in_flight_batch_number=args.in_flight_batch_number,
+                    )
+                    print(
+                        f"{hook_name} {model_name} batch_size={batch_size} "
+                        f"worker_num={worker_num}: "
+                        f"{result['samples_per_second']:.1f} samples/s",
+                        file=sys.stderr,
+                    )
+                    results.append(result)
+    report = {
+        "timestamp": datetime.datetime.now(datetime.UTC).isoformat(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "cuda": torch.cuda.is_available(),
+        "results": results,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    with open(args.output, "w", encoding="utf8") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
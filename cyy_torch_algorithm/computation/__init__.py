@@ -2,3 +2,4 @@ from .batch_hvp import *
 from .sample_gjvp import *
 from .sample_gradient import *
 from .sample_gvjp import *
+from .worker_pool import ComputationWorkerPool, shutdown_worker_pool
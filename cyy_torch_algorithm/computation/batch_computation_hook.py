@@ -1,5 +1,6 @@
 import functools
-from collections.abc import Callable
+import itertools
+from collections.abc import Callable, Iterable
 from typing import Any
 
 import torch
@@ -13,6 +14,7 @@ class BatchComputationHook(ComputationHook):
         super().__init__(**kwargs)
         self.__data_fun: Callable | None = None
         self.__data: Any | None = None
+        self.__last_batch_index: int | None = None
 
     def set_data(self, data: Any) -> None:
         self.__data = data
@@ -43,6 +45,10 @@ class BatchComputationHook(ComputationHook):
             batch_index=batch_index,
         )
 
+    def reset(self) -> None:
+        super().reset()
+        self.__last_batch_index = None
+
     def _get_batch_computation_fun(self) -> Callable:
         raise NotImplementedError()
 
@@ -60,9 +66,27 @@ class BatchComputationHook(ComputationHook):
             inputs=inputs,
             targets=targets,
         )
-        for data_idx, data_piece in enumerate(data):
+        self.__last_batch_index = batch_index
+        self.__add_data_tasks(data)
+
+    def add_data(self, data: Any) -> None:
+        # Computes on new data with the inputs of the last batch, whose one-shot
+        # data are still cached by the workers.
+        assert not self.has_unfetched_result()
+        assert self.__last_batch_index is not None
+        self.__add_data_tasks(data)
+
+    def _get_data_indices(self, data: Any) -> Iterable:
+        # Results are keyed by these indices.
+        return itertools.count()
+
+    def __add_data_tasks(self, data: Any) -> None:
+        assert self.__last_batch_index is not None
+        for data_idx, data_piece in zip(
+            self._get_data_indices(data), data, strict=False
+        ):
             self._add_task(
-                task=(batch_index, data_idx, data_piece),
+                task=(self.__last_batch_index, data_idx, data_piece),
             )
 
     def common_worker_fun(
@@ -84,24 +108,62 @@ class BatchComputationHook(ComputationHook):
                 worker_device=worker_device,
                 model_queue=model_queue,
             )
-            data = tensor_to(data, device=worker_device, non_blocking=True)
+            with self._time_worker_stage("device_transfer", stream=worker_stream):
+                data = tensor_to(data, device=worker_device, non_blocking=True)
             worker_fun = self.get_cached_item(
                 "worker_fun", worker_fun, worker_device=worker_device
             )
-            res = worker_fun(data=data, worker_device=worker_device, **one_shot_data)
+            with self._time_worker_stage("compute", stream=worker_stream):
+                res = worker_fun(
+                    data=data, worker_device=worker_device, **one_shot_data
+                )
 
             result_transform = self.get_cached_item(
                 "result_transform", self._result_transform, worker_device=worker_device
             )
             if result_transform is not None:
-                new_res: dict = {
-                    data_index: result_transform(
-                        data_index=data_index, result=v, data=data
-                    )
-                    for data_index, v, data in zip(
-                        data_indices, res, data, strict=False
-                    )
-                }
+                with self._time_worker_stage("result_transform", stream=worker_stream):
+                    new_res: dict = {
+                        data_index: result_transform(
+                            data_index=data_index, result=v, data=data
+                        )
+                        for data_index, v, data in zip(
+                            data_indices, res, data, strict=False
+                        )
+                    }
             else:
                 new_res = dict(zip(data_indices, res, strict=False))
-            return batch_size, new_res
+            return self._get_worker_result(batch_size, new_res)
+
+
+class SeededBatchComputationHook(BatchComputationHook):
+    # Computes on every every_n_batches batches with a single data piece, a
+    # seed derived from the hook seed and the number of computed batches.
+    # Results are keyed by the batch index.
+    def __init__(self, seed: int = 0, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.__seed = seed
+        self.__batch_number = 0
+        self.__batch_index = 0
+        self.__every_n_batches = 1
+        self.set_data_fun(self.__get_seeds)
+
+    def _set_every_n_batches(self, every_n_batches: int) -> None:
+        assert every_n_batches > 0
+        self.__every_n_batches = every_n_batches
+
+    def __get_seeds(self) -> list[int]:
+        return [self.__seed * 1_000_003 + self.__batch_number]
+
+    def _get_data_indices(self, data: Any) -> Iterable:
+        return [self.__batch_index]
+
+    def _before_batch(self, batch_index: int, **kwargs: Any) -> None:
+        if batch_index % self.__every_n_batches != 0:
+            return
+        # Results of the previous batch are collected before new tasks.
+        if self.has_unfetched_result():
+            _ = self.result_dict
+        self.__batch_index = batch_index
+        super()._before_batch(batch_index=batch_index, **kwargs)
+        self.__batch_number += 1
@@ -1,3 +1,17 @@
 from .batch_hvp_hook import BatchHVPHook
+from .hessian_eigen_hook import HessianEigenHook
+from .hessian_trace_hook import (
+    HessianTraceHook,
+    get_hessian_diagonal,
+    get_hessian_trace,
+)
+from .inverse_hvp_hook import InverseHVPHook
 
-__all__ = ["BatchHVPHook"]
+__all__ = [
+    "BatchHVPHook",
+    "HessianEigenHook",
+    "HessianTraceHook",
+    "InverseHVPHook",
+    "get_hessian_diagonal",
+    "get_hessian_trace",
+]
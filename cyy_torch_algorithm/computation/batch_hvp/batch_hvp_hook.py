@@ -1,21 +1,87 @@
-import collections
 import functools
 from collections.abc import Callable
 
 import torch
 import torch.cuda
 from cyy_naive_lib.algorithm.mapping_op import get_mapping_items_by_key_order
-from cyy_torch_toolbox import (
-    ModelEvaluator,
-    ModelParameter,
-    TensorDict,
-    cat_tensor_dict,
-)
-from cyy_torch_toolbox.tensor import decompose_like_tensor_dict
-from torch.func import grad, jvp, vmap
+from cyy_torch_toolbox import ModelEvaluator, ModelParameter, TensorDict
+from torch.func import grad, jvp, linearize, vmap
 
 from ..batch_computation_hook import BatchComputationHook
+from ..compile_cache import CompiledFunctionCache
 from ..evaluation import eval_model
+from ..flat_parameter import ParameterLayout
+
+
+def get_parameter_dtype(parameters: ModelParameter | torch.Tensor) -> torch.dtype:
+    if isinstance(parameters, torch.Tensor):
+        return parameters.dtype
+    return next(iter(parameters.values())).dtype
+
+
+def get_hvp_fun(
+    model_evaluator: ModelEvaluator,
+    inputs,
+    targets,
+    worker_device: torch.device,
+    parameters: ModelParameter | torch.Tensor,
+    parameter_layout: ParameterLayout | None = None,
+    linearize_once: bool = False,
+) -> Callable:
+    # The returned function maps a tangent to H·v. Tangents are flat tensors
+    # with parameter_layout and dicts in key order otherwise.
+    f = functools.partial(
+        eval_model,
+        inputs=inputs,
+        targets=targets,
+        device=worker_device,
+        model_evaluator=model_evaluator,
+        parameter_layout=parameter_layout,
+    )
+
+    def grad_f(parameters):
+        return grad(f, argnums=0)(parameters)
+
+    if parameter_layout is None:
+        parameters = dict(get_mapping_items_by_key_order(parameters))
+    if linearize_once:
+        # The gradient graph of the batch is traced only once.
+        return linearize(grad_f, parameters)[1]
+
+    def hvp_fun(vector):
+        return jvp(grad_f, (parameters,), (vector,))[1]
+
+    return hvp_fun
+
+
+def get_linearized_hvp_fun(**kwargs) -> Callable:
+    return get_hvp_fun(linearize_once=True, **kwargs)
+
+
+def get_flat_hvp_fun(
+    parameters: ModelParameter | torch.Tensor,
+    parameter_layout: ParameterLayout | None = None,
+    hvp_fun_getter: Callable | None = None,
+    **kwargs,
+) -> Callable:
+    # Maps stacked flat vectors of shape [n, parameter number] to their HVPs,
+    # linearizing the batch gradient once by default.
+    if hvp_fun_getter is None:
+        hvp_fun_getter = get_linearized_hvp_fun
+    hvp_fun = vmap(
+        hvp_fun_getter(
+            parameters=parameters, parameter_layout=parameter_layout, **kwargs
+        ),
+        randomness="same",
+    )
+    if parameter_layout is not None:
+        return hvp_fun
+    layout = ParameterLayout(parameters)
+
+    def flat_hvp_fun(vectors: torch.Tensor) -> torch.Tensor:
+        return layout.flatten(hvp_fun(layout.unflatten(vectors)))
+
+    return flat_hvp_fun
 
 
 def batch_hvp_worker_fun(
@@ -24,60 +90,81 @@ def batch_hvp_worker_fun(
     targets,
     data,
     worker_device: torch.device,
-    parameters: ModelParameter,
+    parameters: ModelParameter | torch.Tensor,
+    parameter_layout: ParameterLayout | None = None,
+    hvp_fun_getter: Callable | None = None,
+    compile_cache: CompiledFunctionCache | None = None,
 ) -> list[TensorDict] | list[torch.Tensor]:
     assert data
     vector_size = len(data)
-    vectors = data
-    parameters = collections.OrderedDict(
-        list(get_mapping_items_by_key_order(parameters))
-    )
+    layout = parameter_layout
+    if layout is None:
+        layout = ParameterLayout(parameters)
 
-    def hvp_wrapper(vector):
-        f = functools.partial(
-            eval_model,
+    vectors: TensorDict | torch.Tensor
+    if isinstance(data[0], dict):
+        vectors = {k: torch.stack([vector[k] for vector in data]) for k in layout.names}
+        if parameter_layout is not None:
+            vectors = layout.flatten(vectors)
+    else:
+        vectors = torch.stack(data).view(vector_size, -1)
+        if parameter_layout is None:
+            vectors = layout.unflatten(vectors)
+    if hvp_fun_getter is None and compile_cache is not None:
+        # The batch is passed as arguments, so the compiled function is reused
+        # by all batches of the same shapes.
+        def batch_hvp(parameters, inputs, targets, vectors):
+            return vmap(
+                get_hvp_fun(
+                    model_evaluator=model_evaluator,
+                    inputs=inputs,
+                    targets=targets,
+                    worker_device=worker_device,
+                    parameters=parameters,
+                    parameter_layout=parameter_layout,
+                ),
+                randomness="same",
+            )(vectors)
+
+        products = compile_cache.run(
+            "batch_hvp",
+            batch_hvp,
+            parameters,
+            inputs,
+            targets,
+            vectors,
+            model_evaluator=model_evaluator,
+            parameter_layout=parameter_layout,
+        )
+    else:
+        if hvp_fun_getter is None:
+            hvp_fun_getter = get_hvp_fun
+        hvp_fun = hvp_fun_getter(
+            model_evaluator=model_evaluator,
             inputs=inputs,
             targets=targets,
-            device=worker_device,
-            model_evaluator=model_evaluator,
+            worker_device=worker_device,
+            parameters=parameters,
+            parameter_layout=parameter_layout,
         )
-
-        def grad_f(parameters):
-            return grad(f, argnums=0)(parameters)
-
-        return jvp(
-            grad_f,
-            (parameters,),
-            (vector,),
-        )[1]
-
-    decompose_vector = False
-    if not isinstance(vectors[0], dict):
-        decompose_vector = True
-        vectors = [decompose_like_tensor_dict(parameters, vector) for vector in vectors]
-        assert len(vectors) == vector_size
-    new_vectors = {
-        k: torch.stack([vector[k] for vector in vectors]) for k in vectors[0]
-    }
-    new_vectors = collections.OrderedDict(
-        list(get_mapping_items_by_key_order(new_vectors))
-    )
-    res = vmap(
-        hvp_wrapper,
-        in_dims=(collections.OrderedDict((k, 0) for k in new_vectors),),
-        randomness="same",
-    )(new_vectors)
-    products: list[TensorDict] | list[torch.Tensor] = [
-        {k: v[idx] for k, v in res.items()} for idx in range(vector_size)
-    ]
-    if decompose_vector:
-        products = [cat_tensor_dict(product) for product in products]
-    assert len(products) == vector_size
-    return products
+        products = vmap(hvp_fun, randomness="same")(vectors)
+    if isinstance(data[0], dict):
+        if parameter_layout is not None:
+            products = layout.unflatten(products)
+        return [{k: v[idx] for k, v in products.items()} for idx in range(vector_size)]
+    if parameter_layout is None:
+        products = layout.flatten(products)
+    return list(products)
 
 
 class BatchHVPHook(BatchComputationHook):
     vectors: list[torch.Tensor] | list[TensorDict] = []
+    __linearize_once: bool = False
+
+    def enable_linearization(self) -> None:
+        # Workers linearize the gradient once per batch and parameter version,
+        # so vectors added later by add_data skip the primal computation.
+        self.__linearize_once = True
 
     def get_vectors(self) -> list[torch.Tensor] | list[TensorDict]:
         return self.vectors
@@ -86,5 +173,39 @@ class BatchHVPHook(BatchComputationHook):
         self.vectors = vectors
         self.set_data_fun(self.get_vectors)
 
+    def _get_hvp_fun_getter(self) -> Callable | None:
+        if not self.__linearize_once:
+            return None
+        return self._get_linearized_hvp_fun
+
+    def _get_linearized_hvp_fun(
+        self, inputs, targets, parameters: ModelParameter | torch.Tensor, **kwargs
+    ) -> Callable:
+        # The one-shot data of a batch are reused by the worker until the batch
+        # or the parameter version changes, so identity checks are sufficient.
+        cached = self.get_cached_item("linearized_hvp_fun", None)
+        if (
+            cached is not None
+            and cached[0] is inputs
+            and cached[1] is targets
+            and cached[2] is parameters
+        ):
+            return cached[3]
+        self._remove_cached_item("linearized_hvp_fun")
+        hvp_fun = get_linearized_hvp_fun(
+            inputs=inputs,
+            targets=targets,
+            parameters=parameters,
+            **kwargs,
+        )
+        self.get_cached_item(
+            "linearized_hvp_fun", (inputs, targets, parameters, hvp_fun)
+        )
+        return hvp_fun
+
     def _get_batch_computation_fun(self) -> Callable:
-        return batch_hvp_worker_fun
+        return functools.partial(
+            batch_hvp_worker_fun,
+            hvp_fun_getter=self._get_hvp_fun_getter(),
+            compile_cache=self._get_compile_cache(),
+        )
@@ -0,0 +1,152 @@
+import functools
+from collections.abc import Callable
+from typing import Any
+
+import torch
+from cyy_naive_lib.log import log_debug
+from cyy_torch_toolbox import ModelEvaluator, ModelParameter
+
+from ..batch_computation_hook import SeededBatchComputationHook
+from ..flat_parameter import ParameterLayout
+from .batch_hvp_hook import get_flat_hvp_fun, get_parameter_dtype
+
+
+def block_lanczos(
+    matvec: Callable,
+    initial_block: torch.Tensor,
+    top_k: int,
+    max_iteration: int,
+    tolerance: float,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    # Rows of initial_block span the starting block. The Krylov basis is fully
+    # reorthogonalized, and Ritz pairs come from the Rayleigh quotient of all
+    # basis vectors, stopping once the top_k Ritz values stop changing.
+    basis, _ = torch.linalg.qr(initial_block.T)
+    basis = basis.T
+    bases: list[torch.Tensor] = []
+    products: list[torch.Tensor] = []
+    ritz_values: torch.Tensor | None = None
+    ritz_vectors: torch.Tensor | None = None
+    for iteration in range(max_iteration):
+        bases.append(basis)
+        products.append(matvec(basis))
+        krylov_basis = torch.cat(bases)
+        projected_matrix = krylov_basis @ torch.cat(products).T
+        projected_matrix = (projected_matrix + projected_matrix.T) / 2
+        eigenvalues, eigenvectors = torch.linalg.eigh(projected_matrix)
+        eigenvalues = eigenvalues.flip(0)[:top_k]
+        eigenvectors = eigenvectors.flip(1)[:, :top_k]
+        if (
+            ritz_values is not None
+            and eigenvalues.shape == ritz_values.shape
+            and (
+                (eigenvalues - ritz_values).abs()
+                <= tolerance * eigenvalues.abs().clamp(min=1e-12)
+            ).all()
+        ):
+            ritz_values = eigenvalues
+            ritz_vectors = eigenvectors.T @ krylov_basis
+            log_debug("block Lanczos converges in %s iterations", iteration + 1)
+            break
+        ritz_values = eigenvalues
+        ritz_vectors = eigenvectors.T @ krylov_basis
+        if krylov_basis.shape[0] + basis.shape[0] > krylov_basis.shape[1]:
+            break
+        residual = products[-1]
+        # Orthogonalize twice against the whole basis for numerical stability.
+        for _ in range(2):
+            residual = residual - (residual @ krylov_basis.T) @ krylov_basis
+        basis, r = torch.linalg.qr(residual.T)
+        basis = basis.T
+        # Directions with vanishing residuals mean an invariant subspace.
+        basis = basis[r.diagonal().abs() > 1e-10 * r.abs().max().clamp(min=1e-30)]
+        if basis.shape[0] == 0:
+            break
+    assert ritz_values is not None and ritz_vectors is not None
+    return ritz_values, ritz_vectors
+
+
+def hessian_eigen_worker_fun(
+    model_evaluator: ModelEvaluator,
+    inputs,
+    targets,
+    data: list[int],
+    worker_device: torch.device,
+    parameters: ModelParameter | torch.Tensor,
+    parameter_layout: ParameterLayout | None = None,
+    top_k: int = 1,
+    block_size: int | None = None,
+    max_iteration: int = 20,
+    tolerance: float = 1e-3,
+) -> list[dict]:
+    # Each data piece is a seed, and the whole solve runs in this task so that
+    # the model and the linearized gradient stay on the worker.
+    matvec = get_flat_hvp_fun(
+        model_evaluator=model_evaluator,
+        inputs=inputs,
+        targets=targets,
+        worker_device=worker_device,
+        parameters=parameters,
+        parameter_layout=parameter_layout,
+    )
+    layout = parameter_layout
+    if layout is None:
+        layout = ParameterLayout(parameters)
+    dtype = get_parameter_dtype(parameters)
+    if block_size is None:
+        block_size = top_k
+    results: list[dict] = []
+    for seed in data:
+        generator = torch.Generator(device=worker_device)
+        generator.manual_seed(seed)
+        eigenvalues, eigenvectors = block_lanczos(
+            matvec=matvec,
+            initial_block=torch.randn(
+                (min(block_size, layout.numel), layout.numel),
+                generator=generator,
+                device=worker_device,
+                dtype=dtype,
+            ),
+            top_k=top_k,
+            max_iteration=max_iteration,
+            tolerance=tolerance,
+        )
+        result: dict[str, Any] = {"eigenvalues": eigenvalues}
+        if parameter_layout is not None:
+            result["eigenvectors"] = eigenvectors
+        else:
+            split_eigenvectors = layout.unflatten(eigenvectors)
+            result["eigenvectors"] = [
+                {k: v[idx] for k, v in split_eigenvectors.items()}
+                for idx in range(eigenvectors.shape[0])
+            ]
+        results.append(result)
+    return results
+
+
+class HessianEigenHook(SeededBatchComputationHook):
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.__solver_kwargs: dict = {}
+
+    def set_eigen_config(
+        self,
+        top_k: int = 1,
+        block_size: int | None = None,
+        max_iteration: int = 20,
+        tolerance: float = 1e-3,
+        every_n_batches: int = 1,
+    ) -> None:
+        # Each iteration costs block_size HVPs in one vmapped call, and the
+        # block size defaults to top_k.
+        assert top_k > 0 and max_iteration > 0
+        self._set_every_n_batches(every_n_batches)
+        self.__solver_kwargs = {
+            "top_k": top_k,
+            "block_size": block_size,
+            "max_iteration": max_iteration,
+            "tolerance": tolerance,
+        }
+
+    def _get_batch_computation_fun(self) -> Callable:
+        return functools.partial(hessian_eigen_worker_fun, **self.__solver_kwargs)
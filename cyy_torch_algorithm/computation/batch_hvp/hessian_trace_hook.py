@@ -0,0 +1,184 @@
+import copy
+import functools
+from collections.abc import Callable
+from typing import Any
+
+import torch
+from cyy_naive_lib.log import log_debug
+from cyy_torch_toolbox import (
+    Inferencer,
+    ModelEvaluator,
+    ModelParameter,
+    TensorDict,
+    tensor_to,
+)
+
+from ..batch_computation_hook import SeededBatchComputationHook
+from ..flat_parameter import ParameterLayout
+from ..sample_gradient.sample_gradient_hook import get_sample_gradient_chunk_size
+from .batch_hvp_hook import get_flat_hvp_fun, get_parameter_dtype
+
+
+def hutchinson_worker_fun(
+    model_evaluator: ModelEvaluator,
+    inputs,
+    targets,
+    data: list[int],
+    worker_device: torch.device,
+    parameters: ModelParameter | torch.Tensor,
+    parameter_layout: ParameterLayout | None = None,
+    probe_batch_size: int | None = None,
+    max_probe_number: int = 256,
+    tolerance: float = 0.01,
+    estimate_diagonal: bool = False,
+) -> list[dict]:
+    # Each data piece is a seed. Rademacher probes v give unbiased estimates
+    # v·Hv of the trace and v⊙Hv of the diagonal, and probe batches are drawn
+    # until the standard error of the trace is below tolerance·|trace|.
+    layout = parameter_layout
+    if layout is None:
+        layout = ParameterLayout(parameters)
+    hvp_fun = get_flat_hvp_fun(
+        model_evaluator=model_evaluator,
+        inputs=inputs,
+        targets=targets,
+        worker_device=worker_device,
+        parameters=parameters,
+        parameter_layout=parameter_layout,
+    )
+    dtype = get_parameter_dtype(parameters)
+    if probe_batch_size is None:
+        probe_batch_size = get_sample_gradient_chunk_size(
+            parameter_bytes=layout.numel * dtype.itemsize, device=worker_device
+        )
+    if probe_batch_size is None:
+        probe_batch_size = max_probe_number
+    probe_batch_size = min(probe_batch_size, max_probe_number)
+
+    results: list[dict] = []
+    for seed in data:
+        generator = torch.Generator(device=worker_device)
+        generator.manual_seed(seed)
+        trace_samples: list[torch.Tensor] = []
+        diagonal_sum: torch.Tensor | None = None
+        probe_number = 0
+        std_error = torch.tensor(float("inf"))
+        while probe_number < max_probe_number:
+            batch_size = min(probe_batch_size, max_probe_number - probe_number)
+            probes = (
+                torch.randint(
+                    0,
+                    2,
+                    (batch_size, layout.numel),
+                    generator=generator,
+                    device=worker_device,
+                    dtype=dtype,
+                )
+                .mul_(2)
+                .sub_(1)
+            )
+            products = hvp_fun(probes).mul_(probes)
+            trace_samples.append(products.sum(dim=1))
+            if estimate_diagonal:
+                diagonal = products.sum(dim=0)
+                diagonal_sum = (
+                    diagonal if diagonal_sum is None else diagonal_sum.add_(diagonal)
+                )
+            del products
+            probe_number += batch_size
+            samples = torch.cat(trace_samples)
+            if probe_number > 1:
+                std_error = samples.std() / (probe_number**0.5)
+                if std_error <= tolerance * samples.mean().abs():
+                    break
+        log_debug("use %s probes for Hutchinson estimation", probe_number)
+        result: dict[str, Any] = {
+            "trace": samples.mean().item(),
+            "trace_std_error": float(std_error),
+            "probe_number": probe_number,
+        }
+        if diagonal_sum is not None:
+            diagonal_sum.div_(probe_number)
+            result["diagonal"] = (
+                diagonal_sum
+                if parameter_layout is not None
+                else layout.unflatten(diagonal_sum)
+            )
+        results.append(result)
+    return results
+
+
+class HessianTraceHook(SeededBatchComputationHook):
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.__estimator_kwargs: dict = {}
+
+    def set_probe_config(
+        self,
+        probe_batch_size: int | None = None,
+        max_probe_number: int = 256,
+        tolerance: float = 0.01,
+        estimate_diagonal: bool = False,
+        every_n_batches: int = 1,
+    ) -> None:
+        # The cost per step is bounded by max_probe_number HVPs on every
+        # every_n_batches batches. Without probe_batch_size, probe batches are
+        # sized by the available device memory.
+        assert max_probe_number > 0
+        self._set_every_n_batches(every_n_batches)
+        self.__estimator_kwargs = {
+            "probe_batch_size": probe_batch_size,
+            "max_probe_number": max_probe_number,
+            "tolerance": tolerance,
+            "estimate_diagonal": estimate_diagonal,
+        }
+
+    def _get_batch_computation_fun(self) -> Callable:
+        return functools.partial(hutchinson_worker_fun, **self.__estimator_kwargs)
+
+
+def get_hessian_estimates(
+    inferencer: Inferencer,
+    estimate_diagonal: bool = False,
+    seed: int = 0,
+    **kwargs: Any,
+) -> dict:
+    # Averages the per-batch estimates over the dataset.
+    hook = HessianTraceHook(seed=seed)
+    hook.set_probe_config(estimate_diagonal=estimate_diagonal, **kwargs)
+    estimates: list[dict] = []
+    hook.set_result_collection_fun(
+        lambda results: estimates.extend(tensor_to(results, device="cpu").values())
+    )
+    tmp_inferencer = copy.deepcopy(inferencer)
+    tmp_inferencer.hook_config.use_performance_metric = False
+    tmp_inferencer.hook_config.summarize_executor = False
+    tmp_inferencer.append_hook(hook)
+    tmp_inferencer.inference()
+    _ = hook.result_dict
+    hook.release()
+    assert estimates
+    result: dict = {
+        "trace": sum(estimate["trace"] for estimate in estimates) / len(estimates),
+        "probe_number": sum(estimate["probe_number"] for estimate in estimates),
+    }
+    if estimate_diagonal:
+        diagonals: list[Any] = [estimate["diagonal"] for estimate in estimates]
+        if isinstance(diagonals[0], dict):
+            result["diagonal"] = {
+                k: sum(diagonal[k] for diagonal in diagonals) / len(diagonals)
+                for k in diagonals[0]
+            }
+        else:
+            result["diagonal"] = sum(diagonals) / len(diagonals)
+    return result
+
+
+def get_hessian_trace(inferencer: Inferencer, **kwargs: Any) -> float:
+    return get_hessian_estimates(inferencer=inferencer, **kwargs)["trace"]
+
+
+def get_hessian_diagonal(inferencer: Inferencer, **kwargs: Any) -> TensorDict:
+    return get_hessian_estimates(
+        inferencer=inferencer, estimate_diagonal=True, **kwargs
+    )["diagonal"]
@@ -0,0 +1,158 @@
+import functools
+from collections.abc import Callable
+
+import torch
+from cyy_naive_lib.log import log_debug, log_warning
+from cyy_torch_toolbox import ModelEvaluator, ModelParameter, TensorDict
+
+from ..flat_parameter import ParameterLayout
+from .batch_hvp_hook import BatchHVPHook, get_flat_hvp_fun
+
+
+def conjugate_gradient(
+    matvec: Callable,
+    b: torch.Tensor,
+    max_iteration: int,
+    tolerance: float,
+) -> torch.Tensor:
+    # Solves each row of b independently and stops once all residuals
+    # are below tolerance relative to the right hand side. A row also stops
+    # at a direction of non-positive curvature, where CG breaks down.
+    x = torch.zeros_like(b)
+    r = b.clone()
+    p = r.clone()
+    rs = (r * r).sum(dim=1)
+    threshold = (tolerance * b.norm(dim=1)) ** 2
+    for iteration in range(max_iteration):
+        active = rs > threshold
+        if not active.any():
+            log_debug("conjugate gradient converges in %s iterations", iteration)
+            break
+        ap = matvec(p)
+        curvature = (p * ap).sum(dim=1)
+        breakdown = active & (curvature <= 0)
+        if breakdown.any():
+            log_warning(
+                "conjugate gradient stops at non-positive curvature for %s vectors",
+                breakdown.sum().item(),
+            )
+            active &= ~breakdown
+            rs = torch.where(breakdown, 0, rs)
+        alpha = torch.where(active, rs / curvature, 0)
+        x.add_(alpha.unsqueeze(1) * p)
+        r.sub_(alpha.unsqueeze(1) * ap)
+        new_rs = (r * r).sum(dim=1)
+        beta = torch.where(active, new_rs / rs, 0)
+        p = r + beta.unsqueeze(1) * p
+        rs = torch.where(active, new_rs, rs)
+    return x
+
+
+def lissa(
+    matvec: Callable,
+    b: torch.Tensor,
+    max_iteration: int,
+    tolerance: float,
+    damping: float,
+    scale: float,
+) -> torch.Tensor:
+    # The fixed point of the recursion is (H + damping·I)^{-1}·b · scale, and
+    # it converges when the eigenvalues of H + damping·I are in (0, 2 · scale).
+    h = b.clone()
+    for iteration in range(max_iteration):
+        new_h = b + (1 - damping / scale) * h - matvec(h) / scale
+        change = (new_h - h).norm(dim=1) / (new_h.norm(dim=1) + 1e-12)
+        h = new_h
+        if (change <= tolerance).all():
+            log_debug("LiSSA converges in %s iterations", iteration + 1)
+            break
+    return h / scale
+
+
+def inverse_hvp_worker_fun(
+    model_evaluator: ModelEvaluator,
+    inputs,
+    targets,
+    data,
+    worker_device: torch.device,
+    parameters: ModelParameter | torch.Tensor,
+    parameter_layout: ParameterLayout | None = None,
+    solver: str = "cg",
+    max_iteration: int = 100,
+    tolerance: float = 1e-5,
+    damping: float = 0.01,
+    scale: float = 10.0,
+    hvp_fun_getter: Callable | None = None,
+) -> list[TensorDict] | list[torch.Tensor]:
+    assert data
+    matvec = get_flat_hvp_fun(
+        model_evaluator=model_evaluator,
+        inputs=inputs,
+        targets=targets,
+        worker_device=worker_device,
+        parameters=parameters,
+        parameter_layout=parameter_layout,
+        hvp_fun_getter=hvp_fun_getter,
+    )
+    layout = parameter_layout
+    if layout is None:
+        layout = ParameterLayout(parameters)
+    b = torch.stack(
+        [
+            layout.flatten(vector) if isinstance(vector, dict) else vector.reshape(-1)
+            for vector in data
+        ]
+    ).to(device=worker_device)
+    match solver:
+        case "cg":
+            solutions = conjugate_gradient(
+                matvec=lambda x: matvec(x) + damping * x,
+                b=b,
+                max_iteration=max_iteration,
+                tolerance=tolerance,
+            )
+        case "lissa":
+            solutions = lissa(
+                matvec=matvec,
+                b=b,
+                max_iteration=max_iteration,
+                tolerance=tolerance,
+                damping=damping,
+                scale=scale,
+            )
+        case _:
+            raise NotImplementedError(solver)
+    if not isinstance(data[0], dict):
+        return list(solutions)
+    split_solutions = layout.unflatten(solutions)
+    return [{k: v[idx] for k, v in split_solutions.items()} for idx in range(len(data))]
+
+
+class InverseHVPHook(BatchHVPHook):
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.__solver_kwargs: dict = {"solver": "cg"}
+
+    def set_solver(
+        self,
+        solver: str,
+        max_iteration: int = 100,
+        tolerance: float = 1e-5,
+        damping: float = 0.01,
+        scale: float = 10.0,
+    ) -> None:
+        assert solver in ("cg", "lissa")
+        self.__solver_kwargs = {
+            "solver": solver,
+            "max_iteration": max_iteration,
+            "tolerance": tolerance,
+            "damping": damping,
+            "scale": scale,
+        }
+
+    def _get_batch_computation_fun(self) -> Callable:
+        return functools.partial(
+            inverse_hvp_worker_fun,
+            hvp_fun_getter=self._get_hvp_fun_getter(),
+            **self.__solver_kwargs,
+        )
@@ -0,0 +1,157 @@
+import functools
+import threading
+from collections.abc import Callable
+from typing import Any
+
+import torch
+from cyy_naive_lib.log import log_info, log_warning
+from cyy_torch_toolbox import ModelEvaluator, ModelParameter
+
+from .flat_parameter import ParameterLayout
+
+
+def get_tensor_signature(data: Any) -> Any:
+    match data:
+        case torch.Tensor():
+            return (tuple(data.shape), data.dtype, data.device)
+        case dict():
+            return tuple((k, get_tensor_signature(v)) for k, v in data.items())
+        case list() | tuple():
+            return tuple(get_tensor_signature(v) for v in data)
+        case _:
+            return type(data)
+
+
+def pad_first_dim(data: Any, size: int) -> Any:
+    # Repeats the last row of every tensor up to size rows.
+    match data:
+        case torch.Tensor():
+            if data.shape[0] == size:
+                return data
+            return torch.cat(
+                [data, data[-1:].expand(size - data.shape[0], *data.shape[1:])]
+            )
+        case dict():
+            return {k: pad_first_dim(v, size) for k, v in data.items()}
+        case list() | tuple():
+            return type(data)(pad_first_dim(v, size) for v in data)
+        case _:
+            return data
+
+
+def truncate_first_dim(data: Any, size: int) -> Any:
+    match data:
+        case torch.Tensor():
+            return data[:size]
+        case dict():
+            return {k: truncate_first_dim(v, size) for k, v in data.items()}
+        case list() | tuple():
+            return type(data)(truncate_first_dim(v, size) for v in data)
+        case _:
+            return data
+
+
+def reload_parameters(
+    parameters: ModelParameter | torch.Tensor,
+    *args: Any,
+    fun: Callable,
+    model_evaluator: ModelEvaluator,
+    parameter_layout: ParameterLayout | None,
+) -> Any:
+    # Evaluating the model loads the parameters wrapped by torch.func into it,
+    # and these must not escape from the compiled graph.
+    result = fun(parameters, *args)
+    if parameter_layout is not None:
+        parameters = parameter_layout.unflatten(parameters)
+    model_evaluator.model_util.load_buffers(parameters)
+    return result
+
+
+class CompiledFunctionCache:
+    # Compiled worker functions keyed by name, the objects captured by the
+    # function and the shapes and dtypes of the arguments. Every worker
+    # process gets its own copy, and compiling happens on the first call with
+    # a new key. All entries share the recompile limit of torch.compile, so
+    # per-sample functions get their sample numbers padded to powers of two
+    # instead of a graph for every sample number.
+    def __init__(self, **compile_kwargs: Any) -> None:
+        self.__compile_kwargs = {"dynamic": False} | compile_kwargs
+        self.__functions: dict[tuple, Callable] = {}
+        self.__lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_CompiledFunctionCache__functions"] = {}
+        state["_CompiledFunctionCache__lock"] = None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.__functions)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__functions.clear()
+
+    def run(
+        self,
+        name: str,
+        fun: Callable,
+        parameters: ModelParameter | torch.Tensor,
+        *args: Any,
+        model_evaluator: ModelEvaluator,
+        parameter_layout: ParameterLayout | None = None,
+        context: tuple = (),
+        pad_sample_dim: bool = False,
+    ) -> Any:
+        # Objects in context are captured by fun, so a cached function is only
+        # reused while they stay the same. Plain values are compared by value.
+        # With pad_sample_dim, the first dimension of the arguments after
+        # parameters and of the result indexes samples. Sample sizes can't
+        # be marked dynamic, since vmapped losses specialize on them.
+        sample_number: int | None = None
+        if pad_sample_dim:
+            sample_number = next(
+                arg.shape[0] for arg in args if isinstance(arg, torch.Tensor)
+            )
+            args = pad_first_dim(args, 1 << (sample_number - 1).bit_length())
+        context_key = tuple(
+            obj if isinstance(obj, str | int | float | tuple) else id(obj)
+            for obj in (model_evaluator, parameter_layout, *context)
+        )
+        args = (parameters, *args)
+        signature = get_tensor_signature(args)
+        key = (name, context_key, signature)
+        with self.__lock:
+            compiled_fun = self.__functions.get(key)
+            if compiled_fun is None:
+                padding_info = (
+                    " with sample numbers padded to powers of two"
+                    if pad_sample_dim
+                    else ""
+                )
+                if any(k[:2] == key[:2] for k in self.__functions):
+                    log_warning(
+                        "recompile %s for arguments %s%s", name, signature, padding_info
+                    )
+                else:
+                    log_info(
+                        "compile %s for arguments %s%s", name, signature, padding_info
+                    )
+                compiled_fun = torch.compile(
+                    functools.partial(
+                        reload_parameters,
+                        fun=fun,
+                        model_evaluator=model_evaluator,
+                        parameter_layout=parameter_layout,
+                    ),
+                    **self.__compile_kwargs,
+                )
+                self.__functions[key] = compiled_fun
+        result = compiled_fun(*args)
+        if sample_number is not None:
+            result = truncate_first_dim(result, sample_number)
+        return result
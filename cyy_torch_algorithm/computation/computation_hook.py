@@ -1,8 +1,9 @@
+import contextlib
 import copy
 import functools
 import os
 import threading
-from collections.abc import Callable
+from collections.abc import Callable, Generator
 from typing import Any
 
 import torch
@@ -10,24 +11,50 @@ from cyy_naive_lib.log import log_debug
 from cyy_naive_lib.time_counter import TimeCounter
 from cyy_torch_toolbox import Hook, ModelEvaluator, TorchProcessTaskQueue, tensor_to
 
+from .compile_cache import CompiledFunctionCache
+from .flat_parameter import ParameterLayout
+from .inline_task_queue import InlineTaskQueue
+from .result_arena import SharedResultArena
+from .stage_timer import StageTimer
+from .worker_pool import ComputationWorkerPool, PooledTaskQueue
+
 
 class ComputationHook(Hook):
     def __init__(self, **kwargs) -> None:
         super().__init__(stripable=True, **kwargs)
         self.__local_data = threading.local()
         self.__result_dict: dict = {}
-        self.__task_queue: TorchProcessTaskQueue | None = None
-        self.__model_queue: TorchProcessTaskQueue | None = None
+        self.__task_queue: (
+            TorchProcessTaskQueue | PooledTaskQueue | InlineTaskQueue | None
+        ) = None
+        self.__model_queue: TorchProcessTaskQueue | InlineTaskQueue | None = None
+        self.__use_worker_pool: bool = False
+        self.__executor_backend: str = "process"
+        self.__worker_num: int | None = None
+        self.__compile_cache: CompiledFunctionCache | None = None
         self._result_transform: Callable | None = None
         self.__pending_task_cnt: int = 0
+        self.__max_pending_task_cnt: int | None = None
         self.__prev_tasks: list = []
         self.__result_collection_fun: Callable | None = None
         self.__shared_models: dict = {}
+        self.__result_arena: SharedResultArena | None = None
+        self.__shared_parameters: list[torch.Tensor] = []
+        self.__parameter_buffer_number: int = 2
+        self.__parameter_key: tuple | None = None
+        self.__pending_tasks_by_batch: dict[int, int] = {}
+        self.__batch_parameter_versions: dict[int, int] = {}
+        self.__parameter_layout: ParameterLayout | None = None
+        self.__flat_parameters: bool = False
+        self.__parameter_version: int = 0
+        self.__timing: bool = False
+        self.__stage_timer: StageTimer | None = None
 
     def __getstate__(self):
         # capture what is normally pickled
         state = self.__dict__.copy()
         state["_ComputationHook__local_data"] = None
+        state["_ComputationHook__stage_timer"] = None
         return state
 
     def set_result_transform(self, f: Callable) -> None:
@@ -37,6 +64,148 @@ class ComputationHook(Hook):
     def set_result_collection_fun(self, f: Callable) -> None:
         self.__result_collection_fun = f
 
+    def set_max_pending_task_num(self, num: int) -> None:
+        # _add_task blocks on fetching results once this many tasks are in flight
+        assert num > 0
+        self.__max_pending_task_cnt = num
+
+    def set_executor_backend(self, backend: str) -> None:
+        # "process" runs workers in subprocesses, "thread" runs them in threads
+        # of this process, and "inline" computes each task in the calling
+        # thread when its result is fetched. In-process backends skip pickling
+        # and shared memory.
+        assert backend in ("process", "thread", "inline")
+        assert self.__task_queue is None
+        # The worker pool only runs worker processes.
+        assert backend == "process" or not self.__use_worker_pool
+        self.__executor_backend = backend
+
+    def set_worker_num(self, worker_num: int) -> None:
+        # Overrides the CUDA_DEVICE_NUM environment variable, and with the
+        # worker pool applies to the pool when it is not used by other hooks.
+        assert worker_num > 0
+        assert self.__task_queue is None
+        self.__worker_num = worker_num
+
+    def enable_compile(self, **compile_kwargs: Any) -> None:
+        # Worker functions supporting it run through torch.compile, and each
+        # worker caches the compiled functions by argument shapes and dtypes.
+        assert self.__task_queue is None
+        self.__compile_cache = CompiledFunctionCache(**compile_kwargs)
+
+    def _get_compile_cache(self) -> CompiledFunctionCache | None:
+        return self.__compile_cache
+
+    def enable_timing(
+        self, callback: Callable | None = None, window_size: int = 10000
+    ) -> None:
+        # Records the durations of the enqueue and fetch stages in this process
+        # and of the model_fetch, device_transfer, compute and result_transform
+        # stages in the workers, which return them with their results. The
+        # callback gets every sample as callback(stage=..., elapsed_ms=...).
+        # Fetching includes waiting for the workers, and with the inline
+        # backend it contains the worker stages.
+        assert self.__task_queue is None
+        self.__timing = True
+        self.__stage_timer = StageTimer(window_size=window_size, callback=callback)
+
+    @property
+    def timing_metrics(self) -> dict[str, dict[str, float]]:
+        # Counts, totals and percentiles in milliseconds of each stage
+        if self.__stage_timer is None:
+            return {}
+        return self.__stage_timer.get_metrics()
+
+    def reset_timing_metrics(self) -> None:
+        if self.__stage_timer is not None:
+            self.__stage_timer.clear()
+
+    def __time_stage(self, stage: str) -> contextlib.AbstractContextManager:
+        if self.__stage_timer is None:
+            return contextlib.nullcontext()
+        return self.__stage_timer.time(stage)
+
+    def _time_worker_stage(
+        self, stage: str, stream: torch.cuda.Stream | None = None
+    ) -> contextlib.AbstractContextManager:
+        if not self.__timing:
+            return contextlib.nullcontext()
+        stage_timer = getattr(self.__local_data, "stage_timer", None)
+        if stage_timer is None:
+            stage_timer = StageTimer(window_size=1, keep_new_samples=True)
+            self.__local_data.stage_timer = stage_timer
+        return stage_timer.time(stage, stream=stream)
+
+    def _get_worker_result(self, batch_size: int, res: Any) -> tuple:
+        stage_timer = getattr(self.__local_data, "stage_timer", None)
+        if stage_timer is None:
+            return batch_size, res
+        return batch_size, res, stage_timer.pop_new_samples()
+
+    def _split_worker_tasks(self, tasks: list, worker_fun: Callable, **kwargs) -> tuple:
+        # Workers may receive tasks of several batches, which use their own
+        # one-shot data and parameter versions, so the tasks of each batch are
+        # computed separately. Task counts by batch index tell the hook when
+        # the data of a batch is no longer used.
+        batch_size = 0
+        results: dict = {}
+        task_counts: dict[int, int] = {}
+        timing_samples: dict[str, list[float]] = {}
+        begin = 0
+        for end in range(1, len(tasks) + 1):
+            if end < len(tasks) and tasks[end][0] == tasks[begin][0]:
+                continue
+            res = worker_fun(tasks=tasks[begin:end], **kwargs)
+            batch_size += res[0]
+            results |= res[1]
+            task_counts[tasks[begin][0]] = (
+                task_counts.get(tasks[begin][0], 0) + end - begin
+            )
+            if len(res) > 2:
+                for stage, samples in res[2].items():
+                    timing_samples.setdefault(stage, []).extend(samples)
+            begin = end
+        return batch_size, results, task_counts, timing_samples
+
+    def set_parameter_buffer_number(self, buffer_number: int) -> None:
+        # Parameters of consecutive versions go round this many shared
+        # buffers, so workers can compute on older versions while the hook
+        # writes a new one. The hook only waits when the buffer it writes
+        # still holds a version with unfinished tasks.
+        assert buffer_number > 0
+        assert self.__task_queue is None
+        self.__parameter_buffer_number = buffer_number
+
+    def enable_worker_pool(self) -> None:
+        # Tasks run on the process-wide ComputationWorkerPool instead of
+        # workers spawned for this hook.
+        assert self.__task_queue is None
+        assert self.__executor_backend == "process"
+        self.__use_worker_pool = True
+
+    def enable_flat_parameters(self) -> None:
+        # Workers get the parameters as one flat tensor together with its
+        # parameter_layout, and parameter-shaped results become flat tensors.
+        assert self.__task_queue is None
+        self.__flat_parameters = True
+
+    @property
+    def use_flat_parameters(self) -> bool:
+        return self.__flat_parameters
+
+    def _set_result_arena_size(self, slot_number: int) -> None:
+        # Results are written by workers into a preallocated shared memory
+        # arena, and result_dict returns views that stay valid until reset_result.
+        # Hooks supporting it implement _get_result_arena_layout and assign
+        # the result slots of their tasks.
+        assert self.__task_queue is None
+        self.__result_arena = SharedResultArena(slot_number=slot_number)
+
+    def _get_result_arena_layout(
+        self, model_evaluator: ModelEvaluator
+    ) -> dict[str, torch.Size] | torch.Size:
+        raise NotImplementedError()
+
     def _get_worker_fun(self) -> Callable:
         raise NotImplementedError()
 
@@ -44,13 +213,25 @@ class ComputationHook(Hook):
         batch_index, need_model_evaluator = task
         res = self.__shared_models[batch_index]
         if need_model_evaluator:
-            res = res | {"model_evaluator": self.__shared_models[0]["model_evaluator"]}
+            res = res | {
+                k: v
+                for k, v in self.__shared_models[0].items()
+                if k
+                in (
+                    "model_evaluator",
+                    "result_arena",
+                    "shared_parameters",
+                    "parameter_layout",
+                )
+            }
         return res
 
     def reset_result(self) -> None:
         self._drop_result()
         del self.__result_dict
         self.__result_dict = {}
+        if self.__result_arena is not None:
+            self.__result_arena.clear_slots()
 
     @property
     def result_dict(self) -> dict:
@@ -62,45 +243,123 @@ class ComputationHook(Hook):
     def _drop_result(self) -> None:
         self.__fetch_result(drop=True)
 
+    def iter_results(self) -> Generator[tuple[Any, Any], None, None]:
+        # Arena slots of popped results are reused once the iteration goes
+        # on, so the views must be copied to be kept.
+        while self.__result_dict:
+            key = next(iter(self.__result_dict))
+            yield key, self.__result_dict.pop(key)
+            self.__free_result_slot(key)
+        while self.has_unfetched_result():
+            for key, result in self.__fetch_batch_result().items():
+                yield key, result
+                self.__free_result_slot(key)
+
+    def __free_result_slot(self, key: Any) -> None:
+        if self.__result_arena is not None:
+            self.__result_arena.free_slot(key)
+
+    def __fetch_batch_result(self, drop: bool = False) -> dict:
+        assert self.__task_queue is not None
+        with self.__time_stage("fetch"):
+            res = self.__task_queue.get_data()
+        assert res is not None
+        res = res[0]
+        if self.__stage_timer is not None:
+            self.__stage_timer.merge(res[3])
+        for batch_index, task_cnt in res[2].items():
+            self.__pending_tasks_by_batch[batch_index] -= task_cnt
+            if self.__pending_tasks_by_batch[batch_index] == 0:
+                self.__pending_tasks_by_batch.pop(batch_index)
+        self.__pending_task_cnt -= res[0]
+        assert self.__pending_task_cnt >= 0
+        # Workers receive tasks in FIFO order, so only the latest tasks may
+        # still be unreceived and need to be kept alive.
+        if self.__pending_task_cnt == 0:
+            self.__prev_tasks = []
+        else:
+            self.__prev_tasks = self.__prev_tasks[-self.__pending_task_cnt :]
+        if drop:
+            return {}
+        results: dict = res[1]
+        if self.__result_arena is not None:
+            results = self.__get_arena_views(results)
+        return results
+
+    def __collect_result(self, results: dict) -> None:
+        if self.__result_collection_fun is not None:
+            self.__result_collection_fun(results)
+        else:
+            self.__result_dict |= results
+
     def __fetch_result(self, drop: bool = False) -> dict:
-        results: dict = {}
         assert self.__pending_task_cnt >= 0
         while self.has_unfetched_result():
-            assert self.__task_queue is not None
-            res = self.__task_queue.get_data()
-            assert res is not None
-            res = res[0]
-            self.__pending_task_cnt -= res[0]
-            assert self.__pending_task_cnt >= 0
+            results = self.__fetch_batch_result(drop=drop)
             if not drop:
-                if self.__result_collection_fun is not None:
-                    self.__result_collection_fun(res[1])
-                else:
-                    results |= res[1]
-            else:
-                del res
-        self.__prev_tasks = []
-        self.__result_dict |= results
+                self.__collect_result(results)
         return self.__result_dict
 
-    def _get_task_queue(self) -> TorchProcessTaskQueue:
+    def __get_arena_views(self, results: dict) -> dict:
+        assert self.__result_arena is not None
+        for k, v in results.items():
+            if isinstance(v, int) and self.__result_arena.get_slot(k) == v:
+                results[k] = self.__result_arena.get_views(v)
+        return results
+
+    def _assign_result_slots(self, keys: list) -> dict:
+        if self.__result_arena is None or self._result_transform is not None:
+            return {}
+        return {"result_slots": self.__result_arena.assign_slots(keys)}
+
+    def _store_result_in_arena(self, results: dict) -> dict:
+        result_slots: dict = getattr(self.__local_data, "result_slots", {})
+        if not result_slots:
+            return results
+        result_arena: SharedResultArena = self.__local_data.result_arena
+        for k, slot in result_slots.items():
+            if k in results:
+                result_arena.write(slot, results[k])
+                results[k] = slot
+        return results
+
+    def _get_task_queue(
+        self,
+    ) -> TorchProcessTaskQueue | PooledTaskQueue | InlineTaskQueue:
+        if self.__task_queue is None and self.__use_worker_pool:
+            self.__task_queue = ComputationWorkerPool.get(
+                worker_num=self.__worker_num
+            ).bind(worker_fun=self.__get_split_worker_fun())
+        if self.__task_queue is None and self.__executor_backend == "inline":
+            self.__task_queue = InlineTaskQueue(batch_process=True)
+            self.__task_queue.start(worker_fun=self.__get_split_worker_fun())
         if self.__task_queue is None:
-            worker_num: int | None | str = os.getenv("CUDA_DEVICE_NUM", None)
-            if worker_num is not None:
-                worker_num = int(worker_num)
+            worker_num: int | None | str = self.__worker_num
+            if worker_num is None:
+                worker_num = os.getenv("CUDA_DEVICE_NUM", None)
+                if worker_num is not None:
+                    worker_num = int(worker_num)
             self.__task_queue = TorchProcessTaskQueue(
                 worker_num=worker_num,
                 batch_process=True,
             )
             self.__task_queue.start(
-                worker_fun=functools.partial(
-                    self._get_worker_fun(),
-                    model_queue=self.__get_model_queue(),
-                )
+                worker_fun=self.__get_split_worker_fun(),
+                use_thread=self.__executor_backend == "thread",
             )
         return self.__task_queue
 
-    def __get_model_queue(self) -> TorchProcessTaskQueue:
+    def __get_split_worker_fun(self) -> Callable:
+        return functools.partial(
+            self._split_worker_tasks,
+            worker_fun=self._get_worker_fun(),
+            model_queue=self.__get_model_queue(),
+        )
+
+    def __get_model_queue(self) -> TorchProcessTaskQueue | InlineTaskQueue:
+        if self.__model_queue is None and self.__executor_backend == "inline":
+            self.__model_queue = InlineTaskQueue()
+            self.__model_queue.start(worker_fun=self._model_worker_fun)
         if self.__model_queue is None:
             self.__model_queue = TorchProcessTaskQueue(
                 worker_num=1,
@@ -109,18 +368,28 @@ class ComputationHook(Hook):
         return self.__model_queue
 
     def _add_task(self, task: Any) -> None:
+        if self.__max_pending_task_cnt is not None:
+            while self.__pending_task_cnt >= self.__max_pending_task_cnt:
+                self.__collect_result(self.__fetch_batch_result())
         self.__prev_tasks.append(task)
         self.__pending_task_cnt += 1
-        self._get_task_queue().add_task(task)
+        batch_index: int = task[0]
+        self.__pending_tasks_by_batch[batch_index] = (
+            self.__pending_tasks_by_batch.get(batch_index, 0) + 1
+        )
+        task_queue = self._get_task_queue()
+        with self.__time_stage("enqueue"):
+            task_queue.add_task(task)
 
     def _broadcast_one_shot_data(
         self, batch_index: int, model_evaluator: ModelEvaluator, **kwargs
     ) -> None:
         with TimeCounter() as cnt:
-            if self.__shared_models:
-                old_model_evaluator = self.__shared_models[0]
-                self.__shared_models.clear()
-                self.__shared_models[0] = old_model_evaluator
+            # Batches with unfinished tasks may still be fetched by workers.
+            for k in list(self.__shared_models):
+                if k != 0 and k not in self.__pending_tasks_by_batch:
+                    self.__shared_models.pop(k)
+                    self.__batch_parameter_versions.pop(k, None)
             assert batch_index >= 0
             data: dict = dict(kwargs)
             if batch_index == 0:
@@ -128,18 +397,64 @@ class ComputationHook(Hook):
                 data["model_evaluator"].model.cpu()
                 data["model_evaluator"].model.zero_grad(set_to_none=True)
                 data["model_evaluator"].model.requires_grad_(False)
-                data["model_evaluator"].model.share_memory()
-            else:
-                data["parameters"] = model_evaluator.model_util.get_parameters(
-                    detach=True
-                )
-                for v in data["parameters"].values():
-                    v.grad = None
-                    v.requires_grad_(False)
-                    v.share_memory_()
+                if self.__executor_backend == "process":
+                    data["model_evaluator"].model.share_memory()
+                if self.__result_arena is not None:
+                    if not self.__result_arena.allocated:
+                        self.__result_arena.allocate(
+                            layout=self._get_result_arena_layout(model_evaluator),
+                            dtype=next(model_evaluator.model.parameters()).dtype,
+                        )
+                    data["result_arena"] = self.__result_arena
+            self.__update_shared_parameters(model_evaluator)
+            if batch_index == 0:
+                data["shared_parameters"] = self.__shared_parameters
+                data["parameter_layout"] = self.__parameter_layout
+            data["parameter_version"] = self.__parameter_version
+            self.__batch_parameter_versions[batch_index] = self.__parameter_version
             self.__shared_models[batch_index] = data
             log_debug("_broadcast_one_shot_data use %s", cnt.elapsed_milliseconds())
 
+    def __update_shared_parameters(self, model_evaluator: ModelEvaluator) -> None:
+        # Parameters live in a ring of persistent flat shared buffers. A new
+        # version is only written when the data pointers or version counters
+        # of the parameters changed, which in-place updates such as optimizer
+        # steps and load_state_dict bump.
+        parameters = model_evaluator.model_util.get_parameters(detach=True)
+        if self.__parameter_layout is None:
+            self.__parameter_layout = ParameterLayout(parameters)
+        parameter_key = tuple(
+            (parameters[name].data_ptr(), parameters[name]._version)
+            for name in self.__parameter_layout.names
+        )
+        if parameter_key == self.__parameter_key:
+            return
+        self.__parameter_key = parameter_key
+        if not self.__shared_parameters:
+            for _ in range(self.__parameter_buffer_number):
+                buffer = torch.empty(
+                    self.__parameter_layout.numel, dtype=self.__parameter_layout.dtype
+                )
+                if self.__executor_backend == "process":
+                    buffer.share_memory_()
+                self.__shared_parameters.append(buffer)
+        else:
+            self.__parameter_version += 1
+        # Workers may still read the version previously in this buffer.
+        old_version = self.__parameter_version - self.__parameter_buffer_number
+        while any(
+            self.__batch_parameter_versions[k] <= old_version
+            for k in self.__pending_tasks_by_batch
+        ):
+            self.__collect_result(self.__fetch_batch_result())
+        with torch.no_grad():
+            self.__parameter_layout.flatten_into(
+                parameters,
+                self.__shared_parameters[
+                    self.__parameter_version % self.__parameter_buffer_number
+                ],
+            )
+
     def _before_execute(self, **_) -> None:
         self.reset()
 
@@ -156,6 +471,15 @@ class ComputationHook(Hook):
             self.__model_queue.release()
             self.__model_queue = None
         self.__shared_models.clear()
+        # In-process workers keep their cached data in this thread-local.
+        self.__local_data = threading.local()
+        self.__shared_parameters = []
+        self.__parameter_key = None
+        self.__pending_tasks_by_batch.clear()
+        self.__batch_parameter_versions.clear()
+        self.__parameter_layout = None
+        if self.__result_arena is not None:
+            self.__result_arena.release()
 
     def _setup_device(self, advised_device) -> tuple:
         worker_device = self.get_cached_item("worker_device", advised_device)
@@ -199,26 +523,45 @@ class ComputationHook(Hook):
             and self.__local_data.batch_index == batch_index
         ):
             return data
-        model_queue.add_task((batch_index, "model_evaluator" not in data))
-        tmp_data = model_queue.get_data()
+        with self._time_worker_stage("model_fetch"):
+            model_queue.add_task((batch_index, "model_evaluator" not in data))
+            tmp_data = model_queue.get_data()
         assert tmp_data is not None
-        new_data: dict = tmp_data[0]
+        new_data: dict = dict(tmp_data[0])
 
         self.__local_data.batch_index = batch_index
-        if "model_evaluator" in new_data:
-            new_data["model_evaluator"] = copy.deepcopy(new_data["model_evaluator"])
-            new_data["model_evaluator"].model_util.to_device(
-                device=worker_device, non_blocking=True
-            )
-        if "parameters" in new_data:
-            new_data["parameters"] = tensor_to(
-                new_data["parameters"], device=worker_device, non_blocking=True
-            )
-        else:
-            new_data["parameters"] = new_data[
-                "model_evaluator"
-            ].model_util.get_parameters(detach=False)
-        new_data = tensor_to(new_data, device=worker_device, non_blocking=True)
+        if "result_arena" in new_data:
+            self.__local_data.result_arena = new_data.pop("result_arena")
+        self.__local_data.result_slots = new_data.pop("result_slots", {})
+        if "shared_parameters" in new_data:
+            self.__local_data.shared_parameters = new_data.pop("shared_parameters")
+            self.__local_data.parameter_layout = new_data.pop("parameter_layout")
+        parameter_version: int = new_data.pop("parameter_version")
+        with self._time_worker_stage("device_transfer"):
+            if "model_evaluator" in new_data:
+                new_data["model_evaluator"] = copy.deepcopy(new_data["model_evaluator"])
+                new_data["model_evaluator"].model_util.to_device(
+                    device=worker_device, non_blocking=True
+                )
+            if (
+                "parameters" not in data
+                or getattr(self.__local_data, "parameter_version", None)
+                != parameter_version
+            ):
+                # A single copy of the flat buffer, split into views on the device
+                shared_parameters = self.__local_data.shared_parameters
+                parameters = shared_parameters[
+                    parameter_version % len(shared_parameters)
+                ].to(device=worker_device, non_blocking=True)
+                if self.__flat_parameters:
+                    new_data["parameters"] = parameters
+                    new_data["parameter_layout"] = self.__local_data.parameter_layout
+                else:
+                    new_data["parameters"] = (
+                        self.__local_data.parameter_layout.unflatten(parameters)
+                    )
+                self.__local_data.parameter_version = parameter_version
+            new_data = tensor_to(new_data, device=worker_device, non_blocking=True)
         data.update(new_data)
 
         self.__local_data.data = data
@@ -1,12 +1,17 @@
 import torch
 from cyy_torch_toolbox import EvaluationMode, ModelEvaluator, ModelParameter
 
+from .flat_parameter import ParameterLayout
+
 
 def eval_model(
-    parameters: ModelParameter,
+    parameters: ModelParameter | torch.Tensor,
     model_evaluator: ModelEvaluator,
+    parameter_layout: ParameterLayout | None = None,
     **kwargs,
 ) -> torch.Tensor:
+    if parameter_layout is not None:
+        parameters = parameter_layout.unflatten(parameters)
     model_evaluator.model_util.load_buffers(parameters)
     kwargs |= {
         "evaluation_mode": EvaluationMode.SampleInference,
@@ -21,3 +26,16 @@ def eval_model(
             kwargs["inputs"] = input_tensors[0]
 
     return model_evaluator(**kwargs)["loss"]
+
+
+def get_perturbed_input_list(
+    inputs: torch.Tensor | dict[str, torch.Tensor],
+) -> tuple[list[str], list[torch.Tensor]]:
+    # Mask inputs are kept constant, and the only other input is the last one.
+    if not isinstance(inputs, dict):
+        return [], [inputs]
+    input_keys = [k for k in inputs if "mask" in k]
+    other_keys = [k for k in inputs if "mask" not in k]
+    assert len(other_keys) == 1
+    input_keys += other_keys
+    return input_keys, [inputs[k] for k in input_keys]
@@ -0,0 +1,65 @@
+import functools
+
+import torch
+from cyy_naive_lib.algorithm.mapping_op import get_mapping_items_by_key_order
+from cyy_torch_toolbox import TensorDict
+
+
+class ParameterLayout:
+    # Names, shapes and dtypes of tensors packed into one flat tensor, in the
+    # same key order as cat_tensor_dict. Tensors of mixed dtypes are promoted
+    # in the flat tensor and cast back by unflatten.
+    def __init__(self, tensor_dict: TensorDict) -> None:
+        self.names: list[str] = []
+        self.shapes: list[torch.Size] = []
+        self.dtypes: list[torch.dtype] = []
+        for name, tensor in get_mapping_items_by_key_order(tensor_dict):
+            self.names.append(name)
+            self.shapes.append(tensor.shape)
+            self.dtypes.append(tensor.dtype)
+        self.numels: list[int] = [shape.numel() for shape in self.shapes]
+        self.dtype: torch.dtype = functools.reduce(torch.promote_types, self.dtypes)
+
+    @property
+    def numel(self) -> int:
+        return sum(self.numels)
+
+    @property
+    def mixed_dtypes(self) -> bool:
+        return any(dtype != self.dtype for dtype in self.dtypes)
+
+    def flatten(self, tensor_dict: TensorDict) -> torch.Tensor:
+        # Leading dimensions in front of the parameter shapes are kept.
+        first = tensor_dict[self.names[0]]
+        batch_shape = first.shape[: first.dim() - len(self.shapes[0])]
+        return torch.cat(
+            [tensor_dict[name].reshape(*batch_shape, -1) for name in self.names],
+            dim=-1,
+        )
+
+    def flatten_into(self, tensor_dict: TensorDict, flat_tensor: torch.Tensor) -> None:
+        # Copies the tensors into flat_tensor without a temporary flat tensor.
+        for name, part in zip(
+            self.names, flat_tensor.split(self.numels, dim=-1), strict=True
+        ):
+            part.copy_(tensor_dict[name].reshape(part.shape))
+
+    def unflatten(self, flat_tensor: torch.Tensor) -> TensorDict:
+        # Returns views, so writes go to flat_tensor, unless the dtypes are
+        # mixed and the tensors are cast back.
+        batch_shape = flat_tensor.shape[:-1]
+        res = {
+            name: tensor.view((*batch_shape, *shape))
+            for name, shape, tensor in zip(
+                self.names,
+                self.shapes,
+                flat_tensor.split(self.numels, dim=-1),
+                strict=True,
+            )
+        }
+        if self.mixed_dtypes:
+            res = {
+                name: tensor.to(dtype=dtype)
+                for (name, tensor), dtype in zip(res.items(), self.dtypes, strict=True)
+            }
+        return res
@@ -0,0 +1,35 @@
+import collections
+from collections.abc import Callable
+from typing import Any
+
+import torch
+
+
+class InlineTaskQueue:
+    # A task queue running the worker fun in the calling thread. Tasks are
+    # computed lazily in FIFO order when their results are fetched, so
+    # nothing is pickled or copied between processes.
+    def __init__(self, batch_process: bool = False) -> None:
+        self.__batch_process = batch_process
+        self.__worker_fun: Callable | None = None
+        self.__tasks: collections.deque = collections.deque()
+        self.__device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    def start(self, worker_fun: Callable) -> None:
+        self.__worker_fun = worker_fun
+
+    def add_task(self, task: Any) -> None:
+        self.__tasks.append(task)
+
+    def get_data(self) -> list | None:
+        if not self.__tasks:
+            return None
+        assert self.__worker_fun is not None
+        task = self.__tasks.popleft()
+        if self.__batch_process:
+            return [self.__worker_fun(tasks=[task], device=self.__device)]
+        return [self.__worker_fun(task, device=self.__device)]
+
+    def release(self) -> None:
+        self.__tasks.clear()
+        self.__worker_fun = None
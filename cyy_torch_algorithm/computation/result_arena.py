@@ -0,0 +1,108 @@
+from collections.abc import Iterable
+from typing import Any
+
+import torch
+from cyy_naive_lib.log import log_info, log_warning
+
+
+class SharedResultArena:
+    def __init__(self, slot_number: int) -> None:
+        assert slot_number > 0
+        self.__slot_number = slot_number
+        self.__tensor: torch.Tensor | None = None
+        self.__layout: dict[str, torch.Size] | torch.Size = {}
+        self.__slots: dict[Any, int] = {}
+        self.__free_slots: list[int] = list(reversed(range(slot_number)))
+        self.__warned_full: bool = False
+
+    def __getstate__(self) -> dict:
+        # workers only need the buffer and the layout
+        state = self.__dict__.copy()
+        state["_SharedResultArena__slots"] = {}
+        state["_SharedResultArena__free_slots"] = []
+        return state
+
+    @property
+    def allocated(self) -> bool:
+        return self.__tensor is not None
+
+    def allocate(
+        self, layout: dict[str, torch.Size] | torch.Size, dtype: torch.dtype
+    ) -> None:
+        # A plain shape means the results are tensors instead of tensor dicts.
+        if isinstance(layout, torch.Size):
+            self.__layout = layout
+            element_number = layout.numel()
+        else:
+            self.__layout = dict(layout)
+            element_number = sum(shape.numel() for shape in self.__layout.values())
+        self.__tensor = torch.empty(
+            (self.__slot_number, element_number), dtype=dtype
+        ).share_memory_()
+        log_info(
+            "allocate result arena with %s slots and %s elements per slot",
+            self.__slot_number,
+            element_number,
+        )
+
+    def release(self) -> None:
+        self.__tensor = None
+        self.__layout = {}
+        self.clear_slots()
+
+    def clear_slots(self) -> None:
+        self.__slots.clear()
+        self.__free_slots = list(reversed(range(self.__slot_number)))
+        self.__warned_full = False
+
+    def assign_slots(self, keys: Iterable) -> dict[Any, int]:
+        # Keys without a free slot get no slot, and their results are pickled.
+        slots: dict[Any, int] = {}
+        overflow_number = 0
+        for key in keys:
+            slot = self.__slots.get(key)
+            if slot is None:
+                if not self.__free_slots:
+                    overflow_number += 1
+                    continue
+                slot = self.__free_slots.pop()
+                self.__slots[key] = slot
+            slots[key] = slot
+        if overflow_number and not self.__warned_full:
+            log_warning(
+                "result arena is full with %s slots, results of %s keys are pickled",
+                self.__slot_number,
+                overflow_number,
+            )
+            self.__warned_full = True
+        return slots
+
+    def free_slot(self, key: Any) -> None:
+        slot = self.__slots.pop(key, None)
+        if slot is not None:
+            self.__free_slots.append(slot)
+            self.__warned_full = False
+
+    def get_slot(self, key: Any) -> int | None:
+        return self.__slots.get(key)
+
+    def get_views(self, slot: int) -> dict[str, torch.Tensor] | torch.Tensor:
+        assert self.__tensor is not None
+        row = self.__tensor[slot]
+        if isinstance(self.__layout, torch.Size):
+            return row.view(self.__layout)
+        views: dict[str, torch.Tensor] = {}
+        offset = 0
+        for name, shape in self.__layout.items():
+            numel = shape.numel()
+            views[name] = row[offset : offset + numel].view(shape)
+            offset += numel
+        return views
+
+    def write(self, slot: int, result: dict[str, torch.Tensor] | torch.Tensor) -> None:
+        views = self.get_views(slot)
+        if isinstance(views, torch.Tensor):
+            views.copy_(result)
+            return
+        for name, view in views.items():
+            view.copy_(result[name])
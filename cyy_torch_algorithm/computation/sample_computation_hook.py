@@ -1,5 +1,6 @@
 import functools
 from collections.abc import Callable
+from typing import Any
 
 import torch
 from cyy_torch_toolbox import (
@@ -15,24 +16,34 @@ from .computation_hook import ComputationHook
 
 class SampleComputationHook(ComputationHook):
     __sample_selector: Callable | None = None
+    __batch_sample_selector: Callable | None = None
     __input_transform: Callable | None = None
     __batch_index: int = 0
 
     def __getstate__(self) -> dict:
         state = super().__getstate__()
         state["_SampleComputationHook__sample_selector"] = None
+        state["_SampleComputationHook__batch_sample_selector"] = None
         return state
 
     def set_sample_selector(self, selector: Callable) -> None:
         self.__sample_selector = selector
+        self.__batch_sample_selector = None
+
+    def set_batch_sample_selector(self, selector: Callable) -> None:
+        # The selector returns a boolean mask over sample_indices.
+        self.__batch_sample_selector = selector
+        self.__sample_selector = None
 
     def set_input_transform(self, transform: Callable) -> None:
         self.__input_transform = transform
 
     def set_computed_indices(self, indices: IndicesType) -> None:
-        index_set = set(indices)
-        self.set_sample_selector(
-            lambda sample_index, **kwargs: sample_index in index_set
+        index_tensor = torch.tensor(sorted(set(indices)), dtype=torch.long)
+        self.set_batch_sample_selector(
+            lambda sample_indices, **kwargs: torch.isin(
+                sample_indices, index_tensor.to(device=sample_indices.device)
+            )
         )
 
     def add_task(
@@ -47,6 +58,15 @@ class SampleComputationHook(ComputationHook):
         )
         inputs = res["inputs"]
         batch_dim = res["batch_dim"]
+        if self.__input_transform is None and isinstance(inputs, torch.Tensor):
+            self.__add_batch_task(
+                model_evaluator=model_evaluator,
+                sample_indices=sample_indices,
+                inputs=inputs,
+                targets=targets,
+                batch_dim=batch_dim,
+            )
+            return
 
         processed_indices = []
         processed_inputs = []
@@ -59,6 +79,13 @@ class SampleComputationHook(ComputationHook):
                 sample_index=sample_index, sample_input=sample_input
             ):
                 continue
+            if self.__batch_sample_selector is not None and not bool(
+                self.__batch_sample_selector(
+                    sample_indices=torch.tensor([sample_index]),
+                    inputs=sample_input,
+                )[0]
+            ):
+                continue
             if isinstance(sample_input, torch.Tensor):
                 sample_input = sample_input.unsqueeze(batch_dim)
             sample_target = sample_target.unsqueeze(0)
@@ -91,6 +118,7 @@ class SampleComputationHook(ComputationHook):
         self._broadcast_one_shot_data(
             batch_index=self.__batch_index,
             model_evaluator=model_evaluator,
+            **self._assign_result_slots(processed_indices),
         )
         for item in zip(
             processed_indices, processed_inputs, processed_targets, strict=False
@@ -100,6 +128,59 @@ class SampleComputationHook(ComputationHook):
             )
         self.__batch_index += 1
 
+    def __add_batch_task(
+        self,
+        model_evaluator: ModelEvaluator,
+        sample_indices: torch.Tensor,
+        inputs: torch.Tensor,
+        targets: torch.Tensor,
+        batch_dim: int,
+    ) -> None:
+        if self.__sample_selector is not None:
+            mask = torch.tensor(
+                [
+                    bool(
+                        self.__sample_selector(
+                            sample_index=sample_index, sample_input=sample_input
+                        )
+                    )
+                    for sample_index, sample_input in zip(
+                        sample_indices.tolist(), inputs, strict=False
+                    )
+                ],
+                dtype=torch.bool,
+            )
+        elif self.__batch_sample_selector is not None:
+            mask = self.__batch_sample_selector(
+                sample_indices=sample_indices, inputs=inputs
+            )
+        else:
+            mask = torch.ones(sample_indices.shape[0], dtype=torch.bool)
+        selected_rows = mask.nonzero().view(-1).cpu()
+        if selected_rows.numel() == 0:
+            return
+        processed_indices: list[int] = sample_indices.cpu()[selected_rows].tolist()
+        self._broadcast_one_shot_data(
+            batch_index=self.__batch_index,
+            model_evaluator=model_evaluator,
+            **self._assign_result_slots(processed_indices),
+        )
+        # Each selected sample keeps its own batch dimension, so that the
+        # chunk has the same layout as stacked single-sample inputs.
+        self._add_task(
+            task=(
+                self.__batch_index,
+                processed_indices,
+                inputs.index_select(0, selected_rows.to(device=inputs.device))
+                .unsqueeze(batch_dim + 1)
+                .contiguous(),
+                targets.index_select(0, selected_rows.to(device=targets.device))
+                .unsqueeze(1)
+                .contiguous(),
+            ),
+        )
+        self.__batch_index += 1
+
     def _get_sample_computation_fun(self):
         raise NotImplementedError()
 
@@ -141,52 +222,79 @@ class SampleComputationHook(ComputationHook):
         )
 
         with torch.cuda.stream(worker_stream):
-            tasks = tensor_to(
-                tasks, device=worker_device, non_blocking=True, check_slowdown=False
-            )
+            with self._time_worker_stage("device_transfer", stream=worker_stream):
+                tasks = tensor_to(
+                    tasks,
+                    device=worker_device,
+                    non_blocking=True,
+                    check_slowdown=False,
+                )
             batch_index: int = tasks[0][0]
             batch_size: int = len(tasks)
-            sample_indices: list[int] = [task[1] for task in tasks]
-            inputs: list = [task[2] for task in tasks]
-            targets: list = [task[3] for task in tasks]
             model_data: dict = self.get_cached_one_shot_data(
                 batch_index=batch_index,
                 worker_device=worker_device,
                 model_queue=model_queue,
             )
-            forward_fun: str | None = None
-            input_features: list = [
-                model_data["model_evaluator"].get_input_feature(input_element)
-                for input_element in inputs
-            ]
-            if input_features[0] is not None:
-                inputs = input_features
-                forward_fun = model_data["model_evaluator"].get_feature_forward_fun()
-                model_data["model_evaluator"].set_forward_fun(forward_fun)
+            model_evaluator = model_data["model_evaluator"]
+            sample_indices: list[int] = []
+            inputs: Any
+            targets: torch.Tensor
+            if isinstance(tasks[0][1], list):
+                # batch tasks already hold stacked samples
+                for task in tasks:
+                    sample_indices += task[1]
+                if len(tasks) == 1:
+                    inputs = tasks[0][2]
+                    targets = tasks[0][3]
+                else:
+                    inputs = torch.cat([task[2] for task in tasks])
+                    targets = torch.cat([task[3] for task in tasks])
+                input_feature = model_evaluator.get_input_feature(inputs)
+                if input_feature is not None:
+                    inputs = input_feature
+                    model_evaluator.set_forward_fun(
+                        model_evaluator.get_feature_forward_fun()
+                    )
+            else:
+                sample_indices = [task[1] for task in tasks]
+                input_list: list = [task[2] for task in tasks]
+                input_features: list = [
+                    model_evaluator.get_input_feature(input_element)
+                    for input_element in input_list
+                ]
+                if input_features[0] is not None:
+                    input_list = input_features
+                    model_evaluator.set_forward_fun(
+                        model_evaluator.get_feature_forward_fun()
+                    )
+                inputs = self.__stack_inputs(input_list)
+                targets = torch.stack([task[3] for task in tasks])
 
             worker_fun = self.get_cached_item(
                 "worker_fun", worker_fun, worker_device=worker_device
             )
-            res = worker_fun(
-                sample_indices=sample_indices,
-                inputs=inputs,
-                targets=targets,
-                worker_device=worker_device,
-                **model_data,
-            )
+            with self._time_worker_stage("compute", stream=worker_stream):
+                res = worker_fun(
+                    sample_indices=sample_indices,
+                    inputs=inputs,
+                    targets=targets,
+                    worker_device=worker_device,
+                    **model_data,
+                )
             result_transform = self.get_cached_item(
                 "result_transform", self._result_transform, worker_device=worker_device
             )
             if result_transform is not None:
-                for sample_index, input_tensor, target in zip(
-                    sample_indices, inputs, targets, strict=False
-                ):
-                    res[sample_index] = result_transform(
-                        sample_index=sample_index,
-                        result=res[sample_index],
-                        input_tensor=input_tensor,
-                        target=target,
-                    )
+                with self._time_worker_stage("result_transform", stream=worker_stream):
+                    for idx, sample_index in enumerate(sample_indices):
+                        res[sample_index] = result_transform(
+                            sample_index=sample_index,
+                            result=res[sample_index],
+                            input_tensor=self.__get_sample_input(inputs, idx),
+                            target=targets[idx],
+                        )
+            res = self._store_result_in_arena(res)
 
         def result_transform2(tensor, **kwargs):
             if tensor.numel() == 1:
@@ -194,4 +302,16 @@ class SampleComputationHook(ComputationHook):
             return tensor
 
         res = recursive_tensor_op(res, result_transform2)
-        return batch_size, res
+        return self._get_worker_result(batch_size, res)
+
+    @classmethod
+    def __stack_inputs(cls, inputs: list) -> torch.Tensor | dict:
+        if isinstance(inputs[0], dict):
+            return {k: torch.stack([a[k] for a in inputs]) for k in inputs[0]}
+        return torch.stack(inputs)
+
+    @classmethod
+    def __get_sample_input(cls, inputs: Any, idx: int) -> Any:
+        if isinstance(inputs, dict):
+            return {k: v[idx] for k, v in inputs.items()}
+        return inputs[idx]
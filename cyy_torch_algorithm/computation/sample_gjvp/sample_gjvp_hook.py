@@ -6,38 +6,72 @@ import torch.cuda
 from cyy_torch_toolbox import ModelParameter, cat_tensor_dict
 from torch.func import grad, jvp, vmap
 
-from ..evaluation import eval_model
+from ..compile_cache import CompiledFunctionCache
+from ..evaluation import eval_model, get_perturbed_input_list
+from ..flat_parameter import ParameterLayout
 from ..sample_computation_hook import SampleComputationHook
 
 
 def sample_gjvp_worker_fun(
-    vector,
+    vector: torch.Tensor,
     model_evaluator,
-    parameters: ModelParameter,
+    parameters: ModelParameter | torch.Tensor,
     sample_indices,
-    inputs: list[torch.Tensor],
-    targets: list[torch.Tensor],
+    inputs: torch.Tensor | dict[str, torch.Tensor],
+    targets: torch.Tensor,
     worker_device,
+    parameter_layout: ParameterLayout | None = None,
+    batched_vector: bool = False,
+    compile_cache: CompiledFunctionCache | None = None,
 ) -> dict:
-    def jvp_wrapper(parameters, input_tensor, target):
+    input_keys, input_list = get_perturbed_input_list(inputs)
+
+    def jvp_wrapper(parameters, target, *input_tensors):
         f = functools.partial(
             eval_model,
-            inputs=input_tensor,
             targets=target,
             device=worker_device,
             model_evaluator=model_evaluator,
+            input_keys=input_keys,
+            parameter_layout=parameter_layout,
         )
 
         def grad_f(input_tensor):
-            return cat_tensor_dict(grad(f, argnums=0)(parameters))
+            gradient = grad(f, argnums=0)(
+                parameters, input_tensors=list(input_tensors[0:-1]) + [input_tensor]
+            )
+            if parameter_layout is not None:
+                return gradient
+            return cat_tensor_dict(gradient)
+
+        def product(tangent):
+            return jvp(
+                grad_f,
+                (input_tensors[-1],),
+                (tangent.reshape(input_tensors[-1].shape),),
+            )[1]
 
-        return jvp(grad_f, (input_tensor,), (vector,))[1]
+        if batched_vector:
+            # The rows of vector are tangents, sharing the samples of the batch.
+            return vmap(product, randomness="same")(vector)
+        return product(vector)
 
-    products = vmap(jvp_wrapper, in_dims=(None, 0, 0), randomness="same")(
-        parameters,
-        torch.stack(inputs),
-        torch.stack(targets),
+    vmap_fun: Callable = vmap(
+        jvp_wrapper,
+        in_dims=tuple([None] + [0] * (len(input_list) + 1)),
+        randomness="same",
     )
+    if compile_cache is not None:
+        vmap_fun = functools.partial(
+            compile_cache.run,
+            "sample_gjvp",
+            vmap_fun,
+            model_evaluator=model_evaluator,
+            parameter_layout=parameter_layout,
+            context=(vector, tuple(input_keys), batched_vector),
+            pad_sample_dim=True,
+        )
+    products = vmap_fun(parameters, targets, *input_list)
     return dict(zip(sample_indices, products, strict=False))
 
 
@@ -45,9 +79,23 @@ class SampleGradientJVPHook(SampleComputationHook):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.__vector = None
+        self.__batched_vector = False
 
     def set_vector(self, vector):
         self.__vector = vector
+        self.__batched_vector = False
+
+    def set_vectors(self, vectors: torch.Tensor | list[torch.Tensor]) -> None:
+        # Each sample gets the products with all vectors, stacked in order.
+        if isinstance(vectors, list):
+            vectors = torch.stack(vectors)
+        self.__vector = vectors
+        self.__batched_vector = True
 
     def _get_sample_computation_fun(self) -> Callable:
-        return functools.partial(sample_gjvp_worker_fun, self.__vector)
+        return functools.partial(
+            sample_gjvp_worker_fun,
+            self.__vector,
+            batched_vector=self.__batched_vector,
+            compile_cache=self._get_compile_cache(),
+        )
@@ -1,13 +1,27 @@
+from .random_projection import RandomProjector
 from .sample_gradient_hook import (
     SampleGradientHook,
+    get_sample_gradient_dict,
+    get_sample_gradient_sketches,
     get_sample_gradients,
     get_sample_gvps,
     get_self_gvps,
+    iter_sample_gradients,
+)
+from .sample_gradient_norm_hook import (
+    SampleGradientNormHook,
+    get_sample_gradient_norms,
 )
 
 __all__ = [
+    "RandomProjector",
     "SampleGradientHook",
+    "SampleGradientNormHook",
+    "get_sample_gradient_dict",
+    "get_sample_gradient_norms",
+    "get_sample_gradient_sketches",
     "get_sample_gradients",
     "get_sample_gvps",
     "get_self_gvps",
+    "iter_sample_gradients",
 ]
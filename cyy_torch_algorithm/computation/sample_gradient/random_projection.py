@@ -0,0 +1,131 @@
+import math
+
+import torch
+from cyy_naive_lib.algorithm.mapping_op import get_mapping_items_by_key_order
+from cyy_torch_toolbox import TensorDict
+
+__UINT32_MASK = 0xFFFFFFFF
+
+
+def __multiply_uint32(x: torch.Tensor, factor: int) -> torch.Tensor:
+    # x * factor modulo 2**32, with the factor split into 16-bit halves so
+    # that the int64 products never overflow.
+    return (
+        x * (factor & 0xFFFF) + (((x * (factor >> 16)) & 0xFFFF) << 16)
+    ) & __UINT32_MASK
+
+
+def __hash_uint32(x: torch.Tensor) -> torch.Tensor:
+    # The lowbias32 integer hash on int64 tensors holding 32-bit values,
+    # which only uses exact integer operations and is the same on every
+    # device.
+    x = x ^ (x >> 16)
+    x = __multiply_uint32(x, 0x7FEB352D)
+    x = x ^ (x >> 15)
+    x = __multiply_uint32(x, 0x846CA68B)
+    return x ^ (x >> 16)
+
+
+def hash_entries(seed: int, rows: torch.Tensor, columns: torch.Tensor) -> torch.Tensor:
+    # 32-bit hashes of the matrix entries at rows x columns, which only depend
+    # on the seed and the entry indices.
+    h = __hash_uint32(torch.tensor(seed & __UINT32_MASK, device=rows.device))
+    h = __hash_uint32(h ^ (rows & __UINT32_MASK))
+    h = __hash_uint32(h ^ (rows >> 32))
+    return __hash_uint32(h.unsqueeze(-1) ^ columns)
+
+
+class RandomProjector:
+    # Projects flattened gradients onto seeded random directions. Entries of
+    # the P x dimension projection matrix are counter-based hashes of the seed
+    # and their indices, so the matrix is generated block by block on the
+    # device of the gradients, and does not depend on the device or
+    # block_size. Generated blocks are cached up to max_cache_bytes, since
+    # every batch uses the same blocks.
+    def __init__(
+        self,
+        dimension: int,
+        seed: int = 0,
+        distribution: str = "rademacher",
+        block_size: int = 2**13,
+        max_cache_bytes: int = 2**28,
+    ) -> None:
+        assert dimension > 0
+        assert distribution in ("rademacher", "gaussian")
+        assert block_size > 0
+        self.dimension = dimension
+        self.seed = seed
+        self.distribution = distribution
+        self.block_size = block_size
+        self.max_cache_bytes = max_cache_bytes
+        self.__cached_rows: dict[tuple, torch.Tensor] = {}
+        self.__cache_bytes: int = 0
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_RandomProjector__cached_rows"] = {}
+        state["_RandomProjector__cache_bytes"] = 0
+        return state
+
+    def get_rows(
+        self,
+        begin: int,
+        end: int,
+        device: torch.device | None = None,
+        dtype: torch.dtype | None = None,
+    ) -> torch.Tensor:
+        # Rows begin to end of the projection matrix.
+        rows = torch.arange(begin, end, device=device)
+        dtype = dtype or torch.get_default_dtype()
+        if self.distribution == "rademacher":
+            # Each hash gives the signs of 32 entries.
+            words = hash_entries(
+                self.seed,
+                rows,
+                torch.arange((self.dimension + 31) // 32, device=device),
+            )
+            bits = (words.unsqueeze(-1) >> torch.arange(32, device=device)) & 1
+            signs = bits.view(rows.shape[0], -1)[:, : self.dimension]
+            return (signs * 2 - 1).to(dtype=dtype)
+        # Box-Muller transform of two uniform numbers with 24-bit mantissas
+        columns = torch.arange(self.dimension, device=device)
+        uniforms = [
+            ((hash_entries(self.seed + offset, rows, columns) >> 8) + 0.5) / 2**24
+            for offset in (0x9E3779B9, 0x7F4A7C15)
+        ]
+        gaussians = torch.sqrt(-2 * torch.log(uniforms[0])) * torch.cos(
+            2 * math.pi * uniforms[1]
+        )
+        return gaussians.to(dtype=dtype)
+
+    def __get_cached_rows(
+        self, begin: int, end: int, device: torch.device, dtype: torch.dtype
+    ) -> torch.Tensor:
+        key = (begin, end, device, dtype)
+        rows = self.__cached_rows.get(key)
+        if rows is None:
+            rows = self.get_rows(begin=begin, end=end, device=device, dtype=dtype)
+            row_bytes = rows.numel() * rows.element_size()
+            if self.__cache_bytes + row_bytes <= self.max_cache_bytes:
+                self.__cached_rows[key] = rows
+                self.__cache_bytes += row_bytes
+        return rows
+
+    def project(self, gradients: TensorDict) -> torch.Tensor:
+        # gradients are batched, the first dimension indexes samples
+        result: torch.Tensor | None = None
+        row_offset = 0
+        for _, gradient in get_mapping_items_by_key_order(gradients):
+            flat_gradient = gradient.reshape(gradient.shape[0], -1)
+            for begin in range(0, flat_gradient.shape[1], self.block_size):
+                gradient_block = flat_gradient[:, begin : begin + self.block_size]
+                product = gradient_block @ self.__get_cached_rows(
+                    begin=row_offset + begin,
+                    end=row_offset + begin + gradient_block.shape[1],
+                    device=gradient_block.device,
+                    dtype=gradient_block.dtype,
+                )
+                result = product if result is None else result.add_(product)
+            row_offset += flat_gradient.shape[1]
+        assert result is not None
+        return result / math.sqrt(self.dimension)
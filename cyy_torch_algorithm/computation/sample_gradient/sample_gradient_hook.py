@@ -1,33 +1,96 @@
 import copy
 import functools
-from collections.abc import Callable
+import os
+import queue
+import threading
+from collections.abc import Callable, Generator, MutableMapping
 from typing import Any
 
 import torch
+from cyy_naive_lib.algorithm.mapping_op import get_mapping_items_by_key_order
+from cyy_naive_lib.log import log_info, log_warning
 from cyy_torch_toolbox import (
+    ExecutorHookPoint,
     IndicesType,
     Inferencer,
     ModelEvaluator,
     ModelGradient,
     ModelParameter,
     OptionalIndicesType,
+    StopExecutingException,
     TensorDict,
+    cat_tensor_dict,
+    tensor_to,
 )
 from cyy_torch_toolbox.tensor import dot_product
 from torch.func import grad, vmap
 
+from ..compile_cache import CompiledFunctionCache
 from ..evaluation import eval_model
+from ..flat_parameter import ParameterLayout
 from ..sample_computation_hook import SampleComputationHook
+from .random_projection import RandomProjector
+
+
+def get_available_memory(device: torch.device) -> int:
+    if device.type == "cuda":
+        return torch.cuda.mem_get_info(device)[0]
+    # MemAvailable counts reclaimable page cache, which MemFree does not.
+    try:
+        with open("/proc/meminfo", encoding="utf8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+@functools.cache
+def __log_chunk_size(
+    chunk_size: int, device: torch.device, parameter_bytes: int
+) -> None:
+    log_info(
+        "use chunk size %s for per-sample gradients on %s, parameter size %s bytes",
+        chunk_size,
+        device,
+        parameter_bytes,
+    )
+
+
+def get_sample_gradient_chunk_size(
+    parameter_bytes: int, device: torch.device, memory_budget: int | None = None
+) -> int | None:
+    # Free memory is read on every call, since it changes during training.
+    if memory_budget is None:
+        memory_budget = get_available_memory(device) // 2
+        if memory_budget == 0:
+            log_warning("failed to get available memory of %s", device)
+            return None
+    # A sample needs its gradient and about twice as much again for the
+    # intermediate results of the backward pass.
+    chunk_size = max(1, memory_budget // (3 * parameter_bytes))
+    __log_chunk_size(chunk_size, device, parameter_bytes)
+    return chunk_size
 
 
 def sample_gradient_worker_fun(
     model_evaluator: ModelEvaluator,
     sample_indices: IndicesType,
-    inputs: list[torch.Tensor] | list[TensorDict],
-    targets: list[torch.Tensor],
+    inputs: torch.Tensor | TensorDict,
+    targets: torch.Tensor,
     worker_device: torch.device,
-    parameters: ModelParameter,
-) -> dict[int, ModelGradient]:
+    parameters: ModelParameter | torch.Tensor,
+    parameter_layout: ParameterLayout | None = None,
+    chunk_size: int | None = None,
+    use_chunking: bool = False,
+    memory_budget: int | None = None,
+    projector: RandomProjector | None = None,
+    compile_cache: CompiledFunctionCache | None = None,
+) -> dict[int, ModelGradient] | dict[int, torch.Tensor]:
     def wrapper(parameters, target, *args, input_keys=None):
         if input_keys is not None:
             inputs = dict(zip(input_keys, args, strict=False))
@@ -41,77 +104,321 @@ def sample_gradient_worker_fun(
             device=worker_device,
             model_evaluator=model_evaluator,
             inputs=inputs,
+            parameter_layout=parameter_layout,
         )
         return grad(f, argnums=0)(parameters)
 
-    match inputs[0]:
+    input_keys: list | None = None
+    match inputs:
         case torch.Tensor():
-            gradient_dicts = vmap(
-                wrapper,
-                in_dims=(None, 0, 0),
-                randomness="same",
-            )(
-                parameters,
-                torch.stack(targets),
-                torch.stack(inputs),
-            )
+            input_list = [inputs]
+            vmap_fun: Callable = wrapper
         case dict():
-            input_keys = list(inputs[0].keys())
-            dict_inputs = []
-            for k in input_keys:
-                dict_inputs.append(torch.stack([a[k] for a in inputs]))
-            in_dims: list[int | None] = [0] * (len(dict_inputs) + 2)
-            in_dims[0] = None
-            gradient_dicts = vmap(
-                functools.partial(wrapper, input_keys=input_keys),
-                in_dims=tuple(in_dims),
-                randomness="same",
-            )(parameters, torch.stack(targets), *dict_inputs)
+            input_keys = list(inputs.keys())
+            input_list = [inputs[k] for k in input_keys]
+            vmap_fun = functools.partial(wrapper, input_keys=input_keys)
         case _:
             raise NotImplementedError(inputs)
-    result: dict[int, ModelGradient] = {}
-    for idx, sample_idx in enumerate(sample_indices):
-        result[sample_idx] = {}
-        for k, v in gradient_dicts.items():
-            result[sample_idx][k] = v[idx]
+    in_dims: list[int | None] = [0] * (len(input_list) + 2)
+    in_dims[0] = None
+    vmap_fun = vmap(vmap_fun, in_dims=tuple(in_dims), randomness="same")
+    if compile_cache is not None:
+        vmap_fun = functools.partial(
+            compile_cache.run,
+            "sample_gradient",
+            vmap_fun,
+            model_evaluator=model_evaluator,
+            parameter_layout=parameter_layout,
+            context=(tuple(input_keys or ()),),
+            pad_sample_dim=True,
+        )
+
+    sample_number = len(sample_indices)
+    if use_chunking and chunk_size is None:
+        if parameter_layout is not None:
+            parameter_bytes = parameters.numel() * parameters.element_size()
+        else:
+            parameter_bytes = sum(
+                v.numel() * v.element_size() for v in parameters.values()
+            )
+        chunk_size = get_sample_gradient_chunk_size(
+            parameter_bytes=parameter_bytes,
+            device=worker_device,
+            memory_budget=memory_budget,
+        )
+    if chunk_size is None:
+        chunk_size = sample_number
+    # Gradients of finished chunks leave the device, otherwise the results
+    # of the batch would take the memory that chunking saves.
+    offload = chunk_size < sample_number and worker_device.type != "cpu"
+
+    result: dict = {}
+    for begin in range(0, sample_number, chunk_size):
+        end = min(begin + chunk_size, sample_number)
+        gradients = vmap_fun(
+            parameters,
+            targets[begin:end],
+            *(input_tensor[begin:end] for input_tensor in input_list),
+        )
+        if projector is not None:
+            if parameter_layout is not None:
+                gradients = parameter_layout.unflatten(gradients)
+            sketches = projector.project(gradients)
+            del gradients
+            result |= dict(zip(sample_indices[begin:end], sketches, strict=True))
+            continue
+        if offload:
+            gradients = tensor_to(gradients, device=torch.device("cpu"))
+        if parameter_layout is not None:
+            result |= dict(zip(sample_indices[begin:end], gradients, strict=True))
+            continue
+        for idx, sample_idx in enumerate(sample_indices[begin:end]):
+            result[sample_idx] = {}
+            for k, v in gradients.items():
+                result[sample_idx][k] = v[idx]
     return result
 
 
 class SampleGradientHook(SampleComputationHook):
-    def _get_sample_computation_fun(self):
-        return sample_gradient_worker_fun
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.__use_chunking: bool = False
+        self.__chunk_size: int | None = None
+        self.__memory_budget: int | None = None
+        self.__projector: RandomProjector | None = None
+
+    def set_projection(
+        self, dimension: int, seed: int = 0, distribution: str = "rademacher"
+    ) -> None:
+        # Results become dimension-sized sketches of the flattened gradients.
+        self.__projector = RandomProjector(
+            dimension=dimension, seed=seed, distribution=distribution
+        )
+
+    def enable_chunking(
+        self, chunk_size: int | None = None, memory_budget: int | None = None
+    ) -> None:
+        # Without an explicit chunk size, workers derive it from memory_budget
+        # or half of the available device memory. Gradients of chunked
+        # batches are returned on CPU.
+        self.__use_chunking = True
+        self.__chunk_size = chunk_size
+        self.__memory_budget = memory_budget
+
+    def _get_sample_computation_fun(self) -> Callable:
+        return functools.partial(
+            sample_gradient_worker_fun,
+            use_chunking=self.__use_chunking,
+            chunk_size=self.__chunk_size,
+            memory_budget=self.__memory_budget,
+            projector=self.__projector,
+            compile_cache=self._get_compile_cache(),
+        )
+
+    def set_result_arena_size(self, slot_number: int) -> None:
+        self._set_result_arena_size(slot_number=slot_number)
+
+    def _get_result_arena_layout(
+        self, model_evaluator: ModelEvaluator
+    ) -> dict[str, torch.Size] | torch.Size:
+        if self.__projector is not None:
+            return torch.Size([self.__projector.dimension])
+        if self.use_flat_parameters:
+            return torch.Size(
+                [ParameterLayout(model_evaluator.model_util.get_parameters()).numel]
+            )
+        return {
+            k: v.shape
+            for k, v in get_mapping_items_by_key_order(
+                model_evaluator.model_util.get_parameters()
+            )
+        }
+
+
+def __prepare_inferencer(
+    inferencer: Inferencer, hook: SampleComputationHook
+) -> Inferencer:
+    tmp_inferencer = copy.deepcopy(inferencer)
+    tmp_inferencer.hook_config.use_performance_metric = False
+    tmp_inferencer.hook_config.summarize_executor = False
+    tmp_inferencer.append_hook(hook)
+    return tmp_inferencer
 
 
 def get_sample_gradients_impl(
     inferencer: Inferencer,
     computed_indices: OptionalIndicesType = None,
     result_transform: None | Callable = None,
-) -> dict[int, ModelGradient] | dict[int, Any]:
-    tmp_inferencer = copy.deepcopy(inferencer)
-    tmp_inferencer.hook_config.use_performance_metric = False
-    tmp_inferencer.hook_config.summarize_executor = False
-    hook = SampleGradientHook()
+    use_chunking: bool = False,
+    memory_budget: int | None = None,
+    projection_dimension: int | None = None,
+    projection_seed: int = 0,
+    hook: SampleComputationHook | None = None,
+    result_storage: MutableMapping | None = None,
+    max_pending_task_num: int = 32,
+    use_flat_parameters: bool = False,
+    use_worker_pool: bool = False,
+) -> dict[int, ModelGradient] | dict[int, Any] | MutableMapping:
+    if hook is None:
+        hook = SampleGradientHook()
+    if use_flat_parameters:
+        hook.enable_flat_parameters()
+    if use_worker_pool:
+        hook.enable_worker_pool()
     if computed_indices is not None:
         hook.set_computed_indices(computed_indices)
+    if isinstance(hook, SampleGradientHook):
+        if use_chunking:
+            hook.enable_chunking(memory_budget=memory_budget)
+        if projection_dimension is not None:
+            hook.set_projection(dimension=projection_dimension, seed=projection_seed)
     if result_transform is not None:
         hook.set_result_transform(result_transform)
-    tmp_inferencer.append_hook(hook)
+    if result_storage is not None:
+        # Tensor dicts are stored flattened, in the key order of cat_tensor_dict.
+        def store_results(results: dict) -> None:
+            for k, v in results.items():
+                result_storage[k] = cat_tensor_dict(v) if isinstance(v, dict) else v
+
+        hook.set_result_collection_fun(store_results)
+        hook.set_max_pending_task_num(max_pending_task_num)
+    tmp_inferencer = __prepare_inferencer(inferencer=inferencer, hook=hook)
     tmp_inferencer.inference()
-    gradients = {
-        k: {name: tensor.cpu() for name, tensor in v.items()}
-        for k, v in hook.result_dict.items()
-    }
-    assert gradients
+    gradients = tensor_to(hook.result_dict, device="cpu")
     hook.release()
+    if result_storage is not None:
+        assert len(result_storage) > 0
+        return result_storage
+    assert gradients
     return gradients
 
 
 def get_sample_gradients(
     inferencer: Inferencer,
     computed_indices: OptionalIndicesType = None,
+    **kwargs: Any,
 ) -> dict[int, ModelGradient]:
     return get_sample_gradients_impl(
-        inferencer=inferencer, computed_indices=computed_indices
+        inferencer=inferencer, computed_indices=computed_indices, **kwargs
+    )
+
+
+def get_sample_gradient_dict(
+    inferencer: Inferencer,
+    computed_indices: OptionalIndicesType = None,
+    storage_dir: str | None = None,
+    cache_size: int | None = None,
+    **kwargs: Any,
+) -> tuple[MutableMapping, ParameterLayout | None]:
+    # Gradients are stored flattened, and the returned layout unflattens them
+    # into named parameters. Transformed or projected results have no layout.
+    try:
+        from ...data_structure.synced_tensor_dict import SyncedTensorDict
+    except ImportError as e:
+        raise RuntimeError(
+            "get_sample_gradient_dict needs SyncedTensorDict from cyy_torch_cpp_extension"
+        ) from e
+
+    parameter_layout: ParameterLayout | None = None
+    if (
+        kwargs.get("projection_dimension") is None
+        and kwargs.get("result_transform") is None
+    ):
+        parameter_layout = ParameterLayout(
+            inferencer.model_evaluator.model_util.get_parameters(detach=True)
+        )
+    tensor_dict = SyncedTensorDict.create(
+        storage_dir=storage_dir, cache_size=cache_size
+    )
+    return get_sample_gradients_impl(
+        inferencer=inferencer,
+        computed_indices=computed_indices,
+        result_storage=tensor_dict,
+        **kwargs,
+    ), parameter_layout
+
+
+def iter_sample_gradients(
+    inferencer: Inferencer,
+    computed_indices: OptionalIndicesType = None,
+    max_pending_task_num: int = 32,
+    use_chunking: bool = False,
+    memory_budget: int | None = None,
+) -> Generator[tuple[int, ModelGradient], None, None]:
+    hook = SampleGradientHook()
+    if computed_indices is not None:
+        hook.set_computed_indices(computed_indices)
+    if use_chunking:
+        hook.enable_chunking(memory_budget=memory_budget)
+    hook.set_max_pending_task_num(max_pending_task_num)
+    tmp_inferencer = __prepare_inferencer(inferencer=inferencer, hook=hook)
+
+    result_queue: queue.Queue = queue.Queue(maxsize=max_pending_task_num)
+    stop_event = threading.Event()
+    end_of_results = object()
+
+    def put_result(item: Any) -> None:
+        while not stop_event.is_set():
+            try:
+                result_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def collect_results(results: dict) -> None:
+        for k, v in results.items():
+            put_result((k, {name: tensor.cpu() for name, tensor in v.items()}))
+
+    hook.set_result_collection_fun(collect_results)
+
+    def stop_inference(**kwargs: Any) -> None:
+        # Ends the inference once the consumer stops iterating.
+        if stop_event.is_set():
+            raise StopExecutingException()
+
+    tmp_inferencer.append_named_hook(
+        ExecutorHookPoint.BEFORE_BATCH, "stop_iteration", stop_inference
+    )
+
+    def run_inference() -> None:
+        try:
+            tmp_inferencer.inference()
+            _ = hook.result_dict
+            put_result(end_of_results)
+        except BaseException as e:
+            put_result(e)
+        finally:
+            hook.reset_result()
+            hook.release()
+
+    inference_thread = threading.Thread(target=run_inference, daemon=True)
+    inference_thread.start()
+    try:
+        while True:
+            item = result_queue.get()
+            if item is end_of_results:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop_event.set()
+        inference_thread.join()
+
+
+def get_sample_gradient_sketches(
+    inferencer: Inferencer,
+    dimension: int,
+    computed_indices: OptionalIndicesType = None,
+    seed: int = 0,
+    **kwargs: Any,
+) -> dict[int, torch.Tensor]:
+    return get_sample_gradients_impl(
+        inferencer=inferencer,
+        computed_indices=computed_indices,
+        projection_dimension=dimension,
+        projection_seed=seed,
+        **kwargs,
     )
 
 
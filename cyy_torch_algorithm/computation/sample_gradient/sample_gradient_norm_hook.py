@@ -0,0 +1,246 @@
+import functools
+from collections.abc import Callable
+from typing import Any
+
+import torch
+from cyy_torch_toolbox import (
+    IndicesType,
+    Inferencer,
+    ModelEvaluator,
+    ModelParameter,
+    OptionalIndicesType,
+    TensorDict,
+)
+from torch.func import grad, vmap
+
+from ..evaluation import eval_model
+from ..flat_parameter import ParameterLayout
+from ..sample_computation_hook import SampleComputationHook
+from .sample_gradient_hook import (
+    get_sample_gradient_chunk_size,
+    get_sample_gradients_impl,
+)
+
+
+def get_ghost_norm_modules(
+    model: torch.nn.Module, parameters: ModelParameter
+) -> dict[str, torch.nn.Linear]:
+    # Shared weights get gradients from several modules, so they are excluded.
+    usage_count: dict[int, int] = {}
+    for module in model.modules():
+        for parameter in module.parameters(recurse=False):
+            usage_count[id(parameter)] = usage_count.get(id(parameter), 0) + 1
+    modules: dict[str, torch.nn.Linear] = {}
+    for name, module in model.named_modules():
+        if not isinstance(module, torch.nn.Linear):
+            continue
+        if f"{name}.weight" not in parameters:
+            continue
+        if any(usage_count[id(p)] > 1 for p in module.parameters(recurse=False)):
+            continue
+        modules[name] = module
+    return modules
+
+
+def get_ghost_squared_norms(
+    activations: list[torch.Tensor], output_gradients: list[torch.Tensor]
+) -> tuple[torch.Tensor, torch.Tensor]:
+    # Per-sample gradient of a linear weight is b^T a, summed over all
+    # positions and calls, so its norm only needs activation sized tensors.
+    sample_number = activations[0].shape[0]
+    a = torch.cat([t.reshape(sample_number, -1, t.shape[-1]) for t in activations], 1)
+    b = torch.cat(
+        [t.reshape(sample_number, -1, t.shape[-1]) for t in output_gradients], 1
+    )
+    position_number = a.shape[1]
+    if position_number * position_number <= a.shape[2] * b.shape[2]:
+        weight_norm = ((a @ a.transpose(1, 2)) * (b @ b.transpose(1, 2))).sum(
+            dim=(1, 2)
+        )
+    else:
+        weight_norm = (b.transpose(1, 2) @ a).pow(2).sum(dim=(1, 2))
+    bias_norm = b.sum(dim=1).pow(2).sum(dim=1)
+    return weight_norm, bias_norm
+
+
+def sample_gradient_norm_worker_fun(
+    model_evaluator: ModelEvaluator,
+    sample_indices: IndicesType,
+    inputs: torch.Tensor | TensorDict,
+    targets: torch.Tensor,
+    worker_device: torch.device,
+    parameters: ModelParameter | torch.Tensor,
+    parameter_layout: ParameterLayout | None = None,
+    chunk_size: int | None = None,
+    use_chunking: bool = False,
+    memory_budget: int | None = None,
+) -> dict[int, torch.Tensor]:
+    if parameter_layout is not None:
+        # The linear layers are handled per module.
+        parameters = parameter_layout.unflatten(parameters)
+    ghost_modules = get_ghost_norm_modules(model_evaluator.model, parameters)
+    ghost_parameter_names: dict[str, str] = {}
+    for module_name, module in ghost_modules.items():
+        ghost_parameter_names[f"{module_name}.weight"] = module_name
+        if module.bias is not None:
+            ghost_parameter_names[f"{module_name}.bias"] = module_name
+    constant_parameters = {
+        k: v for k, v in parameters.items() if k in ghost_parameter_names
+    }
+    other_parameters = {
+        k: v for k, v in parameters.items() if k not in ghost_parameter_names
+    }
+
+    input_keys: list | None = None
+    match inputs:
+        case torch.Tensor():
+            input_list = [inputs]
+        case dict():
+            input_keys = list(inputs.keys())
+            input_list = [inputs[k] for k in input_keys]
+        case _:
+            raise NotImplementedError(inputs)
+
+    def get_inputs(input_tensors) -> Any:
+        if input_keys is not None:
+            return dict(zip(input_keys, input_tensors, strict=True))
+        return input_tensors[0]
+
+    state: dict[str, Any] = {}
+
+    def forward_hook(module_name, module, args, output):
+        activations = state["activations"][module_name]
+        if "perturbations" not in state:
+            activations.append(output.shape)
+            return None
+        perturbation = state["perturbations"][module_name][len(activations)]
+        activations.append(args[0])
+        return output + perturbation
+
+    handles = [
+        module.register_forward_hook(functools.partial(forward_hook, module_name))
+        for module_name, module in ghost_modules.items()
+    ]
+    try:
+        # Record the output shapes of the linear layers for a single sample.
+        state["activations"] = {module_name: [] for module_name in ghost_modules}
+        with torch.no_grad():
+            eval_model(
+                parameters=parameters,
+                model_evaluator=model_evaluator,
+                device=worker_device,
+                targets=targets[0],
+                inputs=get_inputs([t[0] for t in input_list]),
+            )
+        output_shapes: dict[str, list] = state["activations"]
+
+        def loss_wrapper(other_parameters, perturbations, target, *input_tensors):
+            state["perturbations"] = perturbations
+            state["activations"] = {module_name: [] for module_name in ghost_modules}
+            loss = eval_model(
+                parameters=other_parameters | constant_parameters,
+                model_evaluator=model_evaluator,
+                device=worker_device,
+                targets=target,
+                inputs=get_inputs(input_tensors),
+            )
+            return loss, state["activations"]
+
+        vmap_fun = vmap(
+            grad(loss_wrapper, argnums=(0, 1), has_aux=True),
+            in_dims=tuple([None] + [0] * (len(input_list) + 2)),
+            randomness="same",
+        )
+
+        sample_number = len(sample_indices)
+        # Parameters outside the linear layers fall back to per-sample
+        # gradients, which are always evaluated in chunks.
+        if (use_chunking or other_parameters) and chunk_size is None:
+            chunk_size = get_sample_gradient_chunk_size(
+                parameter_bytes=max(
+                    1,
+                    sum(
+                        v.numel() * v.element_size() for v in other_parameters.values()
+                    ),
+                ),
+                device=worker_device,
+                memory_budget=memory_budget,
+            )
+        if chunk_size is None:
+            chunk_size = sample_number
+
+        result: dict[int, torch.Tensor] = {}
+        for begin in range(0, sample_number, chunk_size):
+            end = min(begin + chunk_size, sample_number)
+            perturbations = {
+                module_name: [
+                    torch.zeros(
+                        (end - begin, *shape),
+                        device=worker_device,
+                        dtype=constant_parameters[f"{module_name}.weight"].dtype,
+                    )
+                    for shape in shapes
+                ]
+                for module_name, shapes in output_shapes.items()
+            }
+            (other_gradients, output_gradients), activations = vmap_fun(
+                other_parameters,
+                perturbations,
+                targets[begin:end],
+                *(input_tensor[begin:end] for input_tensor in input_list),
+            )
+            squared_norms = torch.zeros(end - begin, device=worker_device)
+            for gradient in other_gradients.values():
+                squared_norms += gradient.reshape(end - begin, -1).pow(2).sum(dim=1)
+            del other_gradients
+            for module_name, module in ghost_modules.items():
+                weight_norm, bias_norm = get_ghost_squared_norms(
+                    activations[module_name], output_gradients[module_name]
+                )
+                squared_norms += weight_norm
+                if module.bias is not None:
+                    squared_norms += bias_norm
+            result |= dict(
+                zip(sample_indices[begin:end], squared_norms.sqrt(), strict=True)
+            )
+        return result
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+class SampleGradientNormHook(SampleComputationHook):
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.__use_chunking: bool = False
+        self.__chunk_size: int | None = None
+        self.__memory_budget: int | None = None
+
+    def enable_chunking(
+        self, chunk_size: int | None = None, memory_budget: int | None = None
+    ) -> None:
+        self.__use_chunking = True
+        self.__chunk_size = chunk_size
+        self.__memory_budget = memory_budget
+
+    def _get_sample_computation_fun(self) -> Callable:
+        return functools.partial(
+            sample_gradient_norm_worker_fun,
+            use_chunking=self.__use_chunking,
+            chunk_size=self.__chunk_size,
+            memory_budget=self.__memory_budget,
+        )
+
+
+def get_sample_gradient_norms(
+    inferencer: Inferencer,
+    computed_indices: OptionalIndicesType = None,
+    use_chunking: bool = False,
+    memory_budget: int | None = None,
+) -> dict[int, float]:
+    hook = SampleGradientNormHook()
+    if use_chunking:
+        hook.enable_chunking(memory_budget=memory_budget)
+    return get_sample_gradients_impl(
+        inferencer=inferencer, computed_indices=computed_indices, hook=hook
+    )
@@ -9,7 +9,9 @@ from cyy_torch_toolbox import (
 )
 from torch.func import grad, vjp, vmap
 
-from ..evaluation import eval_model
+from ..compile_cache import CompiledFunctionCache
+from ..evaluation import eval_model, get_perturbed_input_list
+from ..flat_parameter import ParameterLayout
 from ..sample_computation_hook import SampleComputationHook
 
 
@@ -17,26 +19,16 @@ def sample_gvjp_worker_fun(
     vector: torch.Tensor,
     model_evaluator: ModelEvaluator,
     sample_indices: list[int],
-    inputs,
-    targets,
+    inputs: torch.Tensor | dict[str, torch.Tensor],
+    targets: torch.Tensor,
     worker_device: torch.device,
-    parameters: ModelParameter,
+    parameters: ModelParameter | torch.Tensor,
+    parameter_layout: ParameterLayout | None = None,
+    batched_vector: bool = False,
+    compile_cache: CompiledFunctionCache | None = None,
     **kwargs,
 ) -> dict:
-    input_list = []
-    input_keys: list = []
-    if isinstance(inputs[0], dict):
-        input_key_sets = set(inputs[0].keys())
-        for k in input_key_sets.copy():
-            if "mask" in k:
-                input_keys.append(k)
-                input_key_sets.remove(k)
-        assert len(input_key_sets) == 1
-        input_keys += list(input_key_sets)
-        for k in input_keys:
-            input_list.append(torch.stack([a[k] for a in inputs]))
-    else:
-        input_list.append(torch.stack(inputs))
+    input_keys, input_list = get_perturbed_input_list(inputs)
 
     def vjp_wrapper(parameters, target, *input_tensors):
         f = functools.partial(
@@ -45,32 +37,62 @@ def sample_gvjp_worker_fun(
             device=worker_device,
             model_evaluator=model_evaluator,
             input_keys=input_keys,
+            parameter_layout=parameter_layout,
         )
 
         def grad_f(input_tensor):
-            return cat_tensor_dict(
-                grad(f, argnums=0)(
-                    parameters, input_tensors=list(input_tensors[0:-1]) + [input_tensor]
-                )
+            gradient = grad(f, argnums=0)(
+                parameters, input_tensors=list(input_tensors[0:-1]) + [input_tensor]
             )
+            if parameter_layout is not None:
+                return gradient
+            return cat_tensor_dict(gradient)
 
         vjpfunc = vjp(grad_f, input_tensors[-1])[1]
+        if batched_vector:
+            # The backward graph of the sample is shared by all rows of vector.
+            return vmap(vjpfunc, randomness="same")(vector)[0]
         return vjpfunc(vector)[0]
 
-    products = vmap(
+    vmap_fun: Callable = vmap(
         vjp_wrapper,
         in_dims=tuple([None] + [0] * (len(input_list) + 1)),
         randomness="same",
-    )(parameters, torch.stack(targets), *input_list)
+    )
+    if compile_cache is not None:
+        vmap_fun = functools.partial(
+            compile_cache.run,
+            "sample_gvjp",
+            vmap_fun,
+            model_evaluator=model_evaluator,
+            parameter_layout=parameter_layout,
+            context=(vector, tuple(input_keys), batched_vector),
+            pad_sample_dim=True,
+        )
+    products = vmap_fun(parameters, targets, *input_list)
     return dict(zip(sample_indices, products, strict=False))
 
 
 class SampleGradientVJPHook(SampleComputationHook):
     __vector: torch.Tensor | None = None
+    __batched_vector: bool = False
 
     def set_vector(self, vector: torch.Tensor) -> None:
         self.__vector = vector
+        self.__batched_vector = False
+
+    def set_vectors(self, vectors: torch.Tensor | list[torch.Tensor]) -> None:
+        # Each sample gets the products with all vectors, stacked in order.
+        if isinstance(vectors, list):
+            vectors = torch.stack(vectors)
+        self.__vector = vectors
+        self.__batched_vector = True
 
     def _get_sample_computation_fun(self) -> Callable:
         assert self.__vector is not None
-        return functools.partial(sample_gvjp_worker_fun, self.__vector)
+        return functools.partial(
+            sample_gvjp_worker_fun,
+            self.__vector,
+            batched_vector=self.__batched_vector,
+            compile_cache=self._get_compile_cache(),
+        )
@@ -0,0 +1,91 @@
+import collections
+import contextlib
+import math
+import time
+from collections.abc import Callable, Generator
+
+import torch
+
+
+class StageTimer:
+    # Wall-clock durations in milliseconds of named stages. Counts, totals
+    # and maxima cover all samples, while percentiles use the latest window_size samples
+    # of each stage. With keep_new_samples, samples are also buffered until
+    # pop_new_samples so that workers can ship them to the hook.
+    def __init__(
+        self,
+        window_size: int = 10000,
+        keep_new_samples: bool = False,
+        callback: Callable | None = None,
+    ) -> None:
+        assert window_size > 0
+        self.__window_size = window_size
+        self.__keep_new_samples = keep_new_samples
+        self.__callback = callback
+        self.__counts: dict[str, int] = {}
+        self.__totals: dict[str, float] = {}
+        self.__maxima: dict[str, float] = {}
+        self.__windows: dict[str, collections.deque] = {}
+        self.__new_samples: dict[str, list[float]] = {}
+
+    def add(self, stage: str, elapsed_ms: float) -> None:
+        self.__counts[stage] = self.__counts.get(stage, 0) + 1
+        self.__totals[stage] = self.__totals.get(stage, 0) + elapsed_ms
+        self.__maxima[stage] = max(self.__maxima.get(stage, elapsed_ms), elapsed_ms)
+        if stage not in self.__windows:
+            self.__windows[stage] = collections.deque(maxlen=self.__window_size)
+        self.__windows[stage].append(elapsed_ms)
+        if self.__keep_new_samples:
+            self.__new_samples.setdefault(stage, []).append(elapsed_ms)
+        if self.__callback is not None:
+            self.__callback(stage=stage, elapsed_ms=elapsed_ms)
+
+    def merge(self, samples: dict[str, list[float]]) -> None:
+        for stage, stage_samples in samples.items():
+            for elapsed_ms in stage_samples:
+                self.add(stage, elapsed_ms)
+
+    @contextlib.contextmanager
+    def time(
+        self, stage: str, stream: torch.cuda.Stream | None = None
+    ) -> Generator[None, None, None]:
+        # Asynchronous device work is waited for, so that it is charged to the
+        # stage issuing it.
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if stream is not None:
+                stream.synchronize()
+            self.add(stage, (time.perf_counter() - start) * 1000)
+
+    def pop_new_samples(self) -> dict[str, list[float]]:
+        samples = self.__new_samples
+        self.__new_samples = {}
+        return samples
+
+    def clear(self) -> None:
+        self.__counts.clear()
+        self.__totals.clear()
+        self.__maxima.clear()
+        self.__windows.clear()
+        self.__new_samples.clear()
+
+    def get_metrics(
+        self, percentiles: tuple[float, ...] = (50, 90, 99)
+    ) -> dict[str, dict[str, float]]:
+        metrics: dict[str, dict[str, float]] = {}
+        for stage, count in self.__counts.items():
+            samples = sorted(self.__windows[stage])
+            stage_metrics: dict[str, float] = {
+                "count": count,
+                "total_ms": self.__totals[stage],
+                "mean_ms": self.__totals[stage] / count,
+                "max_ms": self.__maxima[stage],
+            }
+            for percentile in percentiles:
+                # nearest-rank percentile
+                rank = max(math.ceil(percentile / 100 * len(samples)), 1)
+                stage_metrics[f"p{percentile:g}_ms"] = samples[rank - 1]
+            metrics[stage] = stage_metrics
+        return metrics
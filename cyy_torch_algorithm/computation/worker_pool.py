@@ -0,0 +1,226 @@
+import atexit
+import collections
+import functools
+import os
+import threading
+from collections.abc import Callable
+from typing import Any
+
+from cyy_naive_lib.log import log_info, log_warning
+from cyy_torch_toolbox import TorchProcessTaskQueue
+
+# Worker funs cached in the worker processes, keyed by hook id.
+__bound_worker_funs: dict[int, Callable] = {}
+
+
+def __get_worker_fun(
+    hook_id: int, worker_fun_queue: TorchProcessTaskQueue
+) -> Callable | None:
+    # Workers share the response queue, so a response may belong to another
+    # worker's request. It is cached as well, and the request is repeated.
+    while hook_id not in __bound_worker_funs:
+        worker_fun_queue.add_task(hook_id)
+        res = worker_fun_queue.get_data()
+        assert res is not None
+        bound_hook_id, worker_fun, bound_hook_ids = res[0]
+        # Released hooks hold model copies in their worker-local data.
+        for k in list(__bound_worker_funs):
+            if k not in bound_hook_ids:
+                __bound_worker_funs.pop(k)
+        if worker_fun is not None:
+            __bound_worker_funs[bound_hook_id] = worker_fun
+        elif bound_hook_id == hook_id:
+            return None
+    return __bound_worker_funs[hook_id]
+
+
+def pooled_worker_fun(
+    tasks: list, worker_fun_queue: TorchProcessTaskQueue, **kwargs: Any
+) -> list[tuple[int, Any]]:
+    # Tasks are tagged with the id of the bound hook, whose worker fun is
+    # fetched once per worker process. Consecutive tasks of the same hook are
+    # computed together, and results are tagged for routing.
+    results: list[tuple[int, Any]] = []
+    begin = 0
+    for end in range(1, len(tasks) + 1):
+        if end < len(tasks) and tasks[end][0] == tasks[begin][0]:
+            continue
+        hook_id: int = tasks[begin][0]
+        worker_fun = __get_worker_fun(hook_id, worker_fun_queue)
+        if worker_fun is not None:
+            results.append(
+                (
+                    hook_id,
+                    worker_fun(tasks=[task for _, task in tasks[begin:end]], **kwargs),
+                )
+            )
+        begin = end
+    return results
+
+
+def get_bound_worker_fun(
+    hook_id: int, **kwargs: Any
+) -> tuple[int, Callable | None, set[int]]:
+    return ComputationWorkerPool.get().get_worker_fun(hook_id)
+
+
+class PooledTaskQueue:
+    # The task queue interface used by ComputationHook, on top of the pool.
+    def __init__(self, pool: "ComputationWorkerPool", hook_id: int) -> None:
+        self.__pool: ComputationWorkerPool | None = pool
+        self.__hook_id = hook_id
+
+    def __getstate__(self) -> dict:
+        # Workers never use the queue of the hook, and the pool holds locks.
+        state = self.__dict__.copy()
+        state["_PooledTaskQueue__pool"] = None
+        return state
+
+    def add_task(self, task: Any) -> None:
+        assert self.__pool is not None
+        self.__pool.task_queue.add_task((self.__hook_id, task))
+
+    def get_data(self) -> Any:
+        assert self.__pool is not None
+        return self.__pool.get_data(self.__hook_id)
+
+    def release(self) -> None:
+        assert self.__pool is not None
+        self.__pool.unbind(self.__hook_id)
+        self.__pool = None
+
+
+class ComputationWorkerPool:
+    # Worker processes shared by all computation hooks which enable the pool.
+    # ref_cnt counts the bound hooks, and the workers stay alive after the
+    # last hook is released until shutdown is called. Several hooks can be
+    # bound at the same time, and results are routed by hook id.
+    __instance: "ComputationWorkerPool | None" = None
+    __instance_lock = threading.Lock()
+
+    def __init__(self, worker_num: int | None = None) -> None:
+        self.__lock = threading.Lock()
+        self.__result_lock = threading.Lock()
+        self.__next_hook_id: int = 0
+        self.__worker_funs: dict[int, Callable] = {}
+        self.__results: dict[int, collections.deque] = {}
+        if worker_num is None:
+            env_worker_num = os.getenv("CUDA_DEVICE_NUM", None)
+            if env_worker_num is not None:
+                worker_num = int(env_worker_num)
+        self.__worker_num = worker_num
+        self.__worker_fun_queue = TorchProcessTaskQueue(worker_num=1)
+        self.__worker_fun_queue.start(worker_fun=get_bound_worker_fun, use_thread=True)
+        self.task_queue = TorchProcessTaskQueue(
+            worker_num=worker_num,
+            batch_process=True,
+        )
+        self.task_queue.start(
+            worker_fun=functools.partial(
+                pooled_worker_fun, worker_fun_queue=self.__worker_fun_queue
+            )
+        )
+        log_info("start computation worker pool with %s workers", worker_num)
+
+    @classmethod
+    def get(cls, worker_num: int | None = None) -> "ComputationWorkerPool":
+        # Without worker_num, the CUDA_DEVICE_NUM environment variable is
+        # used. An idle pool with another worker number is restarted.
+        with cls.__instance_lock:
+            if (
+                cls.__instance is not None
+                and worker_num is not None
+                and worker_num != cls.__instance.worker_num
+            ):
+                if cls.__instance.ref_cnt == 0:
+                    cls.__shutdown_instance()
+                else:
+                    log_warning(
+                        "computation worker pool is in use with %s workers",
+                        cls.__instance.worker_num,
+                    )
+            if cls.__instance is None:
+                cls.__instance = ComputationWorkerPool(worker_num=worker_num)
+            return cls.__instance
+
+    @classmethod
+    def shutdown(cls, force: bool = False) -> None:
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                return
+            if cls.__instance.ref_cnt != 0:
+                assert force, "computation worker pool is in use"
+                log_warning(
+                    "shutdown computation worker pool with %s bound hooks",
+                    cls.__instance.ref_cnt,
+                )
+            cls.__shutdown_instance()
+
+    @classmethod
+    def __shutdown_instance(cls) -> None:
+        assert cls.__instance is not None
+        cls.__instance.task_queue.release()
+        cls.__instance.__worker_fun_queue.release()
+        cls.__instance = None
+        log_info("shutdown computation worker pool")
+
+    @property
+    def ref_cnt(self) -> int:
+        with self.__lock:
+            return len(self.__worker_funs)
+
+    @property
+    def worker_num(self) -> int | None:
+        return self.__worker_num
+
+    def bind(self, worker_fun: Callable) -> PooledTaskQueue:
+        # Every binding gets a new id so that workers never reuse a stale
+        # worker fun.
+        with self.__lock:
+            hook_id = self.__next_hook_id
+            self.__next_hook_id += 1
+            self.__worker_funs[hook_id] = worker_fun
+            self.__results[hook_id] = collections.deque()
+        return PooledTaskQueue(pool=self, hook_id=hook_id)
+
+    def unbind(self, hook_id: int) -> None:
+        with self.__lock:
+            self.__worker_funs.pop(hook_id)
+            self.__results.pop(hook_id)
+
+    def get_worker_fun(self, hook_id: int) -> tuple[int, Callable | None, set[int]]:
+        with self.__lock:
+            return (
+                hook_id,
+                self.__worker_funs.get(hook_id),
+                set(self.__worker_funs.keys()),
+            )
+
+    def get_data(self, hook_id: int) -> Any:
+        # One caller at a time reads the shared result queue, and results of
+        # other hooks are kept until their hooks fetch them.
+        while True:
+            with self.__lock:
+                if self.__results[hook_id]:
+                    return self.__results[hook_id].popleft()
+            with self.__result_lock:
+                with self.__lock:
+                    if self.__results[hook_id]:
+                        return self.__results[hook_id].popleft()
+                res = self.task_queue.get_data()
+                assert res is not None
+                with self.__lock:
+                    for bound_hook_id, data in res[0]:
+                        if bound_hook_id in self.__results:
+                            self.__results[bound_hook_id].append([data])
+
+
+def shutdown_worker_pool() -> None:
+    ComputationWorkerPool.shutdown()
+
+
+def __shutdown_worker_pool_at_exit() -> None:
+    ComputationWorkerPool.shutdown(force=True)
+
+
+atexit.register(__shutdown_worker_pool_at_exit)
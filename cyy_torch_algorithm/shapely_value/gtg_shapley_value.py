@@ -1,9 +1,41 @@
 import copy
+from collections.abc import Generator
 
 import numpy as np
 from cyy_naive_lib.log import log_debug, log_info, log_warning
 
 from .shapley_value import RoundBasedShapleyValue
+from .subset_bitmask import mask_to_subset, subset_to_mask
+
+
+class RunningMeans:
+    # Running means of the marginal contributions of all permutations so far,
+    # with the latest last_k means kept in a ring buffer.
+    def __init__(self, player_number: int, last_k: int) -> None:
+        self.count = 0
+        self.sum = np.zeros(player_number)
+        self.__latest_means = np.empty((last_k, player_number))
+
+    def add(self, marginal_contribution: list) -> None:
+        self.sum += marginal_contribution
+        self.count += 1
+        self.__latest_means[(self.count - 1) % len(self.__latest_means)] = (
+            self.sum / self.count
+        )
+
+    @property
+    def mean(self) -> np.ndarray:
+        return self.sum / self.count
+
+    def get_max_relative_error(self) -> float:
+        # Largest mean relative deviation of the latest means from the last one
+        latest_means = self.__latest_means[: min(self.count, len(self.__latest_means))]
+        mean = self.__latest_means[(self.count - 1) % len(self.__latest_means)]
+        errors = np.mean(
+            np.abs(latest_means - mean) / (np.abs(mean) + 1e-12),
+            -1,
+        )
+        return float(np.max(errors))
 
 
 class GTGShapleyValue(RoundBasedShapleyValue):
@@ -13,6 +45,8 @@ class GTGShapleyValue(RoundBasedShapleyValue):
         self.shapley_values_S: dict[int, dict] = {}
 
         self.eps = 0.001
+        # evaluate the subsets of a wave of permutations with batch_metric_fun
+        self.batch_evaluation = False
         self.round_trunc_threshold = 0.001
 
         self.converge_min = max(30, self.player_number)
@@ -34,21 +68,25 @@ class GTGShapleyValue(RoundBasedShapleyValue):
         self.shapley_values[round_index] = {}
         self.shapley_values_S[round_index] = {}
         assert self.metric_fun is not None
-        this_round_metric = self.metric_fun(self.complete_player_indices)
-        metrics: dict = {}
+        this_round_metric = self._get_subset_metric(
+            round_index, self.complete_player_indices
+        )
+        # metrics of the visited subsets keyed by bitmask
+        metrics: dict[int, float] = {}
 
         # for best_S
         perm_records = {}
 
         index = 0
-        contribution_records: list = []
+        running_means = RunningMeans(self.player_number, self.last_k)
         last_round_metric = self.get_last_round_metric(round_index=round_index)
-        while not metrics or self.not_convergent(index, contribution_records):
+        while not metrics or self.not_convergent(index, running_means):
+            # One permutation starting with each player. In batch mode, the
+            # missing metrics of all these permutations are evaluated together.
+            permutations: list[np.ndarray] = []
+            walks: list[Generator] = []
+            marginal_contributions: list[list] = []
             for player_id in self.complete_player_indices:
-                index += 1
-                v: list = [0] * (self.player_number + 1)
-                v[0] = last_round_metric
-                marginal_contribution = [0] * self.player_number
                 perturbed_indices = np.concatenate(
                     (
                         np.array([player_id]),
@@ -57,50 +95,48 @@ class GTGShapleyValue(RoundBasedShapleyValue):
                         ),
                     )
                 ).astype(int)
+                permutations.append(perturbed_indices)
+                walks.append(
+                    self.__walk_permutation(
+                        perturbed_indices=perturbed_indices,
+                        this_round_metric=this_round_metric,
+                        last_round_metric=last_round_metric,
+                        metrics=metrics,
+                    )
+                )
+                if self.batch_evaluation:
+                    continue
+                res = self.__run_walks(round_index, walks, metrics)
+                if res is None:
+                    return
+                marginal_contributions += res
+                walks = []
+            if walks:
+                res = self.__run_walks(round_index, walks, metrics)
+                if res is None:
+                    return
+                marginal_contributions += res
 
-                for j in self.complete_player_indices:
-                    subset = tuple(sorted(perturbed_indices[: (j + 1)].tolist()))
-                    # truncation
-                    if abs(this_round_metric - v[j]) >= self.eps:
-                        if subset not in metrics:
-                            if not subset:
-                                metric = last_round_metric
-                            else:
-                                metric = self.metric_fun(subset)
-                                if metric is None:
-                                    log_warning("force stop")
-                                    return
-                            log_info(
-                                "round %s subset %s metric %s",
-                                round_index,
-                                self.get_players(subset),
-                                metric,
-                            )
-                            metrics[subset] = metric
-                        v[j + 1] = metrics[subset]
-                    else:
-                        v[j + 1] = v[j]
-
-                    # update SV
-                    marginal_contribution[perturbed_indices[j]] = v[j + 1] - v[j]
-                contribution_records.append(marginal_contribution)
+            for perturbed_indices, marginal_contribution in zip(
+                permutations, marginal_contributions, strict=True
+            ):
+                index += 1
+                running_means.add(marginal_contribution)
                 # for best_S
                 perm_records[tuple(perturbed_indices.tolist())] = marginal_contribution
 
         # for best_S
         subset_rank = sorted(
-            metrics.items(), key=lambda x: (x[1], -len(x[0])), reverse=True
+            metrics.items(), key=lambda x: (x[1], -x[0].bit_count()), reverse=True
         )
-        if subset_rank[0][0]:
-            best_S: tuple = subset_rank[0][0]
-        else:
-            best_S = subset_rank[1][0]
+        best_mask = subset_rank[0][0]
+        best_S: tuple = mask_to_subset(best_mask)
 
         contrib_S = [
             v for k, v in perm_records.items() if set(k[: len(best_S)]) == set(best_S)
         ]
         SV_calc_temp = np.sum(contrib_S, 0) / len(contrib_S)
-        round_marginal_gain_S = metrics[best_S] - last_round_metric
+        round_marginal_gain_S = metrics[best_mask] - last_round_metric
         round_SV_S: dict = {}
         for client_id in best_S:
             round_SV_S[client_id] = float(SV_calc_temp[client_id])
@@ -116,9 +152,7 @@ class GTGShapleyValue(RoundBasedShapleyValue):
                 self.shapley_values_S[round_index]
             )
         else:
-            round_shapley_values = np.sum(contribution_records, 0) / len(
-                contribution_records
-            )
+            round_shapley_values = running_means.mean
             assert len(round_shapley_values) == self.player_number
 
             round_marginal_gain = this_round_metric - last_round_metric
@@ -140,6 +174,73 @@ class GTGShapleyValue(RoundBasedShapleyValue):
         log_info("shapley_value %s", self.shapley_values[round_index])
         log_info("shapley_value_S %s", self.shapley_values_S[round_index])
 
+    def __walk_permutation(
+        self,
+        perturbed_indices: np.ndarray,
+        this_round_metric: float,
+        last_round_metric: float,
+        metrics: dict[int, float],
+    ) -> Generator[int, None, list]:
+        # Yields the bitmask of each prefix whose metric is needed but
+        # missing, and returns the marginal contributions.
+        v: list = [0] * (self.player_number + 1)
+        v[0] = last_round_metric
+        marginal_contribution = [0] * self.player_number
+        mask = 0
+        for j in self.complete_player_indices:
+            mask |= 1 << int(perturbed_indices[j])
+            # truncation
+            if abs(this_round_metric - v[j]) >= self.eps:
+                if mask not in metrics:
+                    yield mask
+                v[j + 1] = metrics[mask]
+            else:
+                v[j + 1] = v[j]
+
+            # update SV
+            marginal_contribution[perturbed_indices[j]] = v[j + 1] - v[j]
+        return marginal_contribution
+
+    def __run_walks(
+        self, round_index: int, walks: list[Generator], metrics: dict[int, float]
+    ) -> list[list] | None:
+        # Walks blocked on missing metrics are resumed after one evaluation of
+        # all their subsets. None means that the computation is stopped.
+        results: list = [None] * len(walks)
+
+        def advance(idx: int) -> int | None:
+            try:
+                return next(walks[idx])
+            except StopIteration as e:
+                results[idx] = e.value
+                return None
+
+        pending = {idx: advance(idx) for idx in range(len(walks))}
+        while True:
+            pending = {idx: mask for idx, mask in pending.items() if mask is not None}
+            if not pending:
+                return results
+            subsets = [mask_to_subset(mask) for mask in dict.fromkeys(pending.values())]
+            if self.batch_evaluation:
+                resulting_metrics = self._get_subset_metrics(round_index, subsets)
+            else:
+                assert len(subsets) == 1
+                resulting_metrics = {
+                    subsets[0]: self._get_subset_metric(round_index, subsets[0])
+                }
+            for subset, metric in resulting_metrics.items():
+                if metric is None:
+                    log_warning("force stop")
+                    return None
+                log_info(
+                    "round %s subset %s metric %s",
+                    round_index,
+                    self.get_players(subset),
+                    metric,
+                )
+                metrics[subset_to_mask(subset)] = metric
+            pending = {idx: advance(idx) for idx in pending}
+
     def get_best_players(self, round_index: int) -> set | None:
         return set(self.shapley_values_S[round_index].keys())
 
@@ -149,28 +250,20 @@ class GTGShapleyValue(RoundBasedShapleyValue):
             "round_shapley_values_approximated": self.shapley_values_S,
         }
 
-    def not_convergent(self, index: int, contribution_records: list) -> bool:
+    def not_convergent(self, index: int, running_means: RunningMeans) -> bool:
         if index >= self.max_number:
             log_info("convergent for max_number %s", self.max_number)
             return False
         if index <= self.converge_min:
             return True
-        all_vals = (
-            np.cumsum(contribution_records, 0)
-            / np.reshape(np.arange(1, len(contribution_records) + 1), (-1, 1))
-        )[-self.last_k :]
-        errors = np.mean(
-            np.abs(all_vals[-self.last_k :] - all_vals[-1:])
-            / (np.abs(all_vals[-1:]) + 1e-12),
-            -1,
-        )
-        if np.max(errors) > self.converge_criteria:
+        max_error = running_means.get_max_relative_error()
+        if max_error > self.converge_criteria:
             return True
         log_debug(
             "convergent in index %s and min index for convergent %s max error %s error threshold %s",
             index,
             self.converge_min,
-            np.max(errors),
+            max_error,
             self.converge_criteria,
         )
         return False
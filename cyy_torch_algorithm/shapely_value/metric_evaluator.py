@@ -0,0 +1,68 @@
+import concurrent.futures
+from collections.abc import Callable, Iterable
+from typing import Any
+
+
+class ParallelMetricEvaluator:
+    # Evaluates the metrics of player subsets on a thread or process pool.
+    # metric_fun gets the players of a subset, so with processes it and the
+    # players must be picklable.
+    def __init__(
+        self,
+        metric_fun: Callable,
+        players: tuple,
+        executor_type: str = "thread",
+        worker_num: int | None = None,
+    ) -> None:
+        assert executor_type in ("thread", "process")
+        self.__metric_fun = metric_fun
+        self.__players = players
+        self.__executor_type = executor_type
+        self.__worker_num = worker_num
+        self.__executor: concurrent.futures.Executor | None = None
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_ParallelMetricEvaluator__executor"] = None
+        return state
+
+    def __get_executor(self) -> concurrent.futures.Executor:
+        if self.__executor is None:
+            if self.__executor_type == "thread":
+                self.__executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.__worker_num
+                )
+            else:
+                self.__executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.__worker_num
+                )
+        return self.__executor
+
+    def submit(
+        self, subsets: Iterable[tuple]
+    ) -> dict[tuple, concurrent.futures.Future]:
+        # Asynchronous interface, the caller waits for the futures.
+        executor = self.__get_executor()
+        return {
+            subset: executor.submit(
+                self.__metric_fun, tuple(self.__players[i] for i in subset)
+            )
+            for subset in subsets
+        }
+
+    def evaluate(self, subset: tuple) -> Any:
+        return self.submit([subset])[subset].result()
+
+    def __call__(self, subsets: Iterable[tuple]) -> dict[tuple, Any]:
+        futures = self.submit(subsets)
+        subset_of_future = {future: subset for subset, future in futures.items()}
+        metrics: dict[tuple, Any] = {}
+        for future in concurrent.futures.as_completed(subset_of_future):
+            metrics[subset_of_future[future]] = future.result()
+        # Results keep the order of the subsets.
+        return {subset: metrics[subset] for subset in futures}
+
+    def shutdown(self) -> None:
+        if self.__executor is not None:
+            self.__executor.shutdown()
+            self.__executor = None
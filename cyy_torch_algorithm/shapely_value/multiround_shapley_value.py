@@ -1,9 +1,15 @@
 import copy
-import math
 
+import numpy as np
 from cyy_naive_lib.log import log_info
 
 from .shapley_value import RoundBasedShapleyValue
+from .subset_bitmask import (
+    compute_shapley_values,
+    get_popcounts,
+    mask_to_subset,
+    subset_to_mask,
+)
 
 
 class MultiRoundShapleyValue(RoundBasedShapleyValue):
@@ -17,19 +23,14 @@ class MultiRoundShapleyValue(RoundBasedShapleyValue):
         self.shapley_values_S[round_index] = {}
         assert self.metric_fun is not None
         last_round_metric = self.get_last_round_metric(round_index=round_index)
-        metrics: dict = {
-            (): last_round_metric,
-            self.complete_player_indices: self.round_metrics[round_index],
-        }
-
-        subsets = set()
-        for subset in self.powerset(self.complete_player_indices):
-            sorted_subset = tuple(sorted(subset))
-            if sorted_subset not in metrics:
-                subsets.add(sorted_subset)
+        # Metrics of all subsets indexed by bitmask
+        complete_mask = (1 << self.player_number) - 1
+        metric_table = np.empty(complete_mask + 1)
+        metric_table[0] = last_round_metric
+        metric_table[complete_mask] = self.round_metrics[round_index]
 
-        assert self.batch_metric_fun is not None
-        resulting_metrics = self.batch_metric_fun(subsets)
+        subsets = [mask_to_subset(mask) for mask in range(1, complete_mask)]
+        resulting_metrics = self._get_subset_metrics(round_index, subsets)
         for subset, metric in resulting_metrics.items():
             log_info(
                 "round %s subset %s metric %s",
@@ -37,58 +38,39 @@ class MultiRoundShapleyValue(RoundBasedShapleyValue):
                 self.get_players(subset),
                 metric,
             )
-        metrics |= resulting_metrics
+            metric_table[subset_to_mask(subset)] = metric
 
-        # best subset in metrics
-        subset_rank = sorted(
-            metrics.items(), key=lambda x: (x[1], -len(x[0])), reverse=True
-        )
-        best_S = subset_rank[0][0] if subset_rank[0][0] else subset_rank[1][0]
+        # best subset in metrics, preferring smaller subsets on ties
+        popcounts = get_popcounts(self.player_number)
+        best_mask = int(np.lexsort((popcounts[1:], -metric_table[1:]))[0]) + 1
+        best_S = mask_to_subset(best_mask)
 
         # calculating best subset SV
-        N_S = len(best_S)
-        metrics_S = {k: v for k, v in metrics.items() if set(k).issubset(set(best_S))}
-        round_SV_S = {}
-        for subset, metric in metrics_S.items():
-            if not subset:
-                continue
-            for client_id in subset:
-                marginal_contribution = (
-                    metric
-                    - metrics_S[tuple(sorted(i for i in subset if i != client_id))]
-                )
-                if client_id not in round_SV_S:
-                    round_SV_S[client_id] = 0
-                round_SV_S[client_id] += marginal_contribution / (
-                    (math.comb(N_S - 1, len(subset) - 1)) * N_S
-                )
-        round_marginal_gain_S = metrics_S[best_S] - last_round_metric
+        SV_S = compute_shapley_values(
+            metric_table, player_mask=best_mask, player_number=self.player_number
+        )
+        round_SV_S = {client_id: float(SV_S[client_id]) for client_id in best_S}
+        round_marginal_gain_S = metric_table[best_mask] - last_round_metric
 
         self.shapley_values_S[round_index] = self.normalize_shapley_values(
             round_SV_S, round_marginal_gain_S
         )
 
         # calculating fullset SV
-        if set(best_S) == set(self.complete_player_indices):
+        if best_mask == complete_mask:
             self.shapley_values[round_index] = copy.deepcopy(
                 self.shapley_values_S[round_index]
             )
         else:
-            round_shapley_values = {}
-            for subset, metric in metrics.items():
-                if not subset:
-                    continue
-                for player_id in subset:
-                    marginal_contribution = (
-                        metric
-                        - metrics[tuple(sorted(i for i in subset if i != player_id))]
-                    )
-                    if player_id not in round_shapley_values:
-                        round_shapley_values[player_id] = 0
-                    round_shapley_values[player_id] += marginal_contribution / (
-                        (math.comb(self.player_number - 1, len(subset) - 1))
-                        * self.player_number
-                    )
+            shapley_values = compute_shapley_values(
+                metric_table,
+                player_mask=complete_mask,
+                player_number=self.player_number,
+            )
+            round_shapley_values = {
+                player_id: float(shapley_values[player_id])
+                for player_id in self.complete_player_indices
+            }
 
             round_marginal_gain = self.round_metrics[round_index] - last_round_metric
             self.shapley_values[round_index] = self.normalize_shapley_values(
@@ -5,6 +5,10 @@ from typing import Any
 
 from cyy_naive_lib.log import log_info
 
+from .metric_evaluator import ParallelMetricEvaluator
+from .subset_bitmask import subset_to_mask
+from .subset_metric_cache import SubsetMetricCache
+
 
 class ShapleyValue:
     def __init__(self, players: Iterable, **kwargs: Any) -> None:
@@ -12,6 +16,7 @@ class ShapleyValue:
         self.set_players(players)
         self.metric_fun: None | Callable = None
         self.batch_metric_fun: None | Callable = None
+        self.metric_evaluator: None | ParallelMetricEvaluator = None
 
     def set_players(self, players: Iterable) -> None:
         self.players = tuple(players)
@@ -21,6 +26,7 @@ class ShapleyValue:
         state = self.__dict__.copy()
         state["batch_metric_fun"] = None
         state["metric_fun"] = None
+        state["metric_evaluator"] = None
         return state
 
     @property
@@ -48,6 +54,25 @@ class ShapleyValue:
             0
         ]
 
+    def set_parallel_metric_function(
+        self,
+        metric_fun: Callable,
+        executor_type: str = "thread",
+        worker_num: int | None = None,
+    ) -> None:
+        # Batches of subsets are evaluated concurrently, and
+        # metric_evaluator.submit offers asynchronous evaluation.
+        assert self.metric_fun is None
+        assert self.batch_metric_fun is None
+        self.metric_evaluator = ParallelMetricEvaluator(
+            metric_fun=metric_fun,
+            players=self.players,
+            executor_type=executor_type,
+            worker_num=worker_num,
+        )
+        self.metric_fun = self.metric_evaluator.evaluate
+        self.batch_metric_fun = self.metric_evaluator
+
     @classmethod
     def powerset(cls, iterable: Iterable) -> chain:
         "powerset([1,2,3]) --> () (1,) (2,) (3,) (1,2) (1,3) (2,3) (1,2,3)"
@@ -82,6 +107,39 @@ class RoundBasedShapleyValue(ShapleyValue):
         self.initial_metric = initial_metric
         self.round_trunc_threshold: float | None = None
         self.round_metrics: dict[int, float] = {}
+        self.metric_cache = SubsetMetricCache(deterministic=False)
+
+    def set_metric_cache(self, metric_cache: SubsetMetricCache) -> None:
+        # A deterministic cache can be shared with other computations on the
+        # same players to reuse the metrics of the evaluated subsets.
+        metric_cache.bind_players(self.players)
+        self.metric_cache = metric_cache
+
+    def _get_subset_metric(self, round_index: int, subset: tuple) -> Any:
+        mask = subset_to_mask(subset)
+        metric = self.metric_cache.get(round_index, mask)
+        if metric is None:
+            assert self.metric_fun is not None
+            metric = self.metric_fun(subset)
+            if metric is not None:
+                self.metric_cache.put(round_index, mask, metric)
+        return metric
+
+    def _get_subset_metrics(self, round_index: int, subsets: list[tuple]) -> dict:
+        metrics: dict = {}
+        for subset in subsets:
+            metric = self.metric_cache.get(round_index, subset_to_mask(subset))
+            if metric is not None:
+                metrics[subset] = metric
+        missing_subsets = [subset for subset in subsets if subset not in metrics]
+        if missing_subsets:
+            assert self.batch_metric_fun is not None
+            resulting_metrics = self.batch_metric_fun(missing_subsets)
+            for subset, metric in resulting_metrics.items():
+                if metric is not None:
+                    self.metric_cache.put(round_index, subset_to_mask(subset), metric)
+            metrics |= resulting_metrics
+        return {subset: metrics[subset] for subset in subsets}
 
     def set_round_truncation_threshold(self, threshold: float) -> None:
         self.round_trunc_threshold = threshold
@@ -95,7 +153,9 @@ class RoundBasedShapleyValue(ShapleyValue):
 
     def compute(self, round_index: int) -> None:
         assert self.metric_fun is not None
-        self.round_metrics[round_index] = self.metric_fun(self.complete_player_indices)
+        self.round_metrics[round_index] = self._get_subset_metric(
+            round_index, self.complete_player_indices
+        )
         if self.round_trunc_threshold is not None and (
             abs(
                 self.round_metrics[round_index]
@@ -110,8 +170,10 @@ class RoundBasedShapleyValue(ShapleyValue):
                 self.get_last_round_metric(round_index=round_index),
                 self.round_trunc_threshold,
             )
+            self.metric_cache.end_round(round_index)
             return None
         self._compute_impl(round_index=round_index)
+        self.metric_cache.end_round(round_index)
         return None
 
     def get_best_players(self, round_index: int) -> set | None:
@@ -121,7 +183,9 @@ class RoundBasedShapleyValue(ShapleyValue):
         return None
 
     def exit(self) -> None:
-        pass
+        self.metric_cache.save()
+        if self.metric_evaluator is not None:
+            self.metric_evaluator.shutdown()
 
     def _compute_impl(self, round_index: int) -> None:
         raise NotImplementedError()
@@ -0,0 +1,57 @@
+import math
+from collections.abc import Iterable
+
+import numpy as np
+
+
+def subset_to_mask(subset: Iterable[int]) -> int:
+    mask = 0
+    for player_index in subset:
+        mask |= 1 << player_index
+    return mask
+
+
+def mask_to_subset(mask: int) -> tuple[int, ...]:
+    subset: list[int] = []
+    player_index = 0
+    while mask:
+        if mask & 1:
+            subset.append(player_index)
+        mask >>= 1
+        player_index += 1
+    return tuple(subset)
+
+
+def get_popcounts(player_number: int) -> np.ndarray:
+    # Subset sizes of all bitmasks of player_number players
+    popcounts = np.zeros(1, dtype=np.int64)
+    for _ in range(player_number):
+        popcounts = np.concatenate((popcounts, popcounts + 1))
+    return popcounts
+
+
+def compute_shapley_values(
+    metric_table: np.ndarray, player_mask: int, player_number: int
+) -> np.ndarray:
+    # Exact Shapley values of the game restricted to the players in
+    # player_mask, where metric_table[mask] is the metric of subset mask. Each
+    # marginal contribution v(S) - v(S \ {i}) is weighted by
+    # 1 / (C(n - 1, |S| - 1) * n), with n the number of players in the game.
+    masks = np.arange(len(metric_table), dtype=np.int64)
+    popcounts = get_popcounts(player_number)
+    n = int(popcounts[player_mask])
+    weights = np.zeros(player_number + 1)
+    for k in range(1, n + 1):
+        weights[k] = 1 / (math.comb(n - 1, k - 1) * n)
+    submasks = masks[(masks & ~player_mask) == 0]
+    shapley_values = np.zeros(player_number)
+    for player_index in range(player_number):
+        bit = 1 << player_index
+        if not player_mask & bit:
+            continue
+        subsets = submasks[(submasks & bit) != 0]
+        shapley_values[player_index] = np.dot(
+            metric_table[subsets] - metric_table[subsets ^ bit],
+            weights[popcounts[subsets]],
+        )
+    return shapley_values
@@ -0,0 +1,76 @@
+import collections
+import os
+import pickle
+from typing import Any
+
+from cyy_naive_lib.log import log_info
+
+
+class SubsetMetricCache:
+    # Metrics of player subsets keyed by (round_index, bitmask), shared by
+    # the Shapley value algorithms which compute on the same players. Only
+    # deterministic metrics can be reused by later computations, so otherwise
+    # the metrics of a round are dropped once the round is computed, and
+    # nothing is saved. Least recently used entries beyond max_size are evicted.
+    def __init__(
+        self,
+        max_size: int | None = None,
+        path: str | None = None,
+        deterministic: bool = True,
+    ) -> None:
+        assert max_size is None or max_size > 0
+        self.__max_size = max_size
+        self.__path = path
+        self.__deterministic = deterministic
+        self.__players: tuple | None = None
+        self.__metrics: collections.OrderedDict[tuple[int, int], Any] = (
+            collections.OrderedDict()
+        )
+        if path is not None and deterministic and os.path.isfile(path):
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+            self.__players = data["players"]
+            self.__metrics.update(data["metrics"])
+            log_info("load %s subset metrics from %s", len(self.__metrics), path)
+
+    @property
+    def deterministic(self) -> bool:
+        return self.__deterministic
+
+    def __len__(self) -> int:
+        return len(self.__metrics)
+
+    def bind_players(self, players: tuple) -> None:
+        # Bitmasks index the players, which must stay the same.
+        if self.__players is None:
+            self.__players = players
+        assert self.__players == players
+
+    def get(self, round_index: int, mask: int) -> Any | None:
+        key = (round_index, mask)
+        metric = self.__metrics.get(key)
+        if metric is not None:
+            self.__metrics.move_to_end(key)
+        return metric
+
+    def put(self, round_index: int, mask: int, metric: Any) -> None:
+        key = (round_index, mask)
+        self.__metrics[key] = metric
+        self.__metrics.move_to_end(key)
+        if self.__max_size is not None:
+            while len(self.__metrics) > self.__max_size:
+                self.__metrics.popitem(last=False)
+
+    def end_round(self, round_index: int) -> None:
+        if self.__deterministic:
+            return
+        for key in [key for key in self.__metrics if key[0] == round_index]:
+            del self.__metrics[key]
+
+    def save(self) -> None:
+        if self.__path is None or not self.__deterministic:
+            return
+        tmp_path = self.__path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"players": self.__players, "metrics": dict(self.__metrics)}, f)
+        os.replace(tmp_path, self.__path)
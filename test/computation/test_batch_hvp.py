@@ -1,13 +1,21 @@
 import importlib.util
+from types import SimpleNamespace
 
 import torch
 import torch.nn
 from cyy_naive_lib.log import log_error
 from cyy_naive_lib.time_counter import TimeCounter
-from cyy_torch_algorithm.computation.batch_hvp.batch_hvp_hook import BatchHVPHook
+from cyy_torch_algorithm.computation.batch_hvp import (
+    BatchHVPHook,
+    HessianEigenHook,
+    HessianTraceHook,
+    InverseHVPHook,
+)
+from cyy_torch_algorithm.computation.flat_parameter import ParameterLayout
 from cyy_torch_toolbox import (
     Config,
     ExecutorHookPoint,
+    ModelEvaluator,
     StopExecutingException,
     cat_tensor_dict,
 )
@@ -64,3 +72,256 @@ def test_CV_jvp() -> None:
     hook.set_vectors(vectors)
     trainer.train()
     hook.reset()
+
+
+def test_CV_linearized_hvp() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.trainer_config.hook_config.use_amp = False
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    trainer = config.create_trainer()
+    hook = BatchHVPHook()
+    hook.enable_linearization()
+    trainer.append_hook(hook)
+
+    def check_results(**kwargs):
+        if hook.result_dict:
+            products = {
+                k: cat_tensor_dict(v).cpu() for k, v in hook.result_dict.items()
+            }
+            hook.reset_result()
+            assert torch.linalg.vector_norm(products[1] * 2 - products[2]).item() < 0.1
+            hook.add_data([vector * 3 for vector in hook.get_vectors()])
+            new_products = hook.result_dict
+            assert (
+                torch.linalg.vector_norm(
+                    cat_tensor_dict(new_products[1]).cpu() - products[1] * 3
+                ).item()
+                < 0.1
+            )
+            hook.reset_result()
+            raise StopExecutingException()
+
+    trainer.append_named_hook(
+        ExecutorHookPoint.AFTER_BATCH, "check results", check_results
+    )
+    parameters = trainer.model_util.get_parameters()
+    hook.set_vectors(
+        [
+            {k: torch.ones_like(v, device="cpu") * i for k, v in parameters.items()}
+            for i in range(3)
+        ]
+    )
+    trainer.train()
+    hook.reset()
+
+
+def test_CV_inverse_hvp() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.trainer_config.hook_config.use_amp = False
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    trainer = config.create_trainer()
+    damping = 1.0
+    hook = InverseHVPHook()
+    hook.set_solver("cg", max_iteration=100, tolerance=1e-6, damping=damping)
+    trainer.append_hook(hook)
+    # Products with the solutions on the same batch
+    hvp_hook = BatchHVPHook()
+    hvp_hook.enable_linearization()
+    trainer.append_hook(hvp_hook)
+    parameters = trainer.model_util.get_parameters()
+    parameter_layout = ParameterLayout(parameters)
+    vectors = [
+        torch.ones_like(trainer.model_util.get_parameter_list(), device="cpu") * (i + 1)
+        for i in range(2)
+    ]
+
+    def check_results(**kwargs):
+        if hook.result_dict:
+            assert len(hook.result_dict) == 2
+            solutions = [hook.result_dict[idx].cpu() for idx in range(2)]
+            hook.reset_result()
+            hvp_hook.reset_result()
+            hvp_hook.add_data(
+                [parameter_layout.unflatten(solution) for solution in solutions]
+            )
+            products = hvp_hook.result_dict
+            for idx, solution in enumerate(solutions):
+                residual = (
+                    cat_tensor_dict(products[idx]).cpu()
+                    + damping * solution
+                    - vectors[idx]
+                )
+                relative_residual = torch.linalg.vector_norm(
+                    residual
+                ) / torch.linalg.vector_norm(vectors[idx])
+                assert relative_residual < 1e-2
+            hvp_hook.reset_result()
+            raise StopExecutingException()
+
+    trainer.append_named_hook(
+        ExecutorHookPoint.AFTER_BATCH, "check results", check_results
+    )
+    hook.set_vectors(vectors)
+    hvp_hook.set_vectors([{k: torch.zeros_like(v) for k, v in parameters.items()}])
+    trainer.train()
+    hook.reset()
+    hvp_hook.reset()
+
+
+def test_CV_hessian_trace() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.trainer_config.hook_config.use_amp = False
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    trainer = config.create_trainer()
+    hook = HessianTraceHook()
+    hook.set_probe_config(
+        probe_batch_size=8, max_probe_number=32, estimate_diagonal=True
+    )
+    trainer.append_hook(hook)
+    parameter_names = trainer.model_util.get_parameters().keys()
+
+    batch_number = 0
+
+    def check_results(**kwargs):
+        nonlocal batch_number
+        batch_number += 1
+        if batch_number == 2:
+            # Estimates of different batches are kept apart.
+            assert set(hook.result_dict.keys()) == {0, 1}
+            for estimate in hook.result_dict.values():
+                assert 1 < estimate["probe_number"] <= 32
+                assert estimate["diagonal"].keys() == parameter_names
+            hook.reset_result()
+            raise StopExecutingException()
+
+    trainer.append_named_hook(
+        ExecutorHookPoint.AFTER_BATCH, "check results", check_results
+    )
+    trainer.train()
+    hook.reset()
+
+
+def get_tiny_model_evaluator() -> tuple[ModelEvaluator, torch.Tensor, torch.Tensor]:
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(
+        torch.nn.Linear(4, 3), torch.nn.Tanh(), torch.nn.Linear(3, 2)
+    )
+    model_evaluator = ModelEvaluator(model=model, loss_fun=torch.nn.CrossEntropyLoss())
+    return model_evaluator, torch.randn(8, 4), torch.randint(0, 2, (8,))
+
+
+def get_dense_hessian(
+    model: torch.nn.Module, inputs: torch.Tensor, targets: torch.Tensor
+) -> tuple[torch.Tensor, ParameterLayout]:
+    parameters = {k: v.detach() for k, v in model.named_parameters()}
+    parameter_layout = ParameterLayout(parameters)
+
+    def loss_fun(flat_parameters: torch.Tensor) -> torch.Tensor:
+        return torch.nn.functional.cross_entropy(
+            torch.func.functional_call(
+                model, parameter_layout.unflatten(flat_parameters), (inputs,)
+            ),
+            targets,
+        )
+
+    return torch.func.hessian(loss_fun)(
+        parameter_layout.flatten(parameters)
+    ), parameter_layout
+
+
+def test_hessian_trace_exact() -> None:
+    model_evaluator, inputs, targets = get_tiny_model_evaluator()
+    hessian, parameter_layout = get_dense_hessian(
+        model_evaluator.model, inputs, targets
+    )
+    hook = HessianTraceHook()
+    hook.set_executor_backend("inline")
+    hook.set_probe_config(max_probe_number=4096, tolerance=1e-3, estimate_diagonal=True)
+    for batch_index in range(2):
+        hook._before_batch(
+            executor=SimpleNamespace(model_evaluator=model_evaluator),
+            inputs=inputs,
+            targets=targets,
+            batch_index=batch_index,
+        )
+    assert set(hook.result_dict.keys()) == {0, 1}
+    for estimate in hook.result_dict.values():
+        assert (
+            abs(estimate["trace"] - hessian.trace().item())
+            <= 4 * estimate["trace_std_error"] + 1e-4
+        )
+        assert torch.allclose(
+            parameter_layout.flatten(estimate["diagonal"]).cpu(),
+            hessian.diagonal(),
+            atol=0.05,
+        )
+    hook.release()
+
+
+def test_hessian_eigenvalues_exact() -> None:
+    model_evaluator, inputs, targets = get_tiny_model_evaluator()
+    hessian, _ = get_dense_hessian(model_evaluator.model, inputs, targets)
+    hook = HessianEigenHook()
+    hook.set_executor_backend("inline")
+    hook.set_eigen_config(top_k=2, max_iteration=30, tolerance=1e-6)
+    hook._before_batch(
+        executor=SimpleNamespace(model_evaluator=model_evaluator),
+        inputs=inputs,
+        targets=targets,
+        batch_index=0,
+    )
+    eigenvalues = hook.result_dict[0]["eigenvalues"].cpu()
+    assert torch.allclose(
+        eigenvalues, torch.linalg.eigvalsh(hessian).flip(0)[:2], atol=1e-4
+    )
+    hook.release()
+
+
+def test_CV_hessian_eigenvalues() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.trainer_config.hook_config.use_amp = False
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    trainer = config.create_trainer()
+    hook = HessianEigenHook()
+    hook.set_eigen_config(top_k=2, max_iteration=10)
+    trainer.append_hook(hook)
+
+    def check_results(**kwargs):
+        if hook.result_dict:
+            result = hook.result_dict[0]
+            eigenvalues = result["eigenvalues"].cpu()
+            assert eigenvalues.shape == (2,)
+            assert eigenvalues[0] >= eigenvalues[1]
+            assert len(result["eigenvectors"]) == 2
+            hook.reset_result()
+            raise StopExecutingException()
+
+    trainer.append_named_hook(
+        ExecutorHookPoint.AFTER_BATCH, "check results", check_results
+    )
+    trainer.train()
+    hook.reset()
@@ -0,0 +1,20 @@
+import torch
+from cyy_torch_algorithm.computation.flat_parameter import ParameterLayout
+
+
+def test_parameter_layout_mixed_dtypes() -> None:
+    tensor_dict = {
+        "a": torch.randn(2, 3, dtype=torch.float16),
+        "b": torch.randn(4, dtype=torch.float32),
+        "c": torch.randn(1, dtype=torch.bfloat16),
+    }
+    layout = ParameterLayout(tensor_dict)
+    assert layout.dtype == torch.float32
+    flat_tensor = layout.flatten(tensor_dict)
+    assert flat_tensor.dtype == torch.float32
+    buffer = torch.empty(layout.numel, dtype=layout.dtype)
+    layout.flatten_into(tensor_dict, buffer)
+    assert torch.equal(buffer, flat_tensor)
+    for name, tensor in layout.unflatten(buffer).items():
+        assert tensor.dtype == tensor_dict[name].dtype
+        assert torch.equal(tensor, tensor_dict[name])
@@ -0,0 +1,94 @@
+import math
+
+import torch
+from cyy_torch_algorithm import RandomProjector
+
+
+def get_gradients() -> dict[str, torch.Tensor]:
+    # Batched gradients of a small model with 3 samples.
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(
+        torch.nn.Linear(5, 7), torch.nn.ReLU(), torch.nn.Linear(7, 3)
+    )
+    return {k: torch.randn(3, *v.shape) for k, v in model.named_parameters()}
+
+
+def test_random_projection_determinism() -> None:
+    gradients = get_gradients()
+    for distribution in ("rademacher", "gaussian"):
+        sketches = RandomProjector(
+            dimension=4, seed=1, distribution=distribution
+        ).project(gradients)
+        assert sketches.shape == (3, 4)
+        assert torch.equal(
+            sketches,
+            RandomProjector(dimension=4, seed=1, distribution=distribution).project(
+                gradients
+            ),
+        )
+        assert not torch.equal(
+            sketches,
+            RandomProjector(dimension=4, seed=2, distribution=distribution).project(
+                gradients
+            ),
+        )
+
+
+def test_random_projection_matrix() -> None:
+    gradients = get_gradients()
+    flat_gradients = torch.cat(
+        [gradients[k].reshape(3, -1) for k in sorted(gradients.keys())], dim=1
+    )
+    parameter_number = flat_gradients.shape[1]
+    projector = RandomProjector(dimension=40, seed=1)
+    # The P x k matrix, whose rows only depend on their indices
+    matrix = projector.get_rows(0, parameter_number)
+    assert matrix.shape == (parameter_number, 40)
+    assert set(matrix.unique().tolist()) == {-1.0, 1.0}
+    assert abs(matrix.mean().item()) < 0.1
+    for begin, end in ((0, 1), (5, 17), (parameter_number - 3, parameter_number)):
+        assert torch.equal(projector.get_rows(begin, end), matrix[begin:end])
+    for _ in range(2):
+        assert torch.allclose(
+            projector.project(gradients),
+            flat_gradients @ matrix / math.sqrt(40),
+            atol=1e-5,
+        )
+
+
+def test_random_projection_device() -> None:
+    if not torch.cuda.is_available():
+        return
+    gradients = get_gradients()
+    device_gradients = {k: v.cuda() for k, v in gradients.items()}
+    for distribution in ("rademacher", "gaussian"):
+        projector = RandomProjector(dimension=4, seed=1, distribution=distribution)
+        assert torch.allclose(
+            projector.project(gradients),
+            projector.project(device_gradients).cpu(),
+            atol=1e-4,
+        )
+        if distribution == "rademacher":
+            assert torch.equal(
+                projector.get_rows(0, 100),
+                projector.get_rows(0, 100, device=torch.device("cuda")).cpu(),
+            )
+
+
+def test_random_projection_block_size() -> None:
+    gradients = get_gradients()
+    for distribution in ("rademacher", "gaussian"):
+        sketches = RandomProjector(
+            dimension=4, seed=1, distribution=distribution
+        ).project(gradients)
+        for block_size in (1, 5, 16, 1000):
+            assert torch.allclose(
+                sketches,
+                RandomProjector(
+                    dimension=4,
+                    seed=1,
+                    distribution=distribution,
+                    block_size=block_size,
+                ).project(gradients),
+                atol=1e-5,
+            )
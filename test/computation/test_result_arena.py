@@ -0,0 +1,22 @@
+import torch
+from cyy_torch_algorithm.computation.result_arena import SharedResultArena
+
+
+def test_result_arena_slots() -> None:
+    arena = SharedResultArena(slot_number=2)
+    arena.allocate(
+        layout={"a": torch.Size([2]), "b": torch.Size([3])}, dtype=torch.float
+    )
+    slots = arena.assign_slots([10, 11, 12])
+    # The arena is full, so the last key gets no slot.
+    assert slots == {10: 0, 11: 1}
+    arena.write(slots[11], {"a": torch.ones(2), "b": torch.zeros(3)})
+    views = arena.get_views(slots[11])
+    assert isinstance(views, dict)
+    assert torch.equal(views["a"], torch.ones(2))
+    # Freed slots are reused by other keys.
+    arena.free_slot(10)
+    assert arena.get_slot(10) is None
+    assert arena.assign_slots([12, 11]) == {12: 0, 11: 1}
+    arena.clear_slots()
+    assert arena.assign_slots([13]) == {13: 0}
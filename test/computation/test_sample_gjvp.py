@@ -35,3 +35,31 @@ def test_CV_jvp() -> None:
         ExecutorHookPoint.AFTER_BATCH, "check results", print_products
     )
     trainer.train()
+
+
+def test_CV_multiple_vector_jvp() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    trainer = config.create_trainer()
+    hook = SampleGradientJVPHook()
+    hook.set_vectors([torch.ones((32, 32)).view(-1) * i for i in range(3)])
+    trainer.append_hook(hook)
+
+    def check_products(**kwargs):
+        if hook.result_dict:
+            products = next(iter(hook.result_dict.values())).cpu()
+            assert products.shape[0] == 3
+            assert torch.allclose(products[1] * 2, products[2], atol=1e-4)
+            hook.reset()
+            raise StopExecutingException()
+
+    trainer.append_named_hook(
+        ExecutorHookPoint.AFTER_BATCH, "check results", check_products
+    )
+    trainer.train()
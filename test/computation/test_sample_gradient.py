@@ -1,7 +1,27 @@
+import copy
 import importlib.util
+import time
 
-from cyy_torch_algorithm import SampleGradientHook
-from cyy_torch_toolbox import Config, ExecutorHookPoint, StopExecutingException
+import torch
+from cyy_torch_algorithm import (
+    ComputationWorkerPool,
+    SampleGradientHook,
+    SampleGradientNormHook,
+    iter_sample_gradients,
+    shutdown_worker_pool,
+)
+from cyy_torch_algorithm.computation.compile_cache import CompiledFunctionCache
+from cyy_torch_algorithm.computation.sample_gradient.sample_gradient_hook import (
+    sample_gradient_worker_fun,
+)
+from cyy_torch_toolbox import (
+    Config,
+    ExecutorHookPoint,
+    MachineLearningPhase,
+    ModelEvaluator,
+    StopExecutingException,
+    cat_tensor_dict,
+)
 
 has_cyy_huggingface_toolbox: bool = (
     importlib.util.find_spec("cyy_huggingface_toolbox") is not None
@@ -65,3 +85,440 @@ def test_huggingface_sample_gradient() -> None:
     )
     trainer.train()
     hook.reset()
+
+
+def test_CV_sample_gradient_arena() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    trainer = config.create_trainer()
+    hook = SampleGradientHook()
+    hook.set_result_arena_size(10)
+    hook.set_computed_indices(set(range(10)))
+    trainer.append_hook(hook)
+
+    def check_sample_gradients(**kwargs):
+        if hook.result_dict:
+            gradient = next(iter(hook.result_dict.values()))
+            assert all(v.is_shared() for v in gradient.values())
+            hook.reset_result()
+            raise StopExecutingException()
+
+    trainer.append_named_hook(
+        ExecutorHookPoint.AFTER_BATCH, "check gradients", check_sample_gradients
+    )
+    trainer.train()
+    hook.reset()
+
+
+def test_CV_sample_gradient_flat_parameters() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    trainer = config.create_trainer()
+    parameter_number = sum(
+        v.numel() for v in trainer.model_util.get_parameters().values()
+    )
+    hook = SampleGradientHook()
+    hook.enable_flat_parameters()
+    hook.set_computed_indices(set(range(10)))
+    trainer.append_hook(hook)
+
+    def check_sample_gradients(**kwargs):
+        if hook.result_dict:
+            gradient = next(iter(hook.result_dict.values()))
+            assert gradient.shape == (parameter_number,)
+            hook.reset_result()
+            raise StopExecutingException()
+
+    trainer.append_named_hook(
+        ExecutorHookPoint.AFTER_BATCH, "check gradients", check_sample_gradients
+    )
+    trainer.train()
+    hook.reset()
+
+
+def test_CV_sample_gradient_chunking() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    trainer = config.create_trainer()
+    hook = SampleGradientHook()
+    trainer.append_hook(hook)
+    chunked_hooks = []
+    for chunk_size, memory_budget in ((3, None), (None, 1)):
+        # A memory budget of one byte gives chunks of a single sample.
+        chunked_hook = SampleGradientHook()
+        chunked_hook.enable_chunking(chunk_size=chunk_size, memory_budget=memory_budget)
+        trainer.append_hook(chunked_hook)
+        chunked_hooks.append(chunked_hook)
+
+    def check_sample_gradients(**kwargs):
+        result_dict = hook.result_dict
+        assert len(result_dict) == 8
+        for chunked_hook in chunked_hooks:
+            chunked_result_dict = chunked_hook.result_dict
+            assert chunked_result_dict.keys() == result_dict.keys()
+            for sample_index, gradient in result_dict.items():
+                for k, v in gradient.items():
+                    assert torch.allclose(
+                        v.cpu(), chunked_result_dict[sample_index][k].cpu(), atol=1e-6
+                    )
+        raise StopExecutingException()
+
+    trainer.append_named_hook(
+        ExecutorHookPoint.AFTER_BATCH, "check gradients", check_sample_gradients
+    )
+    trainer.train()
+    hook.reset()
+    for chunked_hook in chunked_hooks:
+        chunked_hook.reset()
+
+
+def test_CV_sample_gradient_worker_pool() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    for _ in range(2):
+        trainer = config.create_trainer()
+        hook = SampleGradientHook()
+        hook.enable_worker_pool()
+        hook.set_computed_indices(set(range(10)))
+        trainer.append_hook(hook)
+
+        def check_sample_gradients(hook=hook, **kwargs):
+            if hook.result_dict:
+                hook.reset_result()
+                raise StopExecutingException()
+
+        trainer.append_named_hook(
+            ExecutorHookPoint.AFTER_BATCH, "check gradients", check_sample_gradients
+        )
+        trainer.train()
+        hook.reset()
+        assert ComputationWorkerPool.get().ref_cnt == 0
+    shutdown_worker_pool()
+
+
+def test_CV_sample_gradient_concurrent_worker_pool() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    trainer = config.create_trainer()
+    hooks = []
+    for _ in range(2):
+        hook = SampleGradientHook()
+        hook.enable_worker_pool()
+        hook.set_worker_num(2)
+        hook.set_computed_indices(set(range(10)))
+        trainer.append_hook(hook)
+        hooks.append(hook)
+
+    def check_sample_gradients(**kwargs):
+        # Both hooks are bound at once, and each gets its own results.
+        assert ComputationWorkerPool.get().ref_cnt == 2
+        result_dicts = [hook.result_dict for hook in hooks]
+        if result_dicts[0]:
+            assert result_dicts[0].keys() == result_dicts[1].keys()
+            for sample_index, gradient in result_dicts[0].items():
+                for k, v in gradient.items():
+                    assert torch.allclose(
+                        v.cpu(), result_dicts[1][sample_index][k].cpu()
+                    )
+            raise StopExecutingException()
+
+    trainer.append_named_hook(
+        ExecutorHookPoint.AFTER_BATCH, "check gradients", check_sample_gradients
+    )
+    trainer.train()
+    for hook in hooks:
+        hook.reset()
+    assert ComputationWorkerPool.get().ref_cnt == 0
+    assert ComputationWorkerPool.get().worker_num == 2
+    shutdown_worker_pool()
+
+
+def test_CV_sample_gradient_in_process_backends() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    for backend in ("thread", "inline"):
+        trainer = config.create_trainer()
+        hook = SampleGradientHook()
+        hook.set_executor_backend(backend)
+        hook.set_worker_num(2)
+        hook.set_computed_indices(set(range(10)))
+        trainer.append_hook(hook)
+
+        def check_sample_gradients(hook=hook, **kwargs):
+            if hook.result_dict:
+                assert set(hook.result_dict.keys()) <= set(range(10))
+                hook.reset_result()
+                raise StopExecutingException()
+
+        trainer.append_named_hook(
+            ExecutorHookPoint.AFTER_BATCH, "check gradients", check_sample_gradients
+        )
+        trainer.train()
+        hook.reset()
+
+
+def test_CV_sample_gradient_training() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    trainer = config.create_trainer()
+    hook = SampleGradientHook()
+    trainer.append_hook(hook)
+    batches: list = []
+
+    def save_batch(inputs, targets, sample_indices, **kwargs):
+        # Results are fetched after training, so the tasks of several
+        # parameter versions are in flight.
+        batches.append(
+            (
+                copy.deepcopy(trainer.model_util.model).cpu(),
+                inputs.cpu(),
+                targets.cpu(),
+                sample_indices.tolist(),
+            )
+        )
+
+    def stop_training(**kwargs):
+        if len(batches) == 5:
+            raise StopExecutingException()
+
+    trainer.append_named_hook(ExecutorHookPoint.BEFORE_BATCH, "save", save_batch)
+    trainer.append_named_hook(ExecutorHookPoint.AFTER_BATCH, "stop", stop_training)
+    trainer.train()
+    result_dict = hook.result_dict
+    for model, inputs, targets, sample_indices in batches:
+        for idx, sample_index in enumerate(sample_indices):
+            loss = torch.nn.functional.cross_entropy(
+                model(inputs[idx : idx + 1]), targets[idx : idx + 1]
+            )
+            gradients = torch.autograd.grad(loss, list(model.parameters()))
+            assert torch.allclose(
+                sum(g.norm() ** 2 for g in gradients),
+                sum(g.cpu().norm() ** 2 for g in result_dict[sample_index].values()),
+                rtol=1e-3,
+            )
+    hook.reset()
+
+
+def test_CV_sample_gradient_compile() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    trainer = config.create_trainer()
+    hook = SampleGradientHook()
+    hook.set_executor_backend("inline")
+    hook.enable_compile()
+    hook.set_computed_indices(set(range(10)))
+    trainer.append_hook(hook)
+
+    def check_sample_gradients(**kwargs):
+        if hook.result_dict:
+            assert set(hook.result_dict.keys()) <= set(range(10))
+            hook.reset_result()
+            raise StopExecutingException()
+
+    trainer.append_named_hook(
+        ExecutorHookPoint.AFTER_BATCH, "check gradients", check_sample_gradients
+    )
+    trainer.train()
+    hook.reset()
+
+
+def test_sample_gradient_compile_padding() -> None:
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(
+        torch.nn.Linear(4, 3), torch.nn.Tanh(), torch.nn.Linear(3, 2)
+    )
+    model_evaluator = ModelEvaluator(model=model, loss_fun=torch.nn.CrossEntropyLoss())
+    parameters = {k: v.detach() for k, v in model.named_parameters()}
+    compile_cache = CompiledFunctionCache()
+    for sample_number in range(3, 9):
+        inputs = torch.randn(sample_number, 1, 4)
+        targets = torch.randint(0, 2, (sample_number, 1))
+        kwargs = {
+            "model_evaluator": model_evaluator,
+            "sample_indices": list(range(sample_number)),
+            "inputs": inputs,
+            "targets": targets,
+            "worker_device": torch.device("cpu"),
+            "parameters": parameters,
+        }
+        gradients = sample_gradient_worker_fun(**kwargs)
+        compiled_gradients = sample_gradient_worker_fun(
+            compile_cache=compile_cache, **kwargs
+        )
+        assert set(compiled_gradients.keys()) == set(range(sample_number))
+        for sample_index, gradient in gradients.items():
+            for name, tensor in gradient.items():
+                assert torch.allclose(
+                    compiled_gradients[sample_index][name], tensor, atol=1e-5
+                )
+    # Sample numbers are padded to 4 and 8.
+    assert len(compile_cache) == 2
+
+
+def test_CV_sample_gradient_timing() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    trainer = config.create_trainer()
+    hook = SampleGradientHook()
+    stages: set = set()
+    hook.enable_timing(callback=lambda stage, **kwargs: stages.add(stage))
+    trainer.append_hook(hook)
+
+    def check_timing(**kwargs):
+        if hook.result_dict:
+            hook.reset_result()
+            raise StopExecutingException()
+
+    trainer.append_named_hook(ExecutorHookPoint.AFTER_BATCH, "check", check_timing)
+    trainer.train()
+    metrics = hook.timing_metrics
+    for stage in ("enqueue", "model_fetch", "device_transfer", "compute", "fetch"):
+        assert stage in stages
+        assert metrics[stage]["count"] > 0
+        assert metrics[stage]["p50_ms"] <= metrics[stage]["p99_ms"]
+    hook.reset()
+
+
+def test_CV_sample_gradient_iteration() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    trainer = config.create_trainer()
+    hook = SampleGradientHook()
+    hook.set_max_pending_task_num(4)
+    hook.set_computed_indices(set(range(10)))
+    trainer.append_hook(hook)
+
+    def check_sample_gradients(**kwargs):
+        sample_indices = [sample_index for sample_index, _ in hook.iter_results()]
+        if sample_indices:
+            assert not hook.has_unfetched_result()
+            raise StopExecutingException()
+
+    trainer.append_named_hook(
+        ExecutorHookPoint.AFTER_BATCH, "check gradients", check_sample_gradients
+    )
+    trainer.train()
+    hook.reset()
+
+
+def test_CV_iter_sample_gradients_early_exit() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.hyper_parameter_config.batch_size = 8
+    trainer = config.create_trainer()
+    inferencer = trainer.get_inferencer(phase=MachineLearningPhase.Test)
+    iterator = iter_sample_gradients(inferencer=inferencer, max_pending_task_num=2)
+    sample_indices = []
+    for sample_index, gradient in iterator:
+        assert gradient
+        sample_indices.append(sample_index)
+        if len(sample_indices) == 3:
+            break
+    # Closing stops the inference instead of computing the whole dataset.
+    start_time = time.monotonic()
+    iterator.close()
+    assert time.monotonic() - start_time < 30
+    assert len(sample_indices) == 3
+
+
+def test_CV_sample_gradient_norm() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    trainer = config.create_trainer()
+    hook = SampleGradientNormHook()
+    hook.set_computed_indices(set(range(10)))
+    trainer.append_hook(hook)
+    gradient_hook = SampleGradientHook()
+    gradient_hook.set_computed_indices(set(range(10)))
+    trainer.append_hook(gradient_hook)
+
+    def print_sample_gradient_norms(**kwargs):
+        if hook.result_dict:
+            gradients = gradient_hook.result_dict
+            assert hook.result_dict.keys() == gradients.keys()
+            for sample_index, norm in hook.result_dict.items():
+                assert torch.allclose(
+                    torch.tensor(norm).cpu(),
+                    cat_tensor_dict(gradients[sample_index]).norm().cpu(),
+                    rtol=1e-4,
+                )
+            print(hook.result_dict)
+            hook.reset_result()
+            gradient_hook.reset_result()
+            raise StopExecutingException()
+
+    trainer.append_named_hook(
+        ExecutorHookPoint.AFTER_BATCH, "check norms", print_sample_gradient_norms
+    )
+    trainer.train()
+    hook.reset()
+    gradient_hook.reset()
@@ -39,6 +39,35 @@ def test_CV_vjp() -> None:
     hook.reset()
 
 
+def test_CV_multiple_vector_vjp() -> None:
+    if not has_cyy_torch_vision:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.hyper_parameter_config.epoch = 1
+    config.hyper_parameter_config.batch_size = 8
+    config.hyper_parameter_config.learning_rate = 0.01
+    trainer = config.create_trainer()
+    hook = SampleGradientVJPHook()
+    vector = torch.ones_like(trainer.model_util.get_parameter_list()).view(-1)
+    hook.set_vectors([vector * i for i in range(3)])
+    trainer.append_hook(hook)
+
+    def check_result(**kwargs) -> None:
+        if hook.result_dict:
+            products = next(iter(hook.result_dict.values())).cpu()
+            assert products.shape[0] == 3
+            assert torch.allclose(products[1] * 2, products[2], atol=1e-4)
+            raise StopExecutingException()
+
+    trainer.append_named_hook(
+        ExecutorHookPoint.AFTER_BATCH, "check gradients", check_result
+    )
+    trainer.train()
+    hook.reset()
+
+
 def test_hugging_face_vjp() -> None:
     if not has_cyy_huggingface_toolbox:
         return
@@ -0,0 +1,36 @@
+import importlib.util
+
+import torch
+from cyy_torch_algorithm import get_sample_gradient_dict, get_sample_gradients
+from cyy_torch_toolbox import Config, MachineLearningPhase
+
+has_cyy_torch_vision: bool = importlib.util.find_spec("cyy_torch_vision") is not None
+has_cyy_torch_cpp_extension: bool = (
+    importlib.util.find_spec("cyy_torch_cpp_extension") is not None
+)
+
+
+def test_sample_gradient_dict() -> None:
+    if not has_cyy_torch_vision or not has_cyy_torch_cpp_extension:
+        return
+    import cyy_torch_vision  # noqa: F401
+
+    config = Config("MNIST", "lenet5")
+    config.hyper_parameter_config.batch_size = 8
+    trainer = config.create_trainer()
+    inferencer = trainer.get_inferencer(phase=MachineLearningPhase.Test)
+    computed_indices = set(range(10))
+    tensor_dict, parameter_layout = get_sample_gradient_dict(
+        inferencer=inferencer, computed_indices=computed_indices, cache_size=4
+    )
+    assert parameter_layout is not None
+    gradients = get_sample_gradients(
+        inferencer=inferencer, computed_indices=computed_indices
+    )
+    assert set(gradients.keys()) == computed_indices
+    for key, tensor in tensor_dict.items():
+        assert key in computed_indices
+        assert tensor.shape == (parameter_layout.numel,)
+        for name, gradient in parameter_layout.unflatten(tensor).items():
+            assert torch.allclose(gradient, gradients[key][name], atol=1e-6)
+    tensor_dict.flush()
@@ -0,0 +1,57 @@
+import numpy as np
+from cyy_torch_algorithm.shapely_value.gtg_shapley_value import (
+    GTGShapleyValue,
+    RunningMeans,
+)
+from cyy_torch_algorithm.shapely_value.subset_bitmask import subset_to_mask
+
+
+def compute_gtg_shapley_values(batch_evaluation: bool) -> tuple[dict, list]:
+    player_number = 6
+    metric_table = np.random.default_rng(0).random(2**player_number)
+    evaluated_subsets: list = []
+
+    def batch_metric_fun(subsets: list) -> dict:
+        evaluated_subsets.append(subsets)
+        return {subset: metric_table[subset_to_mask(subset)] for subset in subsets}
+
+    np.random.seed(0)
+    sv = GTGShapleyValue(players=range(player_number), initial_metric=0.0)
+    sv.set_batch_metric_function(batch_metric_fun)
+    sv.batch_evaluation = batch_evaluation
+    for round_index in range(3):
+        sv.compute(round_index)
+    return sv.get_result(), evaluated_subsets
+
+
+def test_gtg_batch_evaluation() -> None:
+    result, evaluated_subsets = compute_gtg_shapley_values(batch_evaluation=False)
+    batch_result, batch_evaluated_subsets = compute_gtg_shapley_values(
+        batch_evaluation=True
+    )
+    assert result == batch_result
+    # The same subsets are evaluated, in fewer calls
+    assert sorted(sum(evaluated_subsets, [])) == sorted(
+        sum(batch_evaluated_subsets, [])
+    )
+    assert len(batch_evaluated_subsets) < len(evaluated_subsets)
+
+
+def test_running_means() -> None:
+    player_number = 5
+    last_k = 10
+    marginal_contributions = np.random.default_rng(0).normal(size=(50, player_number))
+    running_means = RunningMeans(player_number, last_k)
+    for count, marginal_contribution in enumerate(marginal_contributions, start=1):
+        running_means.add(marginal_contribution.tolist())
+        # The means and errors of all the contributions recorded so far
+        all_means = np.cumsum(marginal_contributions[:count], 0) / np.reshape(
+            np.arange(1, count + 1), (-1, 1)
+        )
+        errors = np.mean(
+            np.abs(all_means[-last_k:] - all_means[-1:])
+            / (np.abs(all_means[-1:]) + 1e-12),
+            -1,
+        )
+        assert np.array_equal(running_means.mean, all_means[-1])
+        assert running_means.get_max_relative_error() == np.max(errors)
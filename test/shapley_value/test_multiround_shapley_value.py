@@ -0,0 +1,62 @@
+import random
+import threading
+import time
+
+import numpy as np
+from cyy_torch_algorithm.shapely_value.multiround_shapley_value import (
+    MultiRoundShapleyValue,
+)
+
+players = ("a", "b", "c", "d", "e")
+
+
+def get_metric_fun(
+    round_metrics: list[np.ndarray], threads: set[threading.Thread] | None = None
+):
+    # The metric of a subset in the round of round_metrics[0]
+    def metric_fun(subset_players: tuple) -> float:
+        if threads is not None:
+            threads.add(threading.current_thread())
+            # Finish in another order than the submission order
+            time.sleep(random.random() / 1000)
+        mask = sum(1 << players.index(player) for player in subset_players)
+        return float(round_metrics[0][mask])
+
+    return metric_fun
+
+
+def compute_shapley_values(parallel: bool) -> tuple[dict, set[threading.Thread]]:
+    rng = np.random.default_rng(0)
+    round_metrics = [rng.random(2 ** len(players))]
+    threads: set[threading.Thread] = set()
+    sv = MultiRoundShapleyValue(players=players, initial_metric=0.0)
+    if parallel:
+        sv.set_parallel_metric_function(
+            get_metric_fun(round_metrics, threads), executor_type="thread", worker_num=4
+        )
+    else:
+        sv.set_metric_function(get_metric_fun(round_metrics))
+    for round_index in range(3):
+        round_metrics[0] = rng.random(2 ** len(players))
+        sv.compute(round_index)
+    if parallel:
+        # Results keep the order of the submitted subsets.
+        subsets = [(4,), (0, 1), (2,), (0, 1, 2, 3), (3,)]
+        assert sv.batch_metric_fun is not None
+        metrics = sv.batch_metric_fun(subsets)
+        assert list(metrics.keys()) == subsets
+        for subset, metric in metrics.items():
+            mask = sum(1 << i for i in subset)
+            assert metric == round_metrics[0][mask]
+    sv.exit()
+    return sv.get_result(), threads
+
+
+def test_parallel_metric_function() -> None:
+    result, _ = compute_shapley_values(parallel=False)
+    parallel_result, threads = compute_shapley_values(parallel=True)
+    assert parallel_result == result
+    assert result["round_shapley_values"][0]
+    assert 1 < len(threads) <= 4
+    # exit shuts the thread pool down.
+    assert not any(thread.is_alive() for thread in threads)
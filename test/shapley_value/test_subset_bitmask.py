@@ -0,0 +1,46 @@
+import itertools
+import math
+
+import numpy as np
+from cyy_torch_algorithm.shapely_value.subset_bitmask import (
+    compute_shapley_values,
+    mask_to_subset,
+    subset_to_mask,
+)
+
+
+def get_permutation_shapley_values(
+    metric_table: np.ndarray, player_mask: int, player_number: int
+) -> np.ndarray:
+    # Average marginal contributions over all orders of the players in
+    # player_mask
+    players = mask_to_subset(player_mask)
+    shapley_values = np.zeros(player_number)
+    for permutation in itertools.permutations(players):
+        mask = 0
+        for player_index in permutation:
+            shapley_values[player_index] += (
+                metric_table[mask | (1 << player_index)] - metric_table[mask]
+            )
+            mask |= 1 << player_index
+    return shapley_values / math.factorial(len(players))
+
+
+def test_compute_shapley_values() -> None:
+    player_number = 5
+    rng = np.random.default_rng(0)
+    metric_table = rng.random(2**player_number)
+    for subset in (tuple(range(player_number)), (0, 2, 3), (4,)):
+        player_mask = subset_to_mask(subset)
+        assert mask_to_subset(player_mask) == subset
+        shapley_values = compute_shapley_values(
+            metric_table, player_mask, player_number
+        )
+        assert np.allclose(
+            shapley_values,
+            get_permutation_shapley_values(metric_table, player_mask, player_number),
+        )
+        # efficiency of the restricted game
+        assert math.isclose(
+            shapley_values.sum(), metric_table[player_mask] - metric_table[0]
+        )
@@ -0,0 +1,114 @@
+import os
+import tempfile
+
+import numpy as np
+from cyy_torch_algorithm.shapely_value.gtg_shapley_value import GTGShapleyValue
+from cyy_torch_algorithm.shapely_value.multiround_shapley_value import (
+    MultiRoundShapleyValue,
+)
+from cyy_torch_algorithm.shapely_value.shapley_value import RoundBasedShapleyValue
+from cyy_torch_algorithm.shapely_value.subset_bitmask import subset_to_mask
+from cyy_torch_algorithm.shapely_value.subset_metric_cache import SubsetMetricCache
+
+
+def test_subset_metric_cache_eviction() -> None:
+    cache = SubsetMetricCache(max_size=2)
+    cache.put(0, 1, 0.1)
+    cache.put(0, 2, 0.2)
+    # The entry of mask 1 becomes the most recently used one.
+    assert cache.get(0, 1) == 0.1
+    cache.put(0, 3, 0.3)
+    assert len(cache) == 2
+    assert cache.get(0, 2) is None
+    assert cache.get(0, 1) == 0.1
+    assert cache.get(0, 3) == 0.3
+
+
+def test_subset_metric_cache_save() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "metrics.pkl")
+        cache = SubsetMetricCache(path=path)
+        cache.bind_players(("a", "b"))
+        cache.put(0, 3, 0.5)
+        cache.put(1, 1, 0.25)
+        cache.save()
+        loaded_cache = SubsetMetricCache(path=path)
+        assert len(loaded_cache) == 2
+        assert loaded_cache.get(0, 3) == 0.5
+        assert loaded_cache.get(1, 1) == 0.25
+        loaded_cache.bind_players(("a", "b"))
+        try:
+            loaded_cache.bind_players(("b", "a"))
+            raise RuntimeError("bind_players accepted other players")
+        except AssertionError:
+            pass
+        # Non-deterministic metrics are neither saved nor loaded.
+        cache = SubsetMetricCache(path=path, deterministic=False)
+        assert len(cache) == 0
+        cache.put(0, 1, 0.75)
+        cache.save()
+        assert SubsetMetricCache(path=path).get(0, 1) is None
+
+
+def test_subset_metric_cache_end_round() -> None:
+    cache = SubsetMetricCache(deterministic=False)
+    cache.put(0, 1, 0.1)
+    cache.put(1, 1, 0.2)
+    cache.end_round(0)
+    assert cache.get(0, 1) is None
+    assert cache.get(1, 1) == 0.2
+    cache = SubsetMetricCache()
+    cache.put(0, 1, 0.1)
+    cache.end_round(0)
+    assert cache.get(0, 1) == 0.1
+
+
+def compute_with_cache(
+    sv: RoundBasedShapleyValue, cache: SubsetMetricCache, round_number: int
+) -> list[tuple[int, int]]:
+    # Returns the evaluated rounds and bitmasks.
+    rng = np.random.default_rng(0)
+    metric_tables = [rng.random(2**sv.player_number) for _ in range(round_number)]
+    evaluated_subsets: list[tuple[int, int]] = []
+    round_index = 0
+
+    def metric_fun(players: tuple) -> float:
+        mask = subset_to_mask(players)
+        evaluated_subsets.append((round_index, mask))
+        return float(metric_tables[round_index][mask])
+
+    sv.set_metric_function(metric_fun)
+    sv.set_metric_cache(cache)
+    for round_index in range(round_number):
+        sv.compute(round_index)
+    return evaluated_subsets
+
+
+def test_shared_subset_metric_cache() -> None:
+    players = tuple(range(4))
+    round_number = 2
+    all_subsets = {
+        (round_index, mask)
+        for round_index in range(round_number)
+        for mask in range(1, 2 ** len(players))
+    }
+
+    # All subsets are evaluated once, and GTG reuses all of them.
+    cache = SubsetMetricCache()
+    evaluated_subsets = compute_with_cache(
+        MultiRoundShapleyValue(players=players), cache, round_number
+    )
+    assert sorted(evaluated_subsets) == sorted(all_subsets)
+    np.random.seed(0)
+    assert not compute_with_cache(GTGShapleyValue(players=players), cache, round_number)
+
+    # Multi-round only evaluates the subsets GTG has not evaluated.
+    cache = SubsetMetricCache()
+    np.random.seed(0)
+    evaluated_subsets = compute_with_cache(
+        GTGShapleyValue(players=players), cache, round_number
+    )
+    evaluated_subsets += compute_with_cache(
+        MultiRoundShapleyValue(players=players), cache, round_number
+    )
+    assert sorted(evaluated_subsets) == sorted(all_subsets)